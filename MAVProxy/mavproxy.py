@@ -18,7 +18,6 @@ import serial
 import shlex
 import signal
 import socket
-import struct
 import sys
 import threading
 import time
@@ -38,8 +37,11 @@ from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import module_stats
+from MAVProxy.modules.lib import tlog_writer
 from MAVProxy.modules.lib import mp_substitute
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_reactor
 from MAVProxy.modules.mavproxy_link import preferred_ports
 
 # adding all this allows pyinstaller to build a working windows executable
@@ -74,6 +76,10 @@ if __name__ == '__main__':
 mavversion = None
 mpstate = None
 
+# state for the event driven main loop (see reactor_step)
+reactor_idle_timer = None
+reactor_counts = None
+
 
 class MPStatus(object):
     '''hold status information about the mavproxy'''
@@ -260,19 +266,29 @@ class MPState(object):
             MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0, 10000000), increment=1),
             MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
             MPSetting('select_timeout', float, 0.01, 'select timeout'),
+            MPSetting('reactor', bool, False, 'event driven main loop'),
+            MPSetting('fastfwd', bool, False, 'only decode messages which are needed when forwarding'),
+            MPSetting('idle_rate', float, 100, 'idle task rate in reactor mode (Hz)', range=(1, 1000), increment=1),
 
             MPSetting('altreadout', int, 10, 'Altitude Readout',
                       range=(0, 100), increment=1, tab='Announcements'),
             MPSetting('distreadout', int, 200, 'Distance Readout', range=(0, 10000), increment=1),
 
             MPSetting('moddebug', int, opts.moddebug, 'Module Debug Level', range=(0, 4), increment=1, tab='Debug'),
+            MPSetting('modstats', bool, False, 'record module timing statistics', tab='Debug'),
             MPSetting('script_fatal', bool, False, 'fatal error on bad script', tab='Debug'),
             MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0, 3), tab='Debug'),
             MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+            MPSetting('log_rotate_size', int, 0, 'rotate telemetry logs at this size (MB)', range=(0, 100000), increment=1),
+            MPSetting('log_rotate_time', int, 0, 'rotate telemetry logs after this long (minutes)',
+                      range=(0, 100000), increment=1),
+            MPSetting('log_compress', str, 'none', 'compress rotated telemetry logs', choice=['none', 'gzip', 'zstd']),
             MPSetting('requireexit', bool, False, 'Require exit command'),
             MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
             MPSetting('wpterrainadjust', bool, True, 'Adjust alt of moved wp using terrain'),
             MPSetting('wp_use_mission_int', bool, True, 'use MISSION_ITEM_INT messages'),
+            MPSetting('wp_request_window', int, 10, 'mission items requested at once', range=(1, 100), increment=1),
+            MPSetting('wp_cache', bool, True, 'cache mission items by vehicle mission id'),
             MPSetting('wp_use_waypoint_set_current', bool, False, 'use deprecated WAYPOINT_SET_CURRENT message'),
 
             MPSetting('basealt', int, 0, 'Base Altitude', range=(0, 30000), increment=1, tab='Altitude'),
@@ -299,6 +315,7 @@ class MPState(object):
             MPSetting('fwdpos', bool, False, 'Forward GLOBAL_POSITION_INT on all links'),
             MPSetting('checkdelay', bool, True, 'check for link delay'),
             MPSetting('param_ftp', bool, True, 'try ftp for parameter download'),
+            MPSetting('param_cache', bool, True, 'load parameters from a cache validated by the vehicle'),
             MPSetting('param_docs', bool, True, 'show help for parameters'),
 
             MPSetting('vehicle_name', str, '', 'Vehicle Name', tab='Vehicle'),
@@ -316,6 +333,7 @@ class MPState(object):
             "status"         : ["(VARIABLE)"],
             "module"    : ["list",
                            "load (AVAILMODULES)",
+                           "stats <show|reset|json>",
                            "<unload|reload> (LOADEDMODULES)"]
         }
 
@@ -342,6 +360,9 @@ class MPState(object):
         self.public_modules = {}
         self.functions = MAVFunctions()
         self.select_extra = {}
+        self.reactor = None
+        self.module_stats = module_stats.ModuleStats()
+        self.module_stats_warned = set()
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -387,6 +408,7 @@ class MPState(object):
                 module = m.init(mpstate, **kwargs)
                 if isinstance(module, mp_module.MPModule):
                     mpstate.modules.append((module, m))
+                    self.modules_changed()
                     if not quiet:
                         if kwargs:
                             print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -417,8 +439,10 @@ class MPState(object):
                     if t.is_alive():
                         print("unload on module %s did not complete" % m.name)
                         mpstate.modules.remove((m, pm))
+                        self.modules_changed()
                         return False
                 mpstate.modules.remove((m, pm))
+                self.modules_changed()
                 if modname in mpstate.public_modules:
                     del mpstate.public_modules[modname]
                 print("Unloaded module %s" % modname)
@@ -426,6 +450,18 @@ class MPState(object):
         print("Unable to find module %s" % modname)
         return False
 
+    def loop_period(self):
+        '''return the expected time between main loop iterations'''
+        if self.settings.reactor:
+            return 1.0 / max(self.settings.idle_rate, 1)
+        return self.settings.select_timeout
+
+    def modules_changed(self):
+        '''rebuild anything which depends on the list of loaded modules'''
+        link = self.module('link')
+        if link is not None:
+            link.rebuild_dispatch_table()
+
     def master(self, target_sysid=-1):
         '''return the currently chosen mavlink master object'''
         if len(self.mav_master) == 0:
@@ -603,7 +639,7 @@ def get_exception_stacktrace(e):
 
 def cmd_module(args):
     '''module commands'''
-    usage = "usage: module <list|load|reload|unload>"
+    usage = "usage: module <list|load|reload|unload|stats>"
     if len(args) < 1:
         print(usage)
         return
@@ -654,6 +690,28 @@ def cmd_module(args):
             return
         modname = os.path.basename(args[1])
         mpstate.unload_module(modname)
+    elif args[0] == "stats":
+        cmd_module_stats(args[1:])
+    else:
+        print(usage)
+
+
+def cmd_module_stats(args):
+    '''show module timing statistics'''
+    usage = "usage: module stats <show|reset|json FILENAME>"
+    if len(args) == 0 or args[0] == "show":
+        if not mpstate.settings.modstats:
+            print("Module statistics are off, use 'set modstats 1'")
+        print(mpstate.module_stats.report())
+    elif args[0] == "reset":
+        mpstate.module_stats.reset()
+        mpstate.module_stats_warned = set()
+    elif args[0] == "json":
+        if len(args) < 2:
+            print(usage)
+            return
+        mpstate.module_stats.save_json(args[1])
+        print("Saved module statistics to %s" % args[1])
     else:
         print(usage)
 
@@ -848,7 +906,7 @@ def process_master(m):
         return
 
     if mpstate.logqueue_raw:
-        mpstate.logqueue_raw.put(bytearray(s))
+        mpstate.logqueue_raw.put(s)
 
     if mpstate.status.setup_mode:
         if mpstate.system == 'Windows':
@@ -863,6 +921,11 @@ def process_master(m):
 
     if m.first_byte and mavversion is None:
         m.auto_mavlink_version(s)
+    if mpstate.settings.fastfwd and getattr(getattr(m.mav, 'signing', None), 'secret_key', None) is None:
+        # frame and forward raw packets, decoding only what is needed.
+        # Signed links need the full parser to check signatures
+        mpstate.module('link').master_fastpath(m, s)
+        return
     msgs = m.mav.parse_buffer(s)
     if msgs:
         for msg in msgs:
@@ -910,7 +973,7 @@ def process_mavlink(slave):
                 mpstate.master(target_sysid).write(mbuf)
             if mpstate.logqueue:
                 usec = int(time.time() * 1.0e6)
-                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+                mpstate.logqueue.write_packet(usec, m.get_msgbuf())
             if mpstate.status.watch:
                 for msg_type in mpstate.status.watch:
                     if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
@@ -935,15 +998,12 @@ def mkdir_p(dir):
 def log_writer():
     '''log writing thread'''
     while not mpstate.status.exit:
-        mpstate.logfile_raw.write(bytearray(mpstate.logqueue_raw.get()))
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
+        mpstate.logqueue.event.wait(1.0)
+        for writer in mpstate.logqueue, mpstate.logqueue_raw:
+            writer.service(flush=mpstate.settings.flushlogs,
+                           rotate_size=mpstate.settings.log_rotate_size*1024*1024,
+                           rotate_time=mpstate.settings.log_rotate_time*60,
+                           compress=mpstate.settings.log_compress)
 
 
 # If state_basedir is NOT set then paths for logs and aircraft
@@ -996,8 +1056,8 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mode = 'wb'
 
     try:
-        mpstate.logfile = open(logpath_telem, mode=mode)
-        mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+        mpstate.logqueue.open(logpath_telem, mode=mode)
+        mpstate.logqueue_raw.open(logpath_telem_raw, mode=mode)
         print("Log Directory: %s" % mpstate.status.logdir)
         print("Telemetry log: %s" % logpath_telem)
 
@@ -1088,21 +1148,125 @@ def periodic_tasks():
 
     mpstate.status.update_bytecounters()
 
+    if mpstate.settings.modstats:
+        stats = mpstate.module_stats
+        budget = mpstate.loop_period()
+    else:
+        stats = None
+
     # call optional module idle tasks. These are called at several hundred Hz
     for (m, pm) in mpstate.modules:
         if hasattr(m, 'idle_task'):
+            if stats is not None:
+                t0 = time.perf_counter()
+            exception = False
             try:
                 m.idle_task()
             except Exception as msg:
+                exception = True
                 if mpstate.settings.moddebug == 1:
                     print(msg)
                 elif mpstate.settings.moddebug > 1:
                     print(get_exception_stacktrace(msg))
+            if stats is not None:
+                stats.record(m.name, 'idle_task', time.perf_counter() - t0, budget=budget, exception=exception)
 
         # also see if the module should be unloaded:
         if m.needs_unloading:
             mpstate.unload_module(m.name)
 
+    if stats is not None and modstats_check_period.trigger():
+        for modname in stats.slow_modules():
+            if modname not in mpstate.module_stats_warned:
+                mpstate.module_stats_warned.add(modname)
+                mpstate.console.writeln("module %s idle_task regularly takes longer than the loop period" % modname)
+
+
+def select_extra_handler(fd):
+    '''call the read function a module registered for fd'''
+    try:
+        (fn, args) = mpstate.select_extra[fd]
+        fn(args)
+    except Exception as msg:
+        if mpstate.settings.moddebug == 1:
+            print(msg)
+        # on an exception, remove it from the select list
+        mpstate.select_extra.pop(fd, None)
+
+
+def poll_serial_masters():
+    '''poll master links which have no file descriptor to select on'''
+    for master in mpstate.mav_master:
+        if master.fd is None:
+            try:
+                if master.port.inWaiting() > 0:
+                    process_master(master)
+            except serial.SerialException:
+                pass
+
+
+def fd_owner(m):
+    '''return the object behind the fd of a mavfile, which changes when a
+    link reconnects even if the fd number is reused'''
+    for name in ['port', 'listen', 'sock']:
+        obj = getattr(m, name, None)
+        try:
+            if obj is not None and obj.fileno() == m.fd:
+                return obj
+        except Exception:
+            pass
+    return m
+
+
+def reactor_sources():
+    '''return a dict of fd -> (handler, arg, owner) for the reactor to watch'''
+    sources = {}
+    for master in mpstate.mav_master:
+        if master.fd is not None and not master.portdead:
+            sources[master.fd] = (process_master, master, fd_owner(master))
+    for m in mpstate.mav_outputs:
+        sources[m.fd] = (process_mavlink, m, fd_owner(m))
+    for m in mpstate.sysid_outputs.values():
+        sources[m.fd] = (process_mavlink, m, fd_owner(m))
+    for fd in mpstate.select_extra:
+        # modules add a new entry each time they open a file, so the
+        # entry stands in for the file
+        sources[fd] = (select_extra_handler, fd, mpstate.select_extra[fd])
+    return sources
+
+
+def reactor_resync(args=None):
+    '''bring the reactor registrations up to date with links and outputs'''
+    global reactor_counts
+    reactor_counts = (len(mpstate.mav_master), len(mpstate.mav_outputs),
+                      len(mpstate.sysid_outputs), len(mpstate.select_extra))
+    mpstate.reactor.sync(reactor_sources())
+
+
+def reactor_idle_task(args=None):
+    '''timer driven periodic work for the reactor main loop'''
+    reactor_idle_timer.period = 1.0 / max(mpstate.settings.idle_rate, 1)
+    poll_serial_masters()
+    periodic_tasks()
+
+
+def reactor_step():
+    '''one iteration of the event driven main loop'''
+    global reactor_idle_timer
+    if mpstate.reactor is None:
+        mpstate.reactor = mp_reactor.MPReactor()
+        reactor_idle_timer = mpstate.reactor.add_timer(1.0 / max(mpstate.settings.idle_rate, 1), reactor_idle_task)
+        # links can reconnect with a new fd without changing the
+        # number of links, so also resync at a low rate
+        mpstate.reactor.add_timer(0.2, reactor_resync)
+        reactor_resync()
+    elif reactor_counts != (len(mpstate.mav_master), len(mpstate.mav_outputs),
+                            len(mpstate.sysid_outputs), len(mpstate.select_extra)):
+        reactor_resync()
+    # don't block for longer than the idle period so queued commands
+    # are still picked up promptly
+    mpstate.reactor.run_once(max_timeout=reactor_idle_timer.period)
+
 
 def main_loop():
     '''main processing loop'''
@@ -1143,13 +1307,15 @@ def main_loop():
             for c in cmds:
                 process_stdin(c)
 
-        for master in mpstate.mav_master:
-            if master.fd is None:
-                try:
-                    if master.port.inWaiting() > 0:
-                        process_master(master)
-                except serial.SerialException:
-                    pass
+        if mpstate.settings.reactor:
+            reactor_step()
+            continue
+        if mpstate.reactor is not None:
+            # reactor mode has been turned off
+            mpstate.reactor.close()
+            mpstate.reactor = None
+
+        poll_serial_masters()
 
         periodic_tasks()
 
@@ -1203,15 +1369,7 @@ def main_loop():
             # this allow modules to register their own file descriptors
             # for the main select loop
             if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+                select_extra_handler(fd)
 
 
 def input_loop():
@@ -1411,8 +1569,9 @@ if __name__ == '__main__':
     # queues for logging
 
     if not opts.no_state:
-        mpstate.logqueue = multiproc.Queue()
-        mpstate.logqueue_raw = multiproc.Queue()
+        # both writers wake the same log_writer thread
+        mpstate.logqueue = tlog_writer.TLogWriter()
+        mpstate.logqueue_raw = tlog_writer.TLogWriter(event=mpstate.logqueue.event)
     else:
         mpstate.logqueue = None
         mpstate.logqueue_raw = None
@@ -1519,6 +1678,7 @@ if __name__ == '__main__':
     msg_period = mavutil.periodic_event(1.0/15)
     heartbeat_period = mavutil.periodic_event(1)
     heartbeat_check_period = mavutil.periodic_event(0.33)
+    modstats_check_period = mavutil.periodic_event(0.1)
 
     mpstate.input_queue = multiproc.Queue()
     mpstate.input_count = 0
@@ -1619,4 +1779,8 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    if mpstate.logqueue:
+        mpstate.logqueue.close()
+        mpstate.logqueue_raw.close()
+
     sys.exit(1)
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+'''
+vectorised evaluation of graph expressions over log columns
+
+A graph expression such as "degrees(ATTITUDE.roll)" or
+"sqrt(IMU[0].AccX**2+IMU[0].AccY**2)" is compiled once into a code
+object where each MSG.field or MSG[instance].field reference is replaced
+by a NumPy array. Messages of different types are aligned with an as-of
+join: each point takes the most recent value of every referenced field,
+which is what evaluating the expression message by message against the
+latest messages gives.
+
+Functions in VECTOR_FUNCTIONS work on whole arrays. Other mavextra and
+math functions, including those taking a whole message such as
+gravity(RAW_IMU), are called once per point with a row view of the
+columns, which still avoids decoding messages and re-parsing the
+expression. Anything else raises UnsupportedExpression and the caller
+falls back to the per message path. That includes the functions in
+STATEFUL_FUNCTIONS, such as diff() and lowpass(): their state is keyed
+by name across all fields and advances with every message evaluated,
+which points sampled per expression can't reproduce.
+
+AP_FLAKE8_CLEAN
+'''
+
+import ast
+import bisect
+import math
+import re
+
+import numpy
+from pymavlink import mavextra
+
+re_msgtype = re.compile('^[A-Z][A-Z0-9_]*$')
+
+
+class UnsupportedExpression(Exception):
+    '''the expression can't be evaluated on columns'''
+    pass
+
+
+def wrap_180(angle):
+    return numpy.where(angle > 180, angle - 360.0, numpy.where(angle < -180, angle + 360.0, angle))
+
+
+def wrap_360(angle):
+    return numpy.where(angle > 360, angle - 360.0, numpy.where(angle < 0, angle + 360.0, angle))
+
+
+def logical_and(*args):
+    ret = args[0]
+    for a in args[1:]:
+        ret = numpy.logical_and(ret, a)
+    return ret
+
+
+def logical_or(*args):
+    ret = args[0]
+    for a in args[1:]:
+        ret = numpy.logical_or(ret, a)
+    return ret
+
+
+def vector_min(*args):
+    if len(args) == 1:
+        return numpy.min(args[0])
+    ret = args[0]
+    for a in args[1:]:
+        ret = numpy.minimum(ret, a)
+    return ret
+
+
+def vector_max(*args):
+    if len(args) == 1:
+        return numpy.max(args[0])
+    ret = args[0]
+    for a in args[1:]:
+        ret = numpy.maximum(ret, a)
+    return ret
+
+
+VECTOR_FUNCTIONS = {
+    'abs': numpy.abs,
+    'fabs': numpy.fabs,
+    'sqrt': numpy.sqrt,
+    'sin': numpy.sin,
+    'cos': numpy.cos,
+    'tan': numpy.tan,
+    'asin': numpy.arcsin,
+    'acos': numpy.arccos,
+    'atan': numpy.arctan,
+    'atan2': numpy.arctan2,
+    'hypot': numpy.hypot,
+    'exp': numpy.exp,
+    'log': numpy.log,
+    'log10': numpy.log10,
+    'pow': numpy.power,
+    'floor': numpy.floor,
+    'ceil': numpy.ceil,
+    'isnan': numpy.isnan,
+    'degrees': numpy.degrees,
+    'radians': numpy.radians,
+    'min': vector_min,
+    'max': vector_max,
+    'int': lambda v: numpy.trunc(v),
+    'float': lambda v: numpy.asarray(v, dtype=float),
+    'wrap_180': wrap_180,
+    'wrap_360': wrap_360,
+    '_and': logical_and,
+    '_or': logical_or,
+    '_not': numpy.logical_not,
+}
+
+# mavextra functions whose result depends on earlier calls
+STATEFUL_FUNCTIONS = frozenset([
+    'average', 'delta', 'delta_angle', 'diff', 'distance_gps2', 'distance_home',
+    'distance_home_df', 'distance_two', 'downsample', 'DCM_update', 'ekf1_pos',
+    'get_lat_lon_alt', 'integral', 'lowpass', 'lowpassHz', 'pitch_estimate',
+    'pitch_sim', 'PX4_update', 'roll_estimate', 'second_derivative_5',
+    'second_derivative_9', 'sim_body_rates', 'sum',
+])
+
+ROW_FUNCTIONS = {}
+for (name, fn) in list(vars(math).items()) + list(vars(mavextra).items()):
+    if callable(fn) and not name.startswith('_') and not isinstance(fn, type):
+        ROW_FUNCTIONS[name] = fn
+
+
+class RowMessage(object):
+    '''one row of a MessageRows, looking like a message to mavextra'''
+    __slots__ = ['_rows', '_i']
+
+    def __init__(self, rows, i):
+        self._rows = rows
+        self._i = i
+
+    def __getattr__(self, name):
+        try:
+            return self._rows.lists[name][self._i]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get_type(self):
+        return self._rows.mtype
+
+
+class MessageRows(object):
+    '''the columns of a whole message type, aligned to the sample points'''
+    def __init__(self, mtype, columns, idx):
+        self.mtype = mtype
+        self.lists = {}
+        for f in columns:
+            self.lists[f] = numpy.asarray(columns[f])[idx].tolist()
+        self.n = len(idx)
+
+    def __len__(self):
+        return self.n
+
+
+def row_call(fn, *args, **kwargs):
+    '''call a scalar function once per point, None results give NaN'''
+    n = None
+    for a in args:
+        if isinstance(a, (numpy.ndarray, MessageRows)):
+            n = len(a)
+            break
+    if n is None:
+        return fn(*args, **kwargs)
+    rows = []
+    for a in args:
+        if isinstance(a, MessageRows):
+            rows.append([RowMessage(a, i) for i in range(n)])
+        elif isinstance(a, numpy.ndarray):
+            rows.append(a.tolist())
+        else:
+            rows.append([a] * n)
+    out = numpy.empty(n)
+    for i in range(n):
+        v = fn(*[r[i] for r in rows], **kwargs)
+        out[i] = numpy.nan if v is None else float(v)
+    return out
+
+
+VECTOR_CONSTANTS = {
+    'pi': numpy.pi,
+    'e': numpy.e,
+    'True': True,
+    'False': False,
+}
+
+
+class FieldRewriter(ast.NodeTransformer):
+    '''replace field references with column variables and boolean
+    operators with element-wise calls'''
+    def __init__(self):
+        self.sources = []
+        self.row_functions = set()
+
+    def column(self, mtype, instance, field):
+        '''a field column, or a whole message if field is None'''
+        key = (mtype, instance, field)
+        if key not in self.sources:
+            self.sources.append(key)
+        return ast.Name(id='_c%u' % self.sources.index(key), ctx=ast.Load())
+
+    def instance(self, node):
+        '''return (mtype, instance) for MSG[instance], or None'''
+        if not isinstance(node.value, ast.Name) or not re_msgtype.match(node.value.id):
+            return None
+        s = node.slice
+        if hasattr(ast, 'Index') and isinstance(s, ast.Index):
+            s = s.value
+        if isinstance(s, ast.Constant):
+            return (node.value.id, str(s.value))
+        if isinstance(s, ast.Name):
+            return (node.value.id, s.id)
+        raise UnsupportedExpression('bad instance in %s' % node.value.id)
+
+    def visit_Attribute(self, node):
+        value = node.value
+        if isinstance(value, ast.Name) and re_msgtype.match(value.id):
+            return self.column(value.id, None, node.attr)
+        if isinstance(value, ast.Subscript):
+            inst = self.instance(value)
+            if inst is not None:
+                return self.column(inst[0], inst[1], node.attr)
+        raise UnsupportedExpression('unsupported attribute %s' % node.attr)
+
+    def visit_Subscript(self, node):
+        inst = self.instance(node)
+        if inst is None:
+            raise UnsupportedExpression('unsupported subscript')
+        return self.column(inst[0], inst[1], None)
+
+    def visit_Name(self, node):
+        if node.id in VECTOR_CONSTANTS or node.id in VECTOR_FUNCTIONS:
+            return node
+        if re_msgtype.match(node.id):
+            return self.column(node.id, None, None)
+        raise UnsupportedExpression('unsupported name %s' % node.id)
+
+    def call(self, name, args):
+        return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[])
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name):
+            raise UnsupportedExpression('unsupported function call')
+        args = [self.visit(a) for a in node.args]
+        keywords = [ast.keyword(arg=k.arg, value=self.visit(k.value)) for k in node.keywords]
+        name = node.func.id
+        if name in STATEFUL_FUNCTIONS:
+            raise UnsupportedExpression('%s keeps state between messages' % name)
+        if name in VECTOR_FUNCTIONS and not keywords:
+            node.args = args
+            return node
+        if name in ROW_FUNCTIONS:
+            self.row_functions.add(name)
+            return ast.Call(func=ast.Name(id='_row_call', ctx=ast.Load()),
+                            args=[ast.Name(id='_f_' + name, ctx=ast.Load())] + args,
+                            keywords=keywords)
+        raise UnsupportedExpression('unsupported function %s' % name)
+
+    def visit_BoolOp(self, node):
+        name = '_and' if isinstance(node.op, ast.And) else '_or'
+        return self.call(name, [self.visit(v) for v in node.values])
+
+    def visit_UnaryOp(self, node):
+        if isinstance(node.op, ast.Not):
+            return self.call('_not', [self.visit(node.operand)])
+        return self.generic_visit(node)
+
+    def visit_Compare(self, node):
+        if len(node.ops) == 1:
+            return self.generic_visit(node)
+        # a < b < c becomes _and(a < b, b < c)
+        operands = [self.visit(node.left)] + [self.visit(c) for c in node.comparators]
+        pairs = []
+        for i in range(len(node.ops)):
+            pairs.append(ast.Compare(left=operands[i], ops=[node.ops[i]], comparators=[operands[i+1]]))
+        return self.call('_and', pairs)
+
+    def generic_visit(self, node):
+        allowed = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Constant,
+                   ast.operator, ast.unaryop, ast.cmpop, ast.expr_context)
+        if not isinstance(node, allowed):
+            raise UnsupportedExpression('unsupported syntax %s' % type(node).__name__)
+        return super(FieldRewriter, self).generic_visit(node)
+
+
+class ColumnExpression(object):
+    '''a graph expression compiled for evaluation on field columns'''
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as ex:
+            raise UnsupportedExpression(str(ex))
+        rewriter = FieldRewriter()
+        tree = ast.fix_missing_locations(rewriter.visit(tree))
+        if len(rewriter.sources) == 0:
+            raise UnsupportedExpression('no fields in %s' % expression)
+        self.sources = rewriter.sources
+        self.code = compile(tree, '<%s>' % expression, 'eval')
+        self.env = dict(VECTOR_FUNCTIONS)
+        self.env.update(VECTOR_CONSTANTS)
+        self.env['_row_call'] = row_call
+        for name in rewriter.row_functions:
+            self.env['_f_' + name] = ROW_FUNCTIONS[name]
+
+    def message_sources(self):
+        '''return the list of (mtype, instance) this expression reads'''
+        ret = []
+        for (mtype, instance, field) in self.sources:
+            if (mtype, instance) not in ret:
+                ret.append((mtype, instance))
+        return ret
+
+    def evaluate(self, columns):
+        '''evaluate with columns, a list of arrays matching self.sources'''
+        env = dict(self.env)
+        for i in range(len(columns)):
+            env['_c%u' % i] = columns[i]
+        with numpy.errstate(all='ignore'):
+            return eval(self.code, {'__builtins__': {}}, env)
+
+
+def source_columns(columns, mtype, instance, fields):
+    '''return the columns dict for one message source, None if missing'''
+    if not columns.has(mtype):
+        return None
+    for f in fields or []:
+        if not columns.has(mtype, f):
+            return None
+    try:
+        return columns.columns(mtype, fields, instance=instance)
+    except KeyError:
+        return None
+
+
+def asof_join(times, source_times):
+    '''return (index, valid) arrays giving the most recent row of a
+    source at each of times'''
+    idx = numpy.searchsorted(source_times, times, side='right') - 1
+    valid = idx >= 0
+    return (numpy.maximum(idx, 0), valid)
+
+
+def sample_columns(expr, columns, times, order=None, source_data=None):
+    '''evaluate a ColumnExpression at times using the most recent value
+    of each field. If order gives the position in the log of each sample
+    the join is done on log position rather than timestamp, matching
+    message by message evaluation when timestamps are not monotonic.
+    Returns (values, valid) or None if a field is missing'''
+    msources = expr.message_sources()
+    if source_data is None:
+        source_data = load_sources(expr, columns)
+        if source_data is None:
+            return None
+    valid = numpy.ones(len(times), dtype=bool)
+    if order is not None and all('_index' in d for d in source_data):
+        joins = [asof_join(order, d['_index']) for d in source_data]
+    else:
+        joins = [asof_join(times, d['_timestamp']) for d in source_data]
+    args = []
+    for (mtype, instance, field) in expr.sources:
+        si = msources.index((mtype, instance))
+        (idx, ok) = joins[si]
+        valid &= ok
+        if field is None:
+            args.append(MessageRows(mtype, source_data[si], idx))
+            continue
+        col = numpy.asarray(source_data[si][field])
+        if col.dtype.kind in 'iubf':
+            # match the double precision of per message evaluation
+            col = col.astype(float)
+        if len(col) == 0:
+            col = numpy.zeros(1)
+        args.append(col[idx])
+    values = numpy.broadcast_to(expr.evaluate(args), times.shape)
+    return (values, valid)
+
+
+def load_sources(expr, columns):
+    '''return the columns for each message source of expr, None if missing'''
+    ret = []
+    for (mtype, instance) in expr.message_sources():
+        fields = [f for (m, i, f) in expr.sources if m == mtype and i == instance]
+        if None in fields:
+            # whole message wanted
+            fields = None
+        c = source_columns(columns, mtype, instance, fields)
+        if c is None:
+            return None
+        ret.append(c)
+    return ret
+
+
+def sample_points(expr, columns):
+    '''return the points at which a graph of expr is sampled: one for
+    each message of any of its message sources. Returns (times, order,
+    source, source_data) where order is the log position of each point
+    (None if the store doesn't have it) and source is the index of the
+    triggering message source, or None if a field is not available'''
+    source_data = load_sources(expr, columns)
+    if source_data is None:
+        return None
+    times = numpy.concatenate([numpy.asarray(d['_timestamp'], dtype=float) for d in source_data])
+    source = numpy.concatenate([numpy.full(len(source_data[i]['_timestamp']), i) for i in range(len(source_data))])
+    if all('_index' in d for d in source_data):
+        order = numpy.concatenate([numpy.asarray(d['_index']) for d in source_data])
+        sort = numpy.argsort(order, kind='stable')
+        order = order[sort]
+    else:
+        order = None
+        sort = numpy.argsort(times, kind='stable')
+    return (times[sort], order, source[sort], source_data)
+
+
+def rate_mask(times, source, rate_hz):
+    '''keep points from each source at least 1/rate_hz seconds apart, as
+    set_max_message_rate does message by message. This walks the kept
+    points with a binary search so costs O(kept * log(n))'''
+    keep = numpy.ones(len(times), dtype=bool)
+    if rate_hz <= 0 or len(times) == 0:
+        return keep
+    period = 1.0 / rate_hz
+    keep[:] = False
+    for s in numpy.unique(source):
+        sel = numpy.nonzero(source == s)[0]
+        t = times[sel].tolist()
+        n = len(t)
+        i = 0
+        while i < n:
+            keep[sel[i]] = True
+            # first point with t[j] - t[i] >= period, checked the same
+            # way as the per message path to get identical rounding
+            j = max(i + 1, bisect.bisect_left(t, t[i] + period))
+            while j > i + 1 and t[j-1] - t[i] >= period:
+                j -= 1
+            while j < n and t[j] - t[i] < period:
+                j += 1
+            i = j
+    return keep
+
+
+def flightmode_mask(times, flightmode_list, selections):
+    '''mask of times inside the selected flight modes'''
+    if not any(selections) or not flightmode_list:
+        return numpy.ones(len(times), dtype=bool)
+    ends = numpy.array([fm[2] for fm in flightmode_list])
+    selected = list(selections)[:len(ends)+1]
+    selected += [False] * (len(ends)+1-len(selected))
+    return numpy.array(selected)[numpy.searchsorted(ends, times, side='right')]
+
+
+if __name__ == "__main__":
+    # benchmark per message and columnar evaluation of the built-in graphs
+    import os
+    import time
+    import xml.etree.ElementTree as ET
+    from argparse import ArgumentParser
+    from pymavlink import mavutil
+    from MAVProxy.modules.lib import grapher
+    from MAVProxy.modules.lib.log_cache import LogCache
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("log", metavar="LOG")
+    default_graphs = os.path.join(os.path.dirname(__file__), '..', '..', 'tools', 'graphs', 'mavgraphs.xml')
+    parser.add_argument("--graphs", default=default_graphs, help="graph definitions to run")
+    parser.add_argument("--no-cache", action='store_true', help="collect columns with a scan instead of the log cache")
+    args = parser.parse_args()
+
+    mlog = mavutil.mavlink_connection(args.log, notimestamps=False, zero_time_base=False)
+    cache = None
+    if not args.no_cache:
+        cache = LogCache(args.log)
+        cache.load(mlog)
+    present = set(LogCache(args.log).types() if cache is None else cache.types())
+    if cache is None:
+        while True:
+            m = mlog.recv_match()
+            if m is None:
+                break
+            present.add(m.get_type())
+        mlog.rewind()
+
+    re_caps = re.compile('[A-Z_][A-Z0-9_]+')
+    total = [0.0, 0.0]
+    count = 0
+    for g in ET.parse(args.graphs).getroot().findall('graph'):
+        for e in g.findall('expression'):
+            if e.text is None:
+                continue
+            fields = e.text.split()
+            types = set(re_caps.findall(' '.join(fields)))
+            if not types.issubset(present):
+                continue
+            dt = []
+            ys = []
+            for columnar in [False, True]:
+                mg = grapher.MavGraph()
+                mg.set_columnar(columnar)
+                mg.add_mav(mlog, log_cache=cache)
+                for f in fields:
+                    mg.add_field(f)
+                t0 = time.time()
+                mg.process([], [])
+                dt.append(time.time() - t0)
+                ys.append(mg.y)
+                mlog.rewind()
+            match = all(len(a) == len(b) and numpy.allclose(a, b, equal_nan=True) for (a, b) in zip(ys[0], ys[1]))
+            print("%-40s %7.3fs %7.3fs %6.1fx %s" % (
+                g.get('name')[:40], dt[0], dt[1], dt[0]/max(dt[1], 1.0e-6), "" if match else "MISMATCH"))
+            total[0] += dt[0]
+            total[1] += dt[1]
+            count += 1
+            break
+    if count > 0:
+        print("%u graphs: per message %.2fs columnar %.2fs speedup %.1fx" % (
+            count, total[0], total[1], total[0]/max(total[1], 1.0e-6)))
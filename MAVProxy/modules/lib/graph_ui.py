@@ -1,5 +1,6 @@
 from MAVProxy.modules.lib import grapher
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import multiproc_util
 
 import errno
 import socket
@@ -31,6 +32,10 @@ class Graph_UI(object):
             self.mg.set_title(self.mestate.settings.title)
         else:
             self.mg.set_title(graphdef.name)
+        self.mg.set_columnar(getattr(self.mestate.settings, 'columnar', True))
+        graph_workers = getattr(self.mestate.settings, 'graph_workers', 0)
+        if graph_workers > 0:
+            self.mg.set_log_pool(multiproc_util.shared_log_pool(graph_workers))
         if self.mestate.settings.max_rate > 0:
             self.mg.set_max_message_rate(self.mestate.settings.max_rate)
         self.mg.set_marker(self.mestate.settings.marker)
@@ -39,7 +44,7 @@ class Graph_UI(object):
         self.mg.set_linestyle(self.mestate.settings.linestyle)
         self.mg.set_show_flightmode(self.mestate.settings.show_flightmode)
         self.mg.set_legend(self.mestate.settings.legend)
-        self.mg.add_mav(copy.copy(self.mestate.mlog))
+        self.mg.add_mav(copy.copy(self.mestate.mlog), log_cache=getattr(self.mestate, 'log_cache', None))
         for f in graphdef.expression.split():
             self.mg.add_field(f)
         self.mg.process(self.mestate.flightmode_selections, self.mestate.mlog._flightmodes)
@@ -48,6 +53,9 @@ class Graph_UI(object):
         #To avoid slowdowns in Windows (which copies the vars to the new process)
         #We need to empty this var when we're finished with it
         self.mg.mav_list = []
+        #The worker pool holds process handles that can't be pickled for
+        #the child, and the child has no use for it
+        self.mg.log_pool = None
         child = multiproc.Process(target=self.mg.show, args=[self.lenmavlist,], kwargs={"xlim_pipe" : self.xlim_pipe})
         child.start()
         self.xlim_pipe[1].close()
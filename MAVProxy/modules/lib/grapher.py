@@ -20,6 +20,8 @@ import matplotlib.pyplot as plt
 from pymavlink import mavutil
 import threading
 import numpy as np
+from MAVProxy.modules.lib import column_expr
+from MAVProxy.modules.lib.log_cache import MessageColumns
 
 MAVGRAPH_DEBUG = 'MAVGRAPH_DEBUG' in os.environ
 
@@ -67,6 +69,18 @@ def timestamp_to_days(timestamp, timeshift=0):
     sec_to_days = 1.0 / (60*60*24)
     return tday_base + (timestamp - tday_basetime) * sec_to_days
 
+def field_expression(field):
+    '''return a graph field without its <label> and :N axis suffixes'''
+    if field.endswith(">"):
+        a2 = field.rfind("<")
+        if a2 != -1:
+            field = field[:a2]
+    if field.endswith(":2"):
+        field = field[:-2]
+    if field.endswith(":1"):
+        field = field[:-2]
+    return field
+
 class MilliFormatter(matplotlib.dates.AutoDateFormatter):
     '''tick formatter that shows millisecond resolution'''
     def __init__(self, locator):
@@ -86,6 +100,7 @@ class MavGraph(object):
         self.lowest_x = None
         self.highest_x = None
         self.mav_list = []
+        self.cache_list = []
         self.fields = []
         self.condition = None
         self.xaxis = None
@@ -125,6 +140,16 @@ class MavGraph(object):
         else:
             self.text_types = frozenset([unicode, str])
         self.max_message_rate = 0
+        self.columnar = True
+        self.log_pool = None
+
+    def set_columnar(self, enable):
+        '''enable vectorised evaluation of graph expressions'''
+        self.columnar = enable
+
+    def set_log_pool(self, pool):
+        '''extract columns for logs without a cache with a LogWorkerPool'''
+        self.log_pool = pool
 
     def set_max_message_rate(self, rate_hz):
         '''set maximum rate we will graph any message'''
@@ -135,9 +160,10 @@ class MavGraph(object):
         '''add another field to plot'''
         self.fields.append(field)
 
-    def add_mav(self, mav):
-        '''add another data source to plot'''
+    def add_mav(self, mav, log_cache=None):
+        '''add another data source to plot, with an optional columnar log cache'''
         self.mav_list.append(mav)
+        self.cache_list.append(log_cache)
 
     def set_condition(self, condition):
         '''set graph condition'''
@@ -494,7 +520,119 @@ class MavGraph(object):
             self.y[i].append(v)
             self.x[i].append(xv)
 
-    def process_mav(self, mlog, flightmode_selections):
+    def compile_columns(self):
+        '''compile the fields, condition and xaxis for columnar evaluation.
+        Returns None if any of them needs the per message path'''
+        try:
+            exprs = [column_expr.ColumnExpression(field_expression(f)) for f in self.fields]
+            condition = None
+            xaxis = None
+            if self.condition:
+                condition = column_expr.ColumnExpression(self.condition)
+            if self.xaxis is not None:
+                xaxis = column_expr.ColumnExpression(self.xaxis)
+        except column_expr.UnsupportedExpression as ex:
+            if MAVGRAPH_DEBUG:
+                print(ex)
+            return None
+        if condition is not None:
+            # the per message path only sees the message types of the
+            # fields, so a condition on any other type never has its
+            # messages; leave that to the per message path
+            for (mtype, instance, field) in condition.sources:
+                if mtype not in self.msg_types:
+                    return None
+        return (exprs, condition, xaxis)
+
+    def columns_wanted(self, compiled):
+        '''return the dict of message type to field names (None for all
+        fields) needed by compiled expressions'''
+        (exprs, condition, xaxis) = compiled
+        wanted = {}
+        for e in exprs + [condition, xaxis]:
+            if e is None:
+                continue
+            for (mtype, instance, field) in e.sources:
+                if field is None:
+                    wanted[mtype] = None
+                elif wanted.get(mtype, set()) is not None:
+                    wanted.setdefault(mtype, set()).add(field)
+        return wanted
+
+    def process_columns(self, mlog, log_cache, flightmode_selections):
+        '''evaluate all fields as NumPy operations on whole columns, from
+        the log cache if there is one or from a single scan collecting
+        only the fields used. Returns False if the graph needs the per
+        message path'''
+        if not self.columnar:
+            return False
+        compiled = self.compile_columns()
+        if compiled is None:
+            return False
+        (exprs, condition, xaxis) = compiled
+        others = [e for e in [condition, xaxis] if e is not None]
+        columns = log_cache
+        if columns is None or not columns.ready():
+            columns = MessageColumns(mlog, self.columns_wanted(compiled))
+        for e in exprs + others:
+            for (mtype, instance, field) in e.sources:
+                if field is not None and columns.dropped(mtype, field):
+                    # not stored as a column, let the per message path try
+                    return False
+
+        results = []
+        try:
+            for expr in exprs:
+                points = column_expr.sample_points(expr, columns)
+                if points is None:
+                    results.append(None)
+                    continue
+                (t, order, source, source_data) = points
+                # masks are applied before evaluating so row functions
+                # are only called for the points that are kept
+                keep = column_expr.flightmode_mask(t, self.flightmode_list, flightmode_selections)
+                if condition is not None:
+                    c = column_expr.sample_columns(condition, columns, t, order)
+                    if c is None:
+                        keep[:] = False
+                    else:
+                        keep &= c[1] & c[0].astype(bool)
+                if self.max_message_rate > 0:
+                    idx = np.nonzero(keep)[0]
+                    keep[idx] = column_expr.rate_mask(t[idx], source[idx], self.max_message_rate)
+                t = t[keep]
+                if order is not None:
+                    order = order[keep]
+                (v, valid) = column_expr.sample_columns(expr, columns, t, order, source_data)
+                xv = None
+                if xaxis is not None:
+                    x = column_expr.sample_columns(xaxis, columns, t, order)
+                    if x is None:
+                        valid[:] = False
+                    else:
+                        valid &= x[1]
+                        xv = x[0][valid]
+                results.append((t[valid], v[valid], xv))
+        except Exception as ex:
+            if MAVGRAPH_DEBUG:
+                print(ex)
+            return False
+
+        for i in range(self.num_fields):
+            if results[i] is None or len(results[i][0]) == 0:
+                continue
+            (t, v, xv) = results[i]
+            if xv is None:
+                timestamp_to_days(t[0], self.timeshift)
+                if tday_base is None:
+                    xv = np.zeros(len(t))
+                else:
+                    xv = tday_base + (t - tday_basetime) * (1.0 / (60*60*24))
+            self.x[i].extend(xv.tolist())
+            self.y[i].extend(v.tolist())
+        return True
+
+    def process_mav(self, mlog, flightmode_selections, log_cache=None):
         '''process one file'''
         self.vars = {}
         idx = 0
@@ -543,6 +681,9 @@ class MavGraph(object):
         except Exception:
             pass
 
+        if self.process_columns(mlog, log_cache, flightmode_selections):
+            return
+
         all_messages = {}
 
         while True:
@@ -625,9 +766,28 @@ class MavGraph(object):
 
         timeshift = self.timeshift
 
+        # start extracting columns for all logs at once, so comparing
+        # several logs runs them in parallel on the worker pool
+        jobs = {}
+        compiled = None
+        if self.log_pool is not None and self.columnar:
+            compiled = self.compile_columns()
+        if compiled is not None:
+            wanted = self.columns_wanted(compiled)
+            for fi in range(0, len(self.mav_list)):
+                log_cache = self.cache_list[fi] if fi < len(self.cache_list) else None
+                if log_cache is None or not log_cache.ready():
+                    try:
+                        jobs[fi] = self.log_pool.submit(self.mav_list[fi], wanted)
+                    except Exception as ex:
+                        print("Log pool failed: %s" % ex)
+
         for fi in range(0, len(self.mav_list)):
             mlog = self.mav_list[fi]
-            self.process_mav(mlog, flightmode_selections)
+            log_cache = self.cache_list[fi] if fi < len(self.cache_list) else None
+            if fi in jobs:
+                log_cache = self.log_pool.result(jobs[fi])
+            self.process_mav(mlog, flightmode_selections, log_cache)
 
 
     def show(self, lenmavlist, block=True, xlim_pipe=None, output=None):
@@ -9,6 +9,7 @@
 """
 
 import platform
+import time
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
@@ -18,7 +19,9 @@ class LiveGraph():
     All of the GUI work is done in a child process to provide some insulation
     from the parent mavproxy instance and prevent instability in the GCS
 
-    New data is sent to the LiveGraph instance via a pipe
+    New data is sent to the LiveGraph instance via a pipe. The child
+    samples the latest values once per tick, so values are batched in
+    the parent and sent at most once per tickresolution
     '''
     def __init__(self,
                  fields,
@@ -35,6 +38,8 @@ class LiveGraph():
         self.timespan = timespan
         self.tickresolution = tickresolution
         self.values = [None]*len(self.fields)
+        self.pending = None
+        self.last_send = 0
         self.parent_pipe,self.child_pipe = multiproc.Pipe()
         self.close_graph = multiproc.Event()
         self.close_graph.clear()
@@ -61,6 +66,19 @@ class LiveGraph():
         
     def add_values(self, values):
         '''add some data to the graph'''
+        self.pending = values[:]
+        self.flush()
+
+    def flush(self, force=False):
+        '''send the latest values if a tick has passed since the last send'''
+        if self.pending is None:
+            return
+        now = time.time()
+        if not force and now - self.last_send < self.tickresolution*0.5:
+            return
+        self.last_send = now
+        values = self.pending
+        self.pending = None
         if self.child.is_alive():
             self.parent_pipe.send(values)
 
@@ -78,7 +96,7 @@ class LiveGraph():
 if __name__ == "__main__":
     multiproc.freeze_support()
     # test the graph
-    import time, math
+    import math
     import live_graph
     livegraph = live_graph.LiveGraph(['sin(t)', 'cos(t)', 'sin(t+1)',
                                       'cos(t+1)', 'sin(t+2)', 'cos(t+2)',
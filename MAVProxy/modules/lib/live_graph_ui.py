@@ -3,6 +3,50 @@ from MAVProxy.modules.lib import icon
 import time
 import numpy, pylab
 
+class RingSeries(object):
+    '''fixed size ring buffer of samples for one series, keeping the
+    min and max of the samples it holds'''
+    def __init__(self, size):
+        self.buf = numpy.zeros(size)
+        self.size = size
+        self.head = 0
+        self.count = 0
+        self.vmin = None
+        self.vmax = None
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        self.vmin = None
+        self.vmax = None
+
+    def append(self, v):
+        evicted = None
+        if self.count == self.size:
+            evicted = self.buf[self.head]
+        else:
+            self.count += 1
+        self.buf[self.head] = v
+        self.head = (self.head + 1) % self.size
+        if self.vmin is None or v < self.vmin:
+            self.vmin = v
+        if self.vmax is None or v > self.vmax:
+            self.vmax = v
+        if evicted is not None and (evicted <= self.vmin or evicted >= self.vmax):
+            # the old extreme has dropped out of the window
+            valid = self.buf[:self.count]
+            self.vmin = valid.min()
+            self.vmax = valid.max()
+
+    def values(self):
+        '''samples oldest first'''
+        if self.count < self.size:
+            return self.buf[:self.count]
+        return numpy.concatenate((self.buf[self.head:], self.buf[:self.head]))
+
 class GraphFrame(wx.Frame):
     """ The main frame of the application
     """
@@ -14,9 +58,11 @@ class GraphFrame(wx.Frame):
         except Exception:
             pass
         self.state = state
+        # one sample per series per tick over the timespan
+        self.xdata = numpy.arange(-self.state.timespan, 0, self.state.tickresolution)
         self.data = []
         for i in range(len(state.fields)):
-            self.data.append([])
+            self.data.append(RingSeries(len(self.xdata)))
         self.paused = False
         self.clear_data = False
 
@@ -29,6 +75,8 @@ class GraphFrame(wx.Frame):
         self.redraw_timer.Start(int(1000*self.state.tickresolution))
 
         self.last_yrange = (None, None)
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw_event)
 
     def create_main_panel(self):
         import platform
@@ -89,10 +137,7 @@ class GraphFrame(wx.Frame):
         # to the plotted line series
         #
         self.plot_data = []
-        if len(self.data[0]) == 0:
-            max_y = min_y = 0
-        else:
-            max_y = min_y = self.data[0][0]
+        max_y = min_y = 0
         num_labels = 0 if not self.state.labels else len(self.state.labels)
         labels = []
         for i in range(len(self.data)):
@@ -101,19 +146,16 @@ class GraphFrame(wx.Frame):
             else:
                 label = self.state.fields[i]
             labels.append(label)
+            # lines are animated so they can be blitted over a saved background
             p = self.axes.plot(
-                self.data[i],
+                [],
                 linewidth=1,
                 color=self.state.colors[i],
-                label=label
+                label=label,
+                animated=True
                 )[0]
             self.plot_data.append(p)
-            if len(self.data[i]) != 0:
-                min_y = min(min_y, min(self.data[i]))
-                max_y = max(max_y, max(self.data[i]))
 
-        # create X data
-        self.xdata = numpy.arange(-self.state.timespan, 0, self.state.tickresolution)
         self.axes.set_xbound(lower=self.xdata[0], upper=0)
         if min_y == max_y:
             self.axes.set_ybound(min_y, max_y+0.1)
@@ -122,48 +164,59 @@ class GraphFrame(wx.Frame):
     def draw_plot(self):
         """ Redraws the plot
         """
-        state = self.state
-
         if len(self.data[0]) == 0:
             print("no data to plot")
             return
-        vhigh = max(self.data[0])
-        vlow  = min(self.data[0])
-
-        for i in range(1,len(self.plot_data)):
-            vhigh = max(vhigh, max(self.data[i]))
-            vlow  = min(vlow,  min(self.data[i]))
-        ymin = vlow  - 0.05*(vhigh-vlow)
-        ymax = vhigh + 0.05*(vhigh-vlow)
-
-        if ymin == ymax:
-            ymax = ymin + 0.1 * ymin
-            ymin = ymin - 0.1 * ymin
-
-        if (ymin, ymax) != self.last_yrange:
-            self.last_yrange = (ymin, ymax)
-
+        vhigh = max([d.vmax for d in self.data])
+        vlow = min([d.vmin for d in self.data])
+
+        (ymin, ymax) = self.last_yrange
+        # a constant series has no span to shrink to, it keeps the padded
+        # range it was given rather than redrawing on every tick
+        shrink = ymin is not None and 0 < (vhigh-vlow) < 0.5*(ymax-ymin)
+        if ymin is None or vlow < ymin or vhigh > ymax or shrink:
+            # rescale with some headroom so the axes and the saved
+            # background only change when the data moves well away
+            ymin = vlow - 0.1*(vhigh-vlow)
+            ymax = vhigh + 0.1*(vhigh-vlow)
+            if ymin == ymax:
+                ymax = ymin + 0.1 * abs(ymin)
+                ymin = ymin - 0.1 * abs(ymin)
             if ymax == ymin:
                 ymin = ymin-0.5
                 ymax = ymin+1
+            self.last_yrange = (ymin, ymax)
 
             self.axes.set_ybound(lower=ymin, upper=ymax)
             #self.axes.ticklabel_format(useOffset=False, style='plain')
             self.axes.grid(True, color='gray')
             pylab.setp(self.axes.get_xticklabels(), visible=True)
             pylab.setp(self.axes.get_legend().get_texts(), fontsize='small')
+            self.background = None
 
         for i in range(len(self.plot_data)):
-            ydata = numpy.array(self.data[i])
-            xdata = self.xdata
-            if len(ydata) < len(self.xdata):
-                xdata = xdata[-len(ydata):]
-            self.plot_data[i].set_xdata(xdata)
-            self.plot_data[i].set_ydata(ydata)
-
-        self.canvas.draw()
+            ydata = self.data[i].values()
+            self.plot_data[i].set_data(self.xdata[-len(ydata):], ydata)
+
+        if self.background is None:
+            # full redraw, on_draw_event saves the new background
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_lines()
+            self.canvas.blit(self.axes.bbox)
         self.canvas.Refresh()
 
+    def draw_lines(self):
+        for p in self.plot_data:
+            self.axes.draw_artist(p)
+
+    def on_draw_event(self, event):
+        '''a full draw happened, from us or a resize; save the background
+        and put the animated lines back on top'''
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.draw_lines()
+
     def on_pause_button(self, event):
         self.paused = not self.paused
 
@@ -202,8 +255,7 @@ class GraphFrame(wx.Frame):
             self.clear_data = False
             for i in range(len(self.plot_data)):
                 if state.values[i] is not None:
-                    while len(self.data[i]):
-                        self.data[i].pop(0)
+                    self.data[i].clear()
 
         for i in range(len(self.plot_data)):
             if (type(state.values[i]) == list):
@@ -213,8 +265,6 @@ class GraphFrame(wx.Frame):
                 return
             if state.values[i] is not None:
                 self.data[i].append(state.values[i])
-                while len(self.data[i]) > len(self.xdata):
-                    self.data[i].pop(0)
 
         for i in range(len(self.plot_data)):
             if state.values[i] is None or len(self.data[i]) < 2:
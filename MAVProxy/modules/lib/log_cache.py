@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+'''
+columnar sidecar cache for logs opened in MAVExplorer
+
+The first load of a log does one full pass over it and writes a
+directory next to the log (LOGNAME.cache) holding one .npy file per
+field of each message type, plus _timestamp and _index columns, the
+latter being the position of each message in the log. Later commands
+and later sessions memory-map only the columns they ask for instead of
+re-scanning the log with recv_match().
+
+Columns are written incrementally: each message type buffers a small
+number of rows which are converted to typed arrays and appended to a
+spill file, so building the cache of a large log needs memory for the
+buffers only.
+
+The cache is keyed on the log size, mtime and a hash of the first and
+last MiB of the file; a stale cache is rebuilt. If the directory next
+to the log is not writable the cache goes under ~/.mavproxy/logcache.
+
+AP_FLAKE8_CLEAN
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy
+
+from MAVProxy.modules.lib import mp_util
+
+CACHE_VERSION = 4
+HASH_BYTES = 1 << 20
+# rows of each message type buffered before being written out
+CHUNK_ROWS = 1024
+
+
+def log_signature(filename):
+    '''return a dict identifying the current contents of a log file'''
+    st = os.stat(filename)
+    h = hashlib.sha1()
+    h.update(str(st.st_size).encode())
+    with open(filename, 'rb') as f:
+        h.update(f.read(HASH_BYTES))
+        if st.st_size > HASH_BYTES:
+            f.seek(max(HASH_BYTES, st.st_size - HASH_BYTES))
+            h.update(f.read(HASH_BYTES))
+    return {
+        'version': CACHE_VERSION,
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'hash': h.hexdigest(),
+    }
+
+
+def column_array(values):
+    '''convert a list of field values to an array, None if they can't be stored'''
+    try:
+        a = numpy.asarray(values)
+    except Exception:
+        return None
+    if a.ndim != 1:
+        # array fields like BATTERY_STATUS.voltages are left to the per
+        # message path
+        return None
+    if a.dtype.kind in 'iufbU':
+        return a
+    if a.dtype.kind == 'S':
+        return numpy.char.decode(a, 'utf-8', 'replace')
+    return None
+
+
+class ColumnSpill(object):
+    '''columns written in typed chunks to one spill file, then assembled
+    into one .npy file per column'''
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'w+b')
+        # (mtype, field) -> list of (offset, count, dtype), or None once
+        # the column has values that can't be stored
+        self.chunks = {}
+
+    def append(self, mtype, field, values):
+        key = (mtype, field)
+        chunks = self.chunks.get(key, [])
+        if chunks is None:
+            return
+        a = column_array(values)
+        if a is None:
+            self.chunks[key] = None
+            return
+        chunks.append((self.f.tell(), len(a), a.dtype))
+        self.f.write(a.tobytes())
+        self.chunks[key] = chunks
+
+    def write_npy(self, mtype, field, filename):
+        '''write one column as an .npy file, returning False if its
+        chunks have no common type'''
+        chunks = self.chunks.get((mtype, field), None)
+        if chunks is None:
+            return False
+        try:
+            dtype = numpy.result_type(*[c[2] for c in chunks])
+        except TypeError:
+            return False
+        if dtype.kind not in 'iufbU':
+            return False
+        count = sum([c[1] for c in chunks])
+        with open(filename, 'wb') as out:
+            numpy.lib.format.write_array_header_1_0(out, {
+                'descr': numpy.lib.format.dtype_to_descr(dtype),
+                'fortran_order': False,
+                'shape': (count,)})
+            for (offset, n, cdtype) in chunks:
+                self.f.seek(offset)
+                a = numpy.frombuffer(self.f.read(n * cdtype.itemsize), dtype=cdtype)
+                out.write(a.astype(dtype, copy=False).tobytes())
+        return True
+
+    def close(self):
+        self.f.close()
+        os.unlink(self.path)
+
+
+class LogCache(object):
+    '''columnar cache of one log file'''
+    def __init__(self, filename, cache_dir=None):
+        self.filename = filename
+        if cache_dir is None:
+            cache_dir = filename + '.cache'
+            if not os.access(os.path.dirname(os.path.abspath(filename)), os.W_OK):
+                digest = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+                cache_dir = mp_util.dot_mavproxy(os.path.join('logcache', digest))
+        self.cache_dir = cache_dir
+        self.index = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # sent to graph processes; columns are re-mapped on demand there
+        return {'filename': self.filename, 'cache_dir': self.cache_dir, 'index': self.index}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def index_path(self):
+        return os.path.join(self.cache_dir, 'index.json')
+
+    def valid(self):
+        '''return True if the cache on disk matches the log'''
+        try:
+            with open(self.index_path()) as f:
+                index = json.load(f)
+            sig = log_signature(self.filename)
+        except Exception:
+            return False
+        if index.get('signature') != sig:
+            return False
+        self.index = index
+        return True
+
+    def ready(self):
+        return self.index is not None
+
+    def build(self, mlog, progress_callback=None):
+        '''build the cache with one pass over mlog, which is left rewound'''
+        signature = log_signature(self.filename)
+        tmpdir = self.cache_dir + '.tmp%u' % os.getpid()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        os.makedirs(tmpdir)
+        spill = ColumnSpill(os.path.join(tmpdir, 'spill.dat'))
+        columns = {}
+        fields = {}
+        counts = {}
+        instance_fields = {}
+
+        def flush(mtype):
+            for (name, values) in columns[mtype].items():
+                if len(values) > 0:
+                    spill.append(mtype, name, values)
+                    del values[:]
+
+        mlog.rewind()
+        count = 0
+        last_pct = -1
+        while True:
+            m = mlog.recv_match()
+            if m is None:
+                break
+            mtype = m.get_type()
+            if mtype == 'BAD_DATA':
+                continue
+            cols = columns.get(mtype, None)
+            if cols is None:
+                fields[mtype] = list(m.get_fieldnames())
+                cols = {'_timestamp': [], '_index': []}
+                for name in fields[mtype]:
+                    cols[name] = []
+                columns[mtype] = cols
+                counts[mtype] = 0
+                fmt = getattr(m, 'fmt', None)
+                instance_fields[mtype] = getattr(fmt, 'instance_field', None)
+            cols['_timestamp'].append(m._timestamp)
+            cols['_index'].append(count)
+            for name in fields[mtype]:
+                cols[name].append(getattr(m, name, None))
+            counts[mtype] += 1
+            if len(cols['_index']) >= CHUNK_ROWS:
+                flush(mtype)
+            count += 1
+            if progress_callback is not None and count % 10000 == 0:
+                pct = int(100 * getattr(mlog, 'offset', 0) / max(1, signature['size']))
+                if pct != last_pct:
+                    progress_callback(pct)
+                    last_pct = pct
+        mlog.rewind()
+
+        types = {}
+        try:
+            for mtype in columns:
+                flush(mtype)
+                os.mkdir(os.path.join(tmpdir, mtype))
+                stored = []
+                for name in columns[mtype]:
+                    if spill.write_npy(mtype, name, os.path.join(tmpdir, mtype, name + '.npy')):
+                        stored.append(name)
+                types[mtype] = {
+                    'count': counts[mtype],
+                    'fields': [f for f in fields[mtype] if f in stored],
+                    'dropped': [f for f in fields[mtype] if f not in stored],
+                    'instance_field': instance_fields[mtype],
+                }
+        finally:
+            spill.close()
+        index = {'signature': signature, 'types': types}
+        with open(os.path.join(tmpdir, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        with self.lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.rename(tmpdir, self.cache_dir)
+            self.index = index
+        return count
+
+    def load(self, mlog, progress_callback=None):
+        '''use the cache on disk if it is valid, otherwise build it'''
+        if self.valid():
+            return True
+        self.build(mlog, progress_callback)
+        return False
+
+    def types(self):
+        '''return the message types in the cache'''
+        if self.index is None:
+            return []
+        return list(self.index['types'].keys())
+
+    def has(self, mtype, field=None):
+        '''return True if the cache holds mtype, and field if given'''
+        if self.index is None or mtype not in self.index['types']:
+            return False
+        return field is None or field in ['_timestamp', '_index'] or field in self.index['types'][mtype]['fields']
+
+    def dropped(self, mtype, field):
+        '''return True if field is in the log but couldn't be stored as a column'''
+        return self.has(mtype) and field in self.index['types'][mtype]['dropped']
+
+    def count(self, mtype):
+        if not self.has(mtype):
+            return 0
+        return self.index['types'][mtype]['count']
+
+    def column(self, mtype, field):
+        '''return a memory mapped array for one field of mtype'''
+        if not self.has(mtype, field):
+            raise KeyError('%s.%s not in log cache' % (mtype, field))
+        return numpy.load(os.path.join(self.cache_dir, mtype, field + '.npy'), mmap_mode='r')
+
+    def instances(self, mtype):
+        '''return the instance values present for mtype, or None if it has no instances'''
+        if not self.has(mtype):
+            return None
+        ifield = self.index['types'][mtype]['instance_field']
+        if ifield is None or not self.has(mtype, ifield):
+            return None
+        return list(numpy.unique(self.column(mtype, ifield)))
+
+    def columns(self, mtype, fields=None, instance=None):
+        '''return a dict of field name to array for mtype, always including
+        _timestamp and _index. If instance is given only rows for that
+        instance are returned'''
+        if fields is None:
+            fields = self.index['types'][mtype]['fields']
+        ret = {'_timestamp': self.column(mtype, '_timestamp'),
+               '_index': self.column(mtype, '_index')}
+        for f in fields:
+            ret[f] = self.column(mtype, f)
+        if instance is not None:
+            ifield = self.index['types'][mtype]['instance_field']
+            if ifield is None:
+                raise KeyError('%s has no instance field' % mtype)
+            mask = instance_mask(self.column(mtype, ifield), instance)
+            for f in ret:
+                ret[f] = ret[f][mask]
+        return ret
+
+
+def instance_mask(icol, instance):
+    '''return a mask of rows of an instance column matching instance'''
+    if icol.dtype.kind != 'U':
+        try:
+            return icol == float(instance)
+        except ValueError:
+            pass
+    return icol.astype(str) == str(instance)
+
+
+class ColumnCollector(object):
+    '''accumulate fields of messages into columns'''
+    def __init__(self, wanted):
+        '''wanted is a dict of message type to a set of field names, or
+        None for all fields'''
+        self.wanted = wanted
+        self.cols = {}
+        self.instance_fields = {}
+
+    def add(self, m, index):
+        '''add message m, which is at position index in the log'''
+        mtype = m.get_type()
+        c = self.cols.get(mtype, None)
+        if c is None:
+            fields = self.wanted.get(mtype, None)
+            if fields is None:
+                fields = m.get_fieldnames()
+            fields = set(fields)
+            ifield = getattr(getattr(m, 'fmt', None), 'instance_field', None)
+            self.instance_fields[mtype] = ifield
+            if ifield is not None:
+                fields.add(ifield)
+            c = {'_timestamp': [], '_index': []}
+            for f in fields:
+                c[f] = []
+            self.cols[mtype] = c
+        c['_timestamp'].append(m._timestamp)
+        c['_index'].append(index)
+        for f in c:
+            if f[0] != '_':
+                c[f].append(getattr(m, f, None))
+
+    def result(self):
+        '''return (data, instance_fields, dropped) where data is a dict of
+        message type to a dict of field arrays'''
+        data = {}
+        dropped = set()
+        for mtype in self.cols:
+            data[mtype] = {}
+            for f in self.cols[mtype]:
+                a = column_array(self.cols[mtype][f])
+                if a is not None:
+                    data[mtype][f] = a
+                elif any(v is not None for v in self.cols[mtype][f]):
+                    dropped.add((mtype, f))
+        return (data, self.instance_fields, dropped)
+
+
+class MessageColumns(object):
+    '''in-memory columns for a few message types, with the same lookup
+    interface as LogCache. Used when there is no cache for a log'''
+    def __init__(self, mlog=None, wanted=None):
+        '''scan mlog once collecting the fields in wanted, a dict of
+        message type to a set of field names, or None for all fields.
+        With no mlog the columns start empty, see merge()'''
+        self.data = {}
+        self.instance_fields = {}
+        self.dropped_fields = set()
+        if mlog is None:
+            return
+        collector = ColumnCollector(wanted)
+        mlog.rewind()
+        count = 0
+        while True:
+            m = mlog.recv_match(type=list(wanted.keys()))
+            if m is None:
+                break
+            collector.add(m, count)
+            count += 1
+        mlog.rewind()
+        self.merge([collector.result()])
+
+    def merge(self, parts):
+        '''add the results of ColumnCollectors which covered consecutive
+        parts of the log, in log order'''
+        for (data, instance_fields, dropped) in parts:
+            self.instance_fields.update(instance_fields)
+            self.dropped_fields.update(dropped)
+        types = set()
+        for (data, instance_fields, dropped) in parts:
+            types.update(data.keys())
+        for mtype in types:
+            present = [p[0][mtype] for p in parts if mtype in p[0]]
+            fields = set(present[0].keys())
+            for d in present[1:]:
+                for f in fields.symmetric_difference(d.keys()):
+                    self.dropped_fields.add((mtype, f))
+                fields.intersection_update(d.keys())
+            self.data[mtype] = {}
+            for f in fields:
+                self.data[mtype][f] = numpy.concatenate([d[f] for d in present])
+
+    def ready(self):
+        return True
+
+    def has(self, mtype, field=None):
+        if mtype not in self.data:
+            return False
+        return field is None or field in self.data[mtype]
+
+    def dropped(self, mtype, field):
+        return (mtype, field) in self.dropped_fields
+
+    def column(self, mtype, field):
+        if not self.has(mtype, field):
+            raise KeyError('%s.%s not collected' % (mtype, field))
+        return self.data[mtype][field]
+
+    def columns(self, mtype, fields=None, instance=None):
+        if fields is None:
+            fields = [f for f in self.data[mtype].keys() if f[0] != '_']
+        ret = {'_timestamp': self.column(mtype, '_timestamp'),
+               '_index': self.column(mtype, '_index')}
+        for f in fields:
+            ret[f] = self.column(mtype, f)
+        if instance is not None:
+            ifield = self.instance_fields.get(mtype, None)
+            if ifield is None or not self.has(mtype, ifield):
+                raise KeyError('%s has no instance field' % mtype)
+            mask = instance_mask(self.column(mtype, ifield), instance)
+            for f in ret:
+                ret[f] = ret[f][mask]
+        return ret
+
+
+if __name__ == "__main__":
+    import time
+    from argparse import ArgumentParser
+    from pymavlink import mavutil
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("log", metavar="LOG")
+    parser.add_argument("field", metavar="TYPE.FIELD", nargs='?', default=None)
+    args = parser.parse_args()
+
+    t0 = time.time()
+    mlog = mavutil.mavlink_connection(args.log, notimestamps=False, zero_time_base=False)
+    cache = LogCache(args.log)
+    if cache.valid():
+        print("Cache valid")
+    else:
+        n = cache.build(mlog)
+        print("Built cache of %u messages in %.1fs" % (n, time.time() - t0))
+    if args.field is not None:
+        (mtype, field) = args.field.split('.')
+        t0 = time.time()
+        n = 0
+        while True:
+            m = mlog.recv_match(type=mtype)
+            if m is None:
+                break
+            getattr(m, field)
+            n += 1
+        t1 = time.time()
+        col = numpy.array(cache.column(mtype, field))
+        t2 = time.time()
+        print("recv_match: %u values in %.3fs, cache: %u values in %.3fs" % (n, t1-t0, len(col), t2-t1))
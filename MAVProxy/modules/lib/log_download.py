@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+'''
+windowed dataflash log download over MAVLink
+
+ArduPilot streams LOG_DATA for one LOG_REQUEST_DATA at a time and a new
+request replaces the one it is serving, so sending several requests at
+once loses all but the last. WindowedDownload keeps one request in
+flight and asks for the next window just before the current one ends.
+Chunks lost from the stream are left as gaps while the stream carries
+on, and are asked for again in one pass once a window's worth are
+missing or the end of the log is reached. The requests of a pass are
+sent back to back at the rate the vehicle serves them rather than
+waiting a round trip for each, and whatever is still missing afterwards
+goes in the next pass. The window grows while the stream arrives
+without loss and halves when chunks go missing or a request times
+out. Received 90 byte chunks are tracked in a bitmap, so finding gaps
+only looks at the chunks near the lowest missing one. The bitmap is saved next to the file so an
+interrupted download can be resumed.
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import struct
+import time
+
+CHUNK_SIZE = 90
+STATE_MAGIC = b'MPLB'
+state_header = struct.Struct('<4sII')
+
+
+class ChunkBitmap(object):
+    '''a growable bitmap of received chunks'''
+    def __init__(self, nchunks=0):
+        self.bits = bytearray((nchunks + 7) // 8)
+        self.count = 0
+        self.low = 0
+
+    def ensure(self, idx):
+        n = idx // 8 + 1
+        if n > len(self.bits):
+            self.bits.extend(bytearray(max(n - len(self.bits), len(self.bits))))
+
+    def test(self, idx):
+        if idx // 8 >= len(self.bits):
+            return False
+        return (self.bits[idx // 8] >> (idx % 8)) & 1 == 1
+
+    def set(self, idx):
+        '''mark a chunk as received, returning False if it already was'''
+        self.ensure(idx)
+        mask = 1 << (idx % 8)
+        if self.bits[idx // 8] & mask:
+            return False
+        self.bits[idx // 8] |= mask
+        self.count += 1
+        self.advance()
+        return True
+
+    def advance(self):
+        '''move low past received chunks, a byte at a time where possible'''
+        while True:
+            b = self.low // 8
+            if b >= len(self.bits):
+                return
+            if self.low % 8 == 0 and self.bits[b] == 0xFF:
+                self.low += 8
+            elif self.test(self.low):
+                self.low += 1
+            else:
+                return
+
+    def count_range(self, start, end):
+        '''number of received chunks in [start, end)'''
+        ret = 0
+        idx = start
+        while idx < end and idx % 8 != 0:
+            ret += self.test(idx)
+            idx += 1
+        while idx + 8 <= end and idx // 8 < len(self.bits):
+            ret += bin(self.bits[idx // 8]).count('1')
+            idx += 8
+        while idx < end:
+            ret += self.test(idx)
+            idx += 1
+        return ret
+
+    def first_gap(self, limit, max_len, start=None):
+        '''return (start, end) of the first missing range from start (the
+        lowest missing chunk by default) below limit, at most max_len
+        chunks long, or None'''
+        if start is None:
+            start = self.low
+        while start < limit:
+            b = start // 8
+            if start % 8 == 0 and b < len(self.bits) and self.bits[b] == 0xFF:
+                start += 8
+            elif self.test(start):
+                start += 1
+            else:
+                break
+        if start >= limit:
+            return None
+        end = start + 1
+        while end < limit and end - start < max_len and not self.test(end):
+            end += 1
+        return (start, end)
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+    @staticmethod
+    def from_bytes(data):
+        ret = ChunkBitmap()
+        ret.bits = bytearray(data)
+        ret.count = sum([bin(b).count('1') for b in ret.bits])
+        ret.advance()
+        return ret
+
+
+class Request(object):
+    '''a LOG_REQUEST_DATA in flight, in chunks'''
+    def __init__(self, start, end, now, retry):
+        self.start = start
+        self.end = end
+        self.sent = now
+        self.retry = retry
+        self.first_rx = None
+        self.last_rx = now
+        self.highest = None
+        self.received = 0
+
+
+class WindowedDownload(object):
+    '''download state for one log'''
+    def __init__(self, lognum, filename, size=None, window=64, window_min=8, window_max=2048):
+        self.lognum = lognum
+        self.filename = filename
+        self.state_filename = filename + '.bitmap'
+        self.size = size
+        self.window = window
+        self.window_min = window_min
+        self.window_max = window_max
+        self.total = None
+        if size is not None:
+            self.total = (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.bitmap = ChunkBitmap(self.total or 0)
+        self.frontier = 0
+        self.req = None
+        self.search_limit = 0
+        # gaps still to ask for in the current retry pass
+        self.retry_queue = []
+        # time the chunks of the last retry pass should all have arrived by
+        self.settle_time = 0
+        self.srtt = None
+        self.rttvar = 0.0
+        self.chunk_interval = None
+        self.last_chunk_time = None
+        self.last_chunk_idx = 0
+        self.loss = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.bytes_received = 0
+        self.file = None
+        self.start_time = None
+        self.last_state_save = 0
+        self.resumed = 0
+        self.complete = False
+
+    def open(self):
+        '''open the output file, resuming from saved state if it matches'''
+        self.start_time = time.time()
+        if os.path.exists(self.filename) and os.path.exists(self.state_filename):
+            try:
+                with open(self.state_filename, 'rb') as f:
+                    data = f.read()
+                (magic, size, frontier) = state_header.unpack_from(data)
+                if magic == STATE_MAGIC and size == (self.size or 0):
+                    self.bitmap = ChunkBitmap.from_bytes(data[state_header.size:])
+                    self.frontier = frontier
+                    self.resumed = self.bitmap.count
+            except Exception:
+                self.resumed = 0
+        if self.resumed > 0:
+            self.file = open(self.filename, 'r+b')
+        else:
+            self.bitmap = ChunkBitmap(self.total or 0)
+            self.frontier = 0
+            self.file = open(self.filename, 'wb')
+        self.search_limit = self.frontier
+        self.check_complete()
+        return self.resumed
+
+    def save_state(self):
+        '''save the bitmap so the download can be resumed'''
+        if self.file is None or self.complete:
+            return
+        self.file.flush()
+        tmpname = self.state_filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(state_header.pack(STATE_MAGIC, self.size or 0, self.frontier))
+            f.write(self.bitmap.to_bytes())
+        os.replace(tmpname, self.state_filename)
+        self.last_state_save = time.time()
+
+    def close(self):
+        '''close the file, keeping the state for a later resume unless complete'''
+        if self.file is None:
+            return
+        if self.complete:
+            if self.total is not None and self.size is not None:
+                self.file.truncate(self.size)
+            self.file.close()
+            if os.path.exists(self.state_filename):
+                os.unlink(self.state_filename)
+        else:
+            self.save_state()
+            self.file.close()
+        self.file = None
+
+    def received_bytes(self):
+        if self.size is not None and self.total is not None and self.bitmap.test(self.total-1):
+            return min(self.bitmap.count * CHUNK_SIZE, self.size)
+        return self.bitmap.count * CHUNK_SIZE
+
+    def missing(self):
+        '''chunks known to be missing below the highest requested'''
+        limit = self.frontier
+        if self.total is not None:
+            limit = min(limit, self.total)
+        return max(0, limit - self.bitmap.count)
+
+    def check_complete(self):
+        if self.total is not None and self.bitmap.count >= self.total:
+            self.complete = True
+        return self.complete
+
+    def handle_data(self, ofs, count, data, now=None):
+        '''handle a LOG_DATA, returning True when the download is complete'''
+        if now is None:
+            now = time.time()
+        idx = ofs // CHUNK_SIZE
+        if count < CHUNK_SIZE:
+            # a short or empty packet marks the end of the log
+            total = idx + 1 if count > 0 else idx
+            if self.total is None or total < self.total:
+                self.total = total
+                self.size = idx * CHUNK_SIZE + count
+        if count > 0 and self.bitmap.set(idx):
+            self.file.seek(ofs)
+            self.file.write(bytearray(data[:count]))
+            self.bytes_received += count
+            if self.last_chunk_time is not None and idx == self.last_chunk_idx + 1:
+                # only consecutive chunks, so loss doesn't look like a
+                # slower vehicle
+                dt = now - self.last_chunk_time
+                if self.chunk_interval is None:
+                    self.chunk_interval = dt
+                else:
+                    self.chunk_interval = 0.9 * self.chunk_interval + 0.1 * dt
+            self.last_chunk_time = now
+            self.last_chunk_idx = idx
+        req = self.req
+        if req is not None and req.start <= idx < req.end:
+            if req.first_rx is None:
+                req.first_rx = now
+                if idx == req.start:
+                    # only the first chunk of the request gives a clean rtt
+                    self.update_rtt(now - req.sent)
+            req.last_rx = now
+            req.received += 1
+            if req.highest is None or idx > req.highest:
+                req.highest = idx
+        if now - self.last_state_save > 2:
+            self.save_state()
+        return self.check_complete()
+
+    def update_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt * 0.5
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self):
+        if self.srtt is None:
+            return 1.0
+        return max(0.3, 2 * self.srtt + 4 * self.rttvar)
+
+    def finish_request(self, now, timed_out):
+        '''adjust the window from how the current request went'''
+        req = self.req
+        self.req = None
+        if req.end > req.start and not req.retry:
+            # only the stream measures loss; retries of a few chunks
+            # would otherwise grow the window whenever they got through
+            expected = req.end - req.start
+            if req.highest is not None and not timed_out:
+                # chunks past highest may still be arriving when pipelined
+                expected = req.highest + 1 - req.start
+            loss = 1.0 - min(1.0, req.received / float(max(1, expected)))
+            self.loss = 0.8 * self.loss + 0.2 * loss
+            if timed_out or loss > 0.05:
+                self.window = max(self.window_min, self.window // 2)
+            elif loss < 0.01:
+                self.window = min(self.window_max, self.window * 2)
+        if req.highest is not None and not timed_out:
+            self.search_limit = min(self.frontier, req.highest + 1)
+        else:
+            self.search_limit = self.frontier
+
+    def missing_below(self, limit):
+        '''chunks known to be missing below limit'''
+        return max(0, limit - (self.bitmap.count - self.bitmap.count_range(limit, self.frontier)))
+
+    def more_to_request(self, limit):
+        '''true if there is anything to ask for below limit or past the frontier'''
+        if self.total is not None:
+            limit = min(limit, self.total)
+        if self.bitmap.first_gap(limit, 1) is not None:
+            return True
+        return self.total is None or self.frontier < self.total
+
+    def next_request(self, now=None):
+        '''return (ofs, count) of the next LOG_REQUEST_DATA to send now, or None'''
+        if now is None:
+            now = time.time()
+        if self.complete:
+            return None
+        req = self.req
+        if req is not None and req.retry and self.chunk_interval:
+            # retries go back to back at the rate the vehicle serves them,
+            # anything lost is picked up by the next pass
+            if now < req.sent + (req.end - req.start) * self.chunk_interval:
+                return None
+            self.req = None
+            self.settle_time = now + self.timeout()
+        elif req is not None:
+            timed_out = now - req.last_rx > self.timeout()
+            done = req.highest is not None and req.highest >= req.end - 1
+            if self.total is not None and req.highest is not None and req.highest >= self.total - 1:
+                done = True
+            ready = False
+            if not done and not timed_out and req.highest is not None and self.srtt is not None and self.chunk_interval:
+                # ask for the next window so it arrives as this one ends,
+                # the vehicle is half a round trip ahead of what we have seen
+                remaining = req.end - 1 - req.highest
+                ready = (remaining + 1) * self.chunk_interval <= self.srtt
+            if not (done or timed_out or ready):
+                return None
+            if ready and not done and not timed_out and not self.more_to_request(min(self.frontier, req.highest + 1)):
+                # only chunks of this request are left, let it finish
+                return None
+            self.finish_request(now, timed_out and not done)
+            if ready and self.total is not None and req.end >= self.total:
+                # let the end of the log arrive before looking for gaps in it
+                self.settle_time = now + (req.end - 1 - req.highest) * self.chunk_interval + self.timeout()
+        else:
+            self.search_limit = self.frontier
+
+        if len(self.retry_queue) > 0:
+            (start, end) = self.retry_queue.pop(0)
+            return self.send_request(start, end, now, True)
+        limit = self.search_limit
+        if self.total is not None:
+            limit = min(limit, self.total)
+        at_end = self.total is not None and self.frontier >= self.total
+        if at_end:
+            # the stream has finished, so every chunk asked for has had its chance
+            limit = self.total
+        if now >= self.settle_time and (at_end or self.missing_below(limit) >= self.window):
+            # enough gaps have built up to be worth breaking the stream for
+            start = None
+            while True:
+                gap = self.bitmap.first_gap(limit, self.window, start)
+                if gap is None:
+                    break
+                self.retry_queue.append(gap)
+                start = gap[1]
+            if len(self.retry_queue) > 0:
+                (start, end) = self.retry_queue.pop(0)
+                return self.send_request(start, end, now, True)
+        if at_end:
+            return None
+        end = self.frontier + self.window
+        if self.total is not None:
+            end = min(end, self.total)
+        start = self.frontier
+        self.frontier = end
+        return self.send_request(start, end, now, False)
+
+    def send_request(self, start, end, now, retry):
+        '''record a request for chunks [start, end) and return its (ofs, count)'''
+        self.req = Request(start, end, now, retry)
+        self.requests += 1
+        if retry:
+            self.retries += 1
+        return (start * CHUNK_SIZE, (end - start) * CHUNK_SIZE)
+
+    def speed(self):
+        '''download rate in bytes/sec'''
+        dt = time.time() - self.start_time
+        if dt <= 0:
+            return 0
+        return self.bytes_received / dt
+
+
+if __name__ == "__main__":
+    # simulate a lossy link to a vehicle serving one request at a time
+    import random
+    import tempfile
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=1000000, help="log size in bytes")
+    parser.add_argument("--loss", type=float, default=0.05, help="fraction of LOG_DATA lost")
+    parser.add_argument("--rate", type=float, default=100, help="LOG_DATA per second")
+    parser.add_argument("--latency", type=float, default=0.1, help="one way latency in seconds")
+    args = parser.parse_args()
+
+    log = bytearray(random.getrandbits(8) for i in range(args.size))
+    filename = os.path.join(tempfile.mkdtemp(), 'sim.bin')
+    dl = WindowedDownload(1, filename, size=args.size)
+    dl.open()
+    now = 0.0
+    serving = None
+    pending = []
+    arrivals = []
+    dt = 1.0 / args.rate
+    while not dl.complete and now < 3600:
+        r = dl.next_request(now)
+        if r is not None:
+            pending.append((now + args.latency, r))
+        while pending and pending[0][0] <= now:
+            serving = list(pending.pop(0)[1])
+        if serving is not None and serving[1] > 0 and serving[0] < args.size:
+            ofs = serving[0]
+            count = min(CHUNK_SIZE, args.size - ofs)
+            if random.random() >= args.loss:
+                arrivals.append((now + args.latency, ofs, count))
+            serving[0] += CHUNK_SIZE
+            serving[1] -= CHUNK_SIZE
+        while arrivals and arrivals[0][0] <= now:
+            (t, ofs, count) = arrivals.pop(0)
+            dl.handle_data(ofs, count, log[ofs:ofs+count], now)
+        now += dt
+    dl.close()
+    ok = open(filename, 'rb').read() == bytes(log)
+    ideal = args.size / float(CHUNK_SIZE) / args.rate
+    print("%u bytes in %.1fs simulated (%.1fs at full rate) %u requests %u retries window %u match=%s" % (
+        args.size, now, ideal, dl.requests, dl.retries, dl.window, ok))
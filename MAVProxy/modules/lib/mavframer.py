@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''
+raw MAVLink framer
+
+Splits a byte stream into MAVLink1/MAVLink2 frames, checking only the
+header, length and CRC. Payloads are not decoded, so frames which are
+only being routed can be forwarded as the original bytes.
+
+AP_FLAKE8_CLEAN
+'''
+
+from pymavlink import mavutil
+
+PROTOCOL_MARKER_V1 = 0xFE
+PROTOCOL_MARKER_V2 = 0xFD
+HEADER_LEN_V1 = 6
+HEADER_LEN_V2 = 10
+SIGNATURE_LEN = 13
+IFLAG_SIGNED = 0x01
+
+
+def message_name(msgid):
+    '''return the message type name for msgid, or None if unknown'''
+    cls = mavutil.mavlink.mavlink_map.get(msgid, None)
+    if cls is None:
+        return None
+    if hasattr(cls, 'msgname'):
+        return cls.msgname
+    return cls.name
+
+
+def message_id(name):
+    '''return the msgid for a message type name, or None if unknown'''
+    return getattr(mavutil.mavlink, 'MAVLINK_MSG_ID_' + name.upper(), None)
+
+
+class MAVFrame(object):
+    '''a raw MAVLink frame'''
+    __slots__ = ['msgid', 'srcSystem', 'srcComponent', 'seq', 'buf']
+
+    def __init__(self, msgid, srcSystem, srcComponent, seq, buf):
+        self.msgid = msgid
+        self.srcSystem = srcSystem
+        self.srcComponent = srcComponent
+        self.seq = seq
+        self.buf = buf
+
+
+class MAVFramer(object):
+    '''frame raw MAVLink packets from a byte stream
+
+    push() returns a list of MAVFrame objects. Frames which could not
+    be checked (unknown msgid) and non-MAVLink bytes are returned with
+    msgid of None so the caller can hand them to the full parser.
+    '''
+    def __init__(self):
+        self.buf = bytearray()
+        self.crc_errors = 0
+        self.crc_extra = {}
+        for (msgid, cls) in mavutil.mavlink.mavlink_map.items():
+            self.crc_extra[msgid] = cls.crc_extra
+
+    def check_crc(self, view, hlen, plen, crc_extra):
+        '''check the CRC of a frame in view'''
+        crc = mavutil.mavlink.x25crc(view[1:hlen+plen])
+        crc.accumulate(bytes([crc_extra]))
+        return crc.crc == (view[hlen+plen] | (view[hlen+plen+1] << 8))
+
+    def push(self, data):
+        '''add data to the stream, returning any complete frames'''
+        buf = self.buf
+        buf.extend(data)
+        ret = []
+        ofs = 0
+        blen = len(buf)
+        view = memoryview(buf)
+        noise_start = None
+        while ofs < blen:
+            magic = buf[ofs]
+            if magic != PROTOCOL_MARKER_V1 and magic != PROTOCOL_MARKER_V2:
+                if noise_start is None:
+                    noise_start = ofs
+                ofs += 1
+                continue
+            if blen - ofs < 3:
+                break
+            plen = buf[ofs+1]
+            if magic == PROTOCOL_MARKER_V2:
+                hlen = HEADER_LEN_V2
+                flen = hlen + plen + 2
+                if buf[ofs+2] & IFLAG_SIGNED:
+                    flen += SIGNATURE_LEN
+            else:
+                hlen = HEADER_LEN_V1
+                flen = hlen + plen + 2
+            if blen - ofs < flen:
+                break
+            if noise_start is not None:
+                ret.append(MAVFrame(None, 0, 0, 0, bytes(buf[noise_start:ofs])))
+                noise_start = None
+            if magic == PROTOCOL_MARKER_V2:
+                (seq, sysid, compid) = (buf[ofs+4], buf[ofs+5], buf[ofs+6])
+                msgid = buf[ofs+7] | (buf[ofs+8] << 8) | (buf[ofs+9] << 16)
+            else:
+                (seq, sysid, compid, msgid) = (buf[ofs+2], buf[ofs+3], buf[ofs+4], buf[ofs+5])
+            crc_extra = self.crc_extra.get(msgid, None)
+            if crc_extra is None:
+                # can't check the CRC, let the full parser deal with it
+                ret.append(MAVFrame(None, sysid, compid, seq, bytes(buf[ofs:ofs+flen])))
+                ofs += flen
+                continue
+            if not self.check_crc(view[ofs:ofs+flen], hlen, plen, crc_extra):
+                # skip the marker and resync
+                self.crc_errors += 1
+                ofs += 1
+                continue
+            ret.append(MAVFrame(msgid, sysid, compid, seq, bytes(buf[ofs:ofs+flen])))
+            ofs += flen
+        if noise_start is not None:
+            ret.append(MAVFrame(None, 0, 0, 0, bytes(buf[noise_start:ofs])))
+        view.release()
+        del buf[:ofs]
+        return ret
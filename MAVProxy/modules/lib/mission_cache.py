@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''
+on-disk cache of mission, fence and rally items
+
+Items are stored in the same packed MISSION_ITEM_INT format as the
+@MISSION ftp files, one file per system ID and mission type, along
+with the mission identity the autopilot reported for them and a CRC32
+of the items so a damaged file is never used. A cached copy is only
+good for a download when the autopilot reports the same non-zero
+identity and item count; with no identity there is nothing to check
+the cache against.
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import struct
+import zlib
+
+from MAVProxy.modules.lib import mp_util
+
+CACHE_MAGIC = b'MPMC'
+cache_header = struct.Struct('<4sII')
+
+
+def cache_dir():
+    path = mp_util.dot_mavproxy('mission_cache')
+    mp_util.mkdir_p(path)
+    return path
+
+
+def cache_path(sysid, mission_type):
+    return os.path.join(cache_dir(), "%u_%u.dat" % (sysid, mission_type))
+
+
+def save(sysid, mission_type, opaque_id, data):
+    '''store packed items for a vehicle'''
+    path = cache_path(sysid, mission_type)
+    tmpname = path + '.tmp'
+    try:
+        with open(tmpname, 'wb') as f:
+            f.write(cache_header.pack(CACHE_MAGIC, opaque_id, zlib.crc32(data) & 0xFFFFFFFF))
+            f.write(data)
+        os.replace(tmpname, path)
+    except (IOError, OSError) as ex:
+        print("Failed to save mission cache %s: %s" % (path, ex))
+        return False
+    return True
+
+
+def load(sysid, mission_type):
+    '''return (opaque_id, data) cached for a vehicle, or None'''
+    path = cache_path(sysid, mission_type)
+    try:
+        with open(path, 'rb') as f:
+            buf = f.read()
+    except (IOError, OSError):
+        return None
+    if len(buf) < cache_header.size:
+        return None
+    (magic, opaque_id, crc) = cache_header.unpack_from(buf)
+    data = buf[cache_header.size:]
+    if magic != CACHE_MAGIC or zlib.crc32(data) & 0xFFFFFFFF != crc:
+        return None
+    return (opaque_id, data)
+
+
+def remove(sysid, mission_type):
+    '''forget the cached items for a vehicle'''
+    path = cache_path(sysid, mission_type)
+    if os.path.exists(path):
+        os.unlink(path)
@@ -15,6 +15,7 @@ import time
 
 import pymavlink
 from pymavlink import mavutil
+from MAVProxy.modules.lib import mission_cache
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
 if mp_util.has_wxpython:
@@ -29,8 +30,39 @@ except ImportError:
     # py3
     from io import BytesIO as SIO
 
+MISSION_FTP_MAGIC = 0x763d
+
+# changed ranges closer than this many items are sent as one range
+PARTIAL_MERGE_GAP = 3
+
+
+class MissionUpload(object):
+    '''an upload of edited items, all of them or changed ranges'''
+    def __init__(self, items, ranges, known):
+        # item keys being uploaded
+        self.items = items
+        # (start, end) ranges still to send, None for a full upload
+        self.ranges = ranges
+        # true if the vehicle holds all of items once this completes
+        self.known = known
+        self.current = None
+        self.fallback = False
+        self.start_time = time.time()
+        self.bytes = 0
+        self.items_sent = 0
+        self.item_bytes = 0
+
 
 class MissionItemProtocolModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset([
+        'MISSION_ACK',
+        'MISSION_COUNT',
+        'MISSION_ITEM',
+        'MISSION_ITEM_INT',
+        'MISSION_REQUEST',
+        'MISSION_REQUEST_INT',
+    ])
+
     def __init__(self, mpstate, name, description, **args):
         super(MissionItemProtocolModule, self).__init__(mpstate, name, description, **args)
         self.add_command(self.command_name(),
@@ -52,6 +84,11 @@ class MissionItemProtocolModule(mp_module.MPModule):
         self.upload_start = None
         self.last_get_home = time.time()
         self.ftp_count = None
+        self.download_sysid = None
+        self.download_opaque_id = 0
+        self.vehicle_items_by_sysid = {}
+        self.partial_unsupported = set()
+        self.upload_op = None
 
         if self.continue_mode and self.logdir is not None:
             waytxt = os.path.join(mpstate.status.logdir, self.save_filename())
@@ -195,10 +232,12 @@ on'''
         ret = []
         tnow = time.time()
         next_seq = self.wploader.count()
-        for i in range(5):
+        for i in range(max(1, self.settings.wp_request_window)):
             seq = next_seq+i
             if seq+1 > self.wploader.expected_count:
                 continue
+            if seq in self.wp_received:
+                continue
             if seq in self.wp_requested and tnow - self.wp_requested[seq] < 2:
                 continue
             ret.append(seq)
@@ -255,14 +294,24 @@ on'''
             if self.wp_op is None:
                 if self.wploader.expected_count != m.count:
                     self.console.writeln("Mission is stale")
+                    self.set_vehicle_items(None)
             else:
                 self.wploader.clear()
+                self.wp_requested = {}
+                self.wp_received = {}
+                self.download_sysid = m.get_srcSystem()
+                self.download_opaque_id = getattr(m, 'opaque_id', 0)
+                self.wploader.expected_count = m.count
+                if self.load_from_cache(m.count):
+                    self.console.writeln("Using cached %u %s (id 0x%08x)" % (
+                        m.count, self.itemstype(), self.download_opaque_id))
+                    self.download_complete(m.get_srcSystem(), save_cache=False)
+                    return
                 self.console.writeln("Requesting %u %s t=%s now=%s" % (
                     m.count,
                     self.itemstype(),
                     time.asctime(time.localtime(m._timestamp)),
                     time.asctime()))
-                self.wploader.expected_count = m.count
                 self.send_wp_requests()
 
         elif mtype in ['MISSION_ITEM', 'MISSION_ITEM_INT'] and self.wp_op is not None:
@@ -287,18 +336,97 @@ on'''
                 # print("m.seq=%u expected_count=%u" % (m.seq, self.wploader.expected_count))
                 self.send_wp_requests()
                 return
-            if self.wp_op == 'list':
-                self.show_and_save(m.get_srcSystem())
-                self.loading_waypoints = False
-            elif self.wp_op == "save":
-                self.save_waypoints(self.wp_save_filename)
-            self.wp_op = None
-            self.wp_requested = {}
-            self.wp_received = {}
+            self.download_complete(m.get_srcSystem())
 
         elif mtype in frozenset(["MISSION_REQUEST", "MISSION_REQUEST_INT"]):
             self.process_waypoint_request(m, self.master)
 
+        elif mtype == 'MISSION_ACK':
+            if getattr(m, 'mission_type', 0) != self.mav_mission_type():
+                return
+            self.handle_mission_ack(m)
+
+    def download_complete(self, source_system, save_cache=True):
+        '''finish a list, save or fetch once all items are held'''
+        if save_cache:
+            self.save_to_cache()
+        self.set_vehicle_items(self.item_keys())
+        if self.wp_op == 'list':
+            self.show_and_save(source_system)
+            self.loading_waypoints = False
+        elif self.wp_op == "save":
+            self.save_waypoints(self.wp_save_filename)
+        self.wp_op = None
+        self.wp_requested = {}
+        self.wp_received = {}
+
+    def load_from_cache(self, count):
+        '''fill wploader from the cache if it holds the mission the
+        vehicle just reported. Returns True on success'''
+        if not self.settings.wp_cache or self.download_opaque_id == 0:
+            return False
+        cached = mission_cache.load(self.download_sysid, self.mav_mission_type())
+        if cached is None:
+            return False
+        (opaque_id, data) = cached
+        if opaque_id != self.download_opaque_id:
+            return False
+        (items, error) = self.unpack_items(data)
+        if items is None or len(items) != count:
+            return False
+        self.wploader.clear()
+        for w in items:
+            self.wploader.add(w)
+        return True
+
+    def save_to_cache(self):
+        '''store the held items under the mission id they were downloaded with'''
+        if not self.settings.wp_cache or self.download_opaque_id == 0 or self.download_sysid is None:
+            return
+        mission_cache.save(self.download_sysid, self.mav_mission_type(), self.download_opaque_id,
+                           self.pack_items())
+
+    def pack_items(self):
+        '''held items as MISSION_ITEM_INT in the mission ftp file format'''
+        fh = SIO()
+        fh.write(struct.pack("<HHHHH", MISSION_FTP_MAGIC, self.mav_mission_type(), 0, 0, self.wploader.count()))
+        mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
+        for i in range(self.wploader.count()):
+            w = self.wploader.wp(i)
+            w = self.wp_to_mission_item_int(w)
+            tlist = []
+            for field in mavmsg.ordered_fieldnames:
+                tlist.append(getattr(w, field))
+            tlist = tuple(tlist)
+            buf = mavmsg.unpacker.pack(*tlist)
+            fh.write(buf)
+        return fh.getvalue()
+
+    def unpack_items(self, data):
+        '''items from the mission ftp file format, returns (items, error)'''
+        if len(data) < 10:
+            return (None, "short data")
+        magic2, dtype, options, start, num_items = struct.unpack("<HHHHH", data[0:10])
+        if magic2 != MISSION_FTP_MAGIC:
+            return (None, "bad magic 0x%x expected 0x%x" % (magic2, MISSION_FTP_MAGIC))
+        if dtype != self.mav_mission_type():
+            return (None, "bad data type %u" % dtype)
+        items = []
+        mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
+        item_size = mavmsg.unpacker.size
+        ofs = 10
+        while len(data) - ofs >= item_size:
+            msg = mavmsg.unpacker.unpack(data[ofs:ofs+item_size])
+            ofs += item_size
+            tlist = list(msg)
+            t = tlist[:]
+            for i in range(0, len(tlist)):
+                tlist[i] = t[mavmsg.orders[i]]
+            t = tuple(tlist)
+            w = mavmsg(*t)
+            items.append(self.wp_from_mission_item_int(w))
+        return (items, None)
+
     def idle_task(self):
         '''handle missing waypoints'''
         if self.wp_period.trigger():
@@ -309,6 +437,11 @@ on'''
                 wps = self.missing_wps_to_request()
                 print("re-requesting %s %s" % (self.itemstype(), str(wps)))
                 self.send_wp_requests(wps)
+            if self.upload_op is not None and time.time() > self.loading_waypoint_lasttime + 10.0:
+                print("Timed out sending %s" % self.itemstype())
+                # the vehicle may hold some of the edit
+                self.set_vehicle_items(None)
+                self.upload_op = None
 
         self.idle_task_add_menu_items()
 
@@ -446,9 +579,22 @@ on'''
         # update the user on our progress:
         self.mpstate.console.set_status(self.itemtype(), '%s %u/%u' % (self.itemtype(), m.seq, self.wploader.count()-1))
 
+        up = self.upload_op
+        if up is not None:
+            nbytes = len(wp_send.get_msgbuf())
+            up.bytes += nbytes
+            up.item_bytes += nbytes
+            up.items_sent += 1
+            if up.current is not None and m.seq == up.current[1]:
+                # the rest is reported when the vehicle acknowledges
+                self.loading_waypoints = False
+                return
+
         # see if the transfer is complete:
         if m.seq == self.wploader.count() - 1:
             self.loading_waypoints = False
+            if up is not None:
+                return
             print("Loaded %u %s in %.2fs" % (
                 self.wploader.count(),
                 self.itemstype(),
@@ -461,15 +607,144 @@ on'''
         return self.send_all_items()
 
     def send_all_items(self):
-        '''send all waypoints to vehicle'''
+        '''send all waypoints to vehicle, or only the changed ones when
+        the vehicle's copy is known'''
+        self.send_changes()
+
+    def item_key(self, w):
+        '''the fields of an item the vehicle stores, packed so NaNs compare equal'''
+        w = self.wp_to_mission_item_int(w)
+        return struct.pack("<ffffiifHBB", w.param1, w.param2, w.param3, w.param4,
+                           w.x, w.y, w.z, w.command, w.frame, w.autocontinue)
+
+    def item_keys(self):
+        return [self.item_key(self.wploader.wp(i)) for i in range(self.wploader.count())]
+
+    @property
+    def vehicle_items(self):
+        '''item keys last downloaded from or acknowledged by the vehicle, or None'''
+        return self.vehicle_items_by_sysid.get(self.target_system, None)
+
+    def set_vehicle_items(self, items):
+        self.vehicle_items_by_sysid[self.target_system] = items
+
+    def partial_supported(self):
+        return (self.target_system, self.mav_mission_type()) not in self.partial_unsupported
+
+    def changed_ranges(self, old, new):
+        '''inclusive (start, end) ranges of items that differ, merging
+        ranges which are close together'''
+        ranges = []
+        for i in range(len(new)):
+            if old[i] == new[i]:
+                continue
+            if ranges and i - ranges[-1][1] <= PARTIAL_MERGE_GAP + 1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i, i])
+        return [(r[0], r[1]) for r in ranges]
+
+    def send_changes(self, hint=None):
+        '''send the edited items. Items are compared with the vehicle's
+        copy and changed ranges sent with MISSION_WRITE_PARTIAL_LIST
+        where possible. hint is an inclusive range known to be changed,
+        used when the vehicle's copy is unknown'''
+        new = self.item_keys()
+        old = self.vehicle_items
+        ranges = None
+        known = True
+        if self.partial_supported():
+            if old is not None and len(old) == len(new):
+                ranges = self.changed_ranges(old, new)
+                if len(ranges) == 0:
+                    print("No %s changes to send" % self.itemtype())
+                    return
+                changed = sum([end + 1 - start for (start, end) in ranges])
+                if changed + 2 * len(ranges) >= len(new):
+                    # each range costs a request and ack, not worth it
+                    ranges = None
+            elif old is None and hint is not None and len(new) > 0:
+                (start, end) = hint
+                ranges = [(max(start, 0), min(end, len(new) - 1))]
+                known = False
+        self.upload_op = MissionUpload(new, ranges, known)
+        self.upload_start = time.time()
+        if ranges is None:
+            self.send_full_upload()
+        else:
+            self.send_next_range()
+
+    def send_full_upload(self):
+        '''start sending all items'''
         self.loading_waypoints = True
         self.loading_waypoint_lasttime = time.time()
-        self.upload_start = time.time()
-        self.master.mav.mission_count_send(
+        msg = self.master.mav.mission_count_encode(
             self.target_system,
             self.target_component,
             self.wploader.count(),
             mission_type=self.mav_mission_type())
+        self.master.mav.send(msg)
+        if self.upload_op is not None:
+            self.upload_op.current = None
+            self.upload_op.bytes += len(msg.get_msgbuf())
+
+    def send_next_range(self):
+        '''start sending the next changed range'''
+        up = self.upload_op
+        up.current = up.ranges.pop(0)
+        self.loading_waypoints = True
+        self.loading_waypoint_lasttime = time.time()
+        msg = self.master.mav.mission_write_partial_list_encode(
+            self.target_system,
+            self.target_component,
+            up.current[0],
+            up.current[1],
+            self.mav_mission_type())
+        self.master.mav.send(msg)
+        up.bytes += len(msg.get_msgbuf())
+
+    def handle_mission_ack(self, m):
+        '''move an upload on when the vehicle acknowledges it'''
+        up = self.upload_op
+        if up is None:
+            return
+        self.loading_waypoints = False
+        if m.type != mavutil.mavlink.MAV_MISSION_ACCEPTED:
+            if up.ranges is not None and not up.fallback:
+                print("Partial %s upload rejected (%u), sending all" % (self.itemtype(), m.type))
+                self.partial_unsupported.add((self.target_system, self.mav_mission_type()))
+                up.ranges = None
+                up.fallback = True
+                up.known = True
+                self.send_full_upload()
+                return
+            print("Failed to send %s (%u)" % (self.itemstype(), m.type))
+            self.set_vehicle_items(None)
+            self.upload_op = None
+            return
+        if up.ranges:
+            self.send_next_range()
+            return
+        self.upload_op = None
+        if up.known:
+            self.set_vehicle_items(up.items)
+        opaque_id = getattr(m, 'opaque_id', 0)
+        if opaque_id != 0:
+            self.download_sysid = m.get_srcSystem()
+            self.download_opaque_id = opaque_id
+            self.save_to_cache()
+        dt = time.time() - up.start_time
+        count = len(up.items)
+        if up.ranges is None:
+            print("Sent all %u %s, %u bytes in %.2fs" % (count, self.itemstype(), up.bytes, dt))
+        else:
+            # compare with an estimate of sending everything
+            full_bytes = 0
+            if up.items_sent > 0:
+                full_bytes = count * up.item_bytes // up.items_sent
+            print("Sent %u of %u %s, %u bytes in %.2fs (all items about %u bytes)" % (
+                up.items_sent, count, self.itemstype(), up.bytes, dt, full_bytes))
+        self.console.writeln("Sent %u %s" % (up.items_sent, self.itemstype()))
 
     def load_waypoints(self, filename):
         '''load waypoints from a file'''
@@ -505,6 +780,7 @@ on'''
         else:
             print("Loaded updated %s %u from %s" % (self.itemtype(), wpnum, filename))
 
+        self.set_vehicle_items(None)
         self.loading_waypoints = True
         self.loading_waypoint_lasttime = time.time()
         if wpnum == -1:
@@ -586,16 +862,7 @@ on'''
         self.send_single_waypoint(offset)
 
     def send_single_waypoint(self, idx):
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.upload_start = time.time()
-        self.master.mav.mission_write_partial_list_send(
-            self.target_system,
-            self.target_component,
-            idx,
-            idx,
-            self.mav_mission_type()
-        )
+        self.send_changes(hint=(idx, idx))
 
     def is_location_command(self, cmd):
         '''see if cmd is a MAV_CMD with a latitude/longitude'''
@@ -679,13 +946,7 @@ on'''
             self.wploader.set(wp, wpnum)
 
         self.wploader.last_change = time.time()
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(
-            self.target_system,
-            self.target_component,
-            wpstart_offset,
-            wpend_offset)
+        self.send_changes(hint=(wpstart_offset, wpend_offset))
         print("Moved %s %u:%u to %f, %f rotation=%.1f" % (self.itemstype(), wpstart, wpend, lat, lon, rotation))
 
     def change_mission_item_range(self, args, desc, changer, newvalstr):
@@ -716,15 +977,7 @@ on'''
             self.wploader.set(wp, offset)
 
         self.wploader.last_change = time.time()
-        self.upload_start = time.time()
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(
-            self.target_system,
-            self.target_component,
-            self.item_num_to_offset(idx),
-            self.item_num_to_offset(idx+count),
-            mission_type=self.mav_mission_type())
+        self.send_changes(hint=(self.item_num_to_offset(idx), self.item_num_to_offset(idx+count-1)))
         print("Changed %s for WPs %u:%u to %s" % (desc, idx, idx+(count-1), newvalstr))
 
     def cmd_changealt(self, args):
@@ -849,6 +1102,8 @@ on'''
             self.wploader.expected_count = 0
         self.wploader.expected_count = 0
         self.loading_waypoint_lasttime = time.time()
+        # vehicles may keep some items, e.g. home
+        self.set_vehicle_items(None)
 
     def cmd_list(self, args):
         self.wp_op = "list"
@@ -1020,7 +1275,7 @@ on'''
             buf = fh.read(10)
             fh.seek(ofs)
             magic2, dtype, options, start, num_items = struct.unpack("<HHHHH", buf)
-            if magic2 == 0x763d:
+            if magic2 == MISSION_FTP_MAGIC:
                 self.ftp_count = num_items
         if self.ftp_count is not None:
             mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
@@ -1033,33 +1288,15 @@ on'''
         if fh is None:
             print("mission: failed ftp download")
             return
-        magic = 0x763d
-        data = fh.read()
-        magic2, dtype, options, start, num_items = struct.unpack("<HHHHH", data[0:10])
-        if magic != magic2:
-            print("%s: bad magic 0x%x expected 0x%x" % (self.itemtype(), magic2, magic))
-            return
-        if dtype != self.mav_mission_type():
-            print("%s: bad data type %u" % (self.itemtype(), dtype))
+        (items, error) = self.unpack_items(fh.read())
+        if items is None:
+            print("%s: %s" % (self.itemtype(), error))
             return
 
         self.wploader.clear()
-
-        data = data[10:]
-        mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
-        item_size = mavmsg.unpacker.size
-        while len(data) >= item_size:
-            mdata = data[:item_size]
-            data = data[item_size:]
-            msg = mavmsg.unpacker.unpack(mdata)
-            tlist = list(msg)
-            t = tlist[:]
-            for i in range(0, len(tlist)):
-                tlist[i] = t[mavmsg.orders[i]]
-            t = tuple(tlist)
-            w = mavmsg(*t)
-            w = self.wp_from_mission_item_int(w)
+        for w in items:
             self.wploader.add(w)
+        self.set_vehicle_items(self.item_keys())
         self.show_and_save(self.target_system)
 
     def show_and_save(self, source_system):
@@ -1096,19 +1333,7 @@ on'''
         print("Loaded %u %s from %s" % (self.wploader.count(), self.itemstype(), filename))
         print("Sending %s with ftp" % self.itemstype())
 
-        fh = SIO()
-        fh.write(struct.pack("<HHHHH", 0x763d, self.mav_mission_type(), 0, 0, self.wploader.count()))
-        mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
-        for i in range(self.wploader.count()):
-            w = self.wploader.wp(i)
-            w = self.wp_to_mission_item_int(w)
-            tlist = []
-            for field in mavmsg.ordered_fieldnames:
-                tlist.append(getattr(w, field))
-            tlist = tuple(tlist)
-            buf = mavmsg.unpacker.pack(*tlist)
-            fh.write(buf)
-        fh.seek(0)
+        fh = SIO(self.pack_items())
 
         self.upload_start = time.time()
 
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+'''
+motion capture to vehicle bridge shared by the optitrack, vicon and
+nokov modules
+
+Capture threads call push() for every rigid body in every frame. push()
+only appends to a deque and pokes a socket registered in select_extra,
+so all MAVLink sending happens in the main loop. Each body is mapped
+to a vehicle by system ID or to a list of links, and each mapping is
+sent at its own rate on a deadline schedule, with mappings spread
+across the period so a frame for many vehicles isn't sent as one
+burst. Only the newest sample of a body is sent; samples replaced
+before their deadline, or older than mocap_max_age, are counted as
+drops.
+
+ATT_POS_MOCAP has no target system field, so a mapping by system ID
+sends on the link that vehicle was last heard on. Vehicles sharing a
+link all see every body sent on it, so mapping two system IDs that are
+on the same link gives a warning.
+
+The mappings are only changed and used from the main loop. Capture
+threads that need the mapped body names read bodies, a tuple that is
+replaced rather than changed.
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import socket
+import time
+
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_util
+
+
+class MocapSample(object):
+    '''pose of one body from one frame, position in metres NED and
+    attitude as a (w, x, y, z) quaternion'''
+    __slots__ = ['body', 'pos', 'q', 'capture_time', 'rx_time', 'extra', 'sent']
+
+    def __init__(self, body, pos, q, capture_time, rx_time, extra):
+        self.body = body
+        self.pos = pos
+        self.q = q
+        self.capture_time = capture_time
+        self.rx_time = rx_time
+        self.extra = extra
+        self.sent = False
+
+
+class BodyMap(object):
+    '''where and how often to send one body'''
+    def __init__(self, body, sysid=None, links=None, rate=None):
+        self.body = body
+        self.sysid = sysid
+        self.links = links
+        self.rate = rate
+        self.deadline = 0
+        # per mapping state for senders that need it
+        self.state = {}
+
+    def describe(self):
+        if self.sysid is not None:
+            target = "sysid %u" % self.sysid
+        elif self.links is None:
+            target = "master"
+        elif self.links == 'all':
+            target = "all links"
+        else:
+            target = "links %s" % ','.join([str(x) for x in self.links])
+        return "%s -> %s" % (self.body, target)
+
+
+class BodyStats(object):
+    '''counts and latency for one body'''
+    def __init__(self):
+        self.received = 0
+        self.sent = 0
+        self.superseded = 0
+        self.stale = 0
+        self.latency = 0.0
+        self.latency_max = 0.0
+        self.capture_latency = None
+        self.last_send = None
+        self.interval = None
+        self.jitter = 0.0
+
+    def update_send(self, now, latency, capture_latency):
+        self.sent += 1
+        self.latency = latency if self.sent == 1 else 0.95 * self.latency + 0.05 * latency
+        self.latency_max = max(self.latency_max, latency)
+        if capture_latency is not None:
+            if self.capture_latency is None:
+                self.capture_latency = capture_latency
+            else:
+                self.capture_latency = 0.95 * self.capture_latency + 0.05 * capture_latency
+        if self.last_send is not None:
+            dt = now - self.last_send
+            if self.interval is None:
+                self.interval = dt
+            else:
+                self.jitter = 0.95 * self.jitter + 0.05 * abs(dt - self.interval)
+                self.interval = 0.95 * self.interval + 0.05 * dt
+        self.last_send = now
+
+
+def att_pos_mocap_sender(link, mapping, sample, time_us):
+    '''send a sample as ATT_POS_MOCAP'''
+    link.mav.att_pos_mocap_send(time_us, sample.q, sample.pos[0], sample.pos[1], sample.pos[2])
+
+
+class MocapBridge(object):
+    '''queue samples from capture threads and send them from the main loop'''
+    def __init__(self, mpstate, name, settings=None, sender=att_pos_mocap_sender, rate=50.0, queue_len=4096):
+        self.mpstate = mpstate
+        self.name = name
+        self.sender = sender
+        # the bridge settings go in with the settings of the module using it
+        if settings is None:
+            settings = mp_settings.MPSettings([])
+        settings.append(('mocap_rate', float, rate))
+        settings.append(('mocap_max_age', float, 0.1))
+        self.settings = settings
+        self.maps = collections.OrderedDict()
+        # names of the mapped bodies, safe to read from capture threads
+        self.bodies = ()
+        self.default_map = None
+        self.queue = collections.deque(maxlen=queue_len)
+        self.latest = {}
+        self.stats = {}
+        self.wake_pending = False
+        self.wake_r = None
+        self.wake_w = None
+        self.overflows = 0
+
+    def start(self):
+        '''register the wakeup socket with the main loop'''
+        if self.wake_r is not None:
+            return
+        (self.wake_r, self.wake_w) = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.mpstate.select_extra[self.wake_r.fileno()] = (self.on_wakeup, None)
+
+    def stop(self):
+        '''remove the wakeup socket, dropping anything queued'''
+        if self.wake_r is None:
+            return
+        self.mpstate.select_extra.pop(self.wake_r.fileno(), None)
+        self.wake_r.close()
+        self.wake_w.close()
+        self.wake_r = None
+        self.wake_w = None
+        self.queue.clear()
+        self.latest = {}
+
+    def push(self, body, pos, q, capture_time=None, extra=None):
+        '''add a sample, safe to call from any thread'''
+        if len(self.queue) == self.queue.maxlen:
+            self.overflows += 1
+        self.queue.append(MocapSample(str(body), pos, q, capture_time, time.time(), extra))
+        if not self.wake_pending and self.wake_w is not None:
+            self.wake_pending = True
+            try:
+                self.wake_w.send(b'\0')
+            except (OSError, socket.error):
+                pass
+
+    def on_wakeup(self, args):
+        '''main loop handler for the wakeup socket'''
+        self.wake_pending = False
+        try:
+            self.wake_r.recv(4096)
+        except (OSError, socket.error):
+            pass
+        self.service()
+
+    def get_stats(self, body):
+        if body not in self.stats:
+            self.stats[body] = BodyStats()
+        return self.stats[body]
+
+    def drain(self):
+        '''move queued samples to latest, counting replaced ones as drops'''
+        queue = self.queue
+        latest = self.latest
+        while True:
+            try:
+                s = queue.popleft()
+            except IndexError:
+                break
+            st = self.get_stats(s.body)
+            st.received += 1
+            old = latest.get(s.body, None)
+            if old is not None and not old.sent:
+                st.superseded += 1
+            latest[s.body] = s
+
+    def mappings(self):
+        if self.maps:
+            return self.maps.values()
+        if self.default_map is not None:
+            return [self.default_map]
+        return []
+
+    def set_default(self, body, rate=None):
+        '''the body to send to the master link when nothing is mapped'''
+        body = str(body)
+        if self.default_map is None or self.default_map.body != body or self.default_map.rate != rate:
+            self.default_map = BodyMap(body, rate=rate)
+
+    def add_map(self, body, sysid=None, links=None, rate=None):
+        mapping = BodyMap(str(body), sysid=sysid, links=links, rate=rate)
+        if sysid is not None:
+            self.check_shared_link(mapping)
+        self.maps[mapping.body] = mapping
+        self.bodies = tuple(self.maps.keys())
+        self.reschedule()
+
+    def remove_map(self, body):
+        self.maps.pop(str(body), None)
+        self.bodies = tuple(self.maps.keys())
+        self.reschedule()
+
+    def check_shared_link(self, mapping):
+        '''warn if another vehicle mapped by system ID is on the same link,
+        as it will see this body too'''
+        link = self.select_links(mapping)[0]
+        if link is None:
+            return
+        for m in self.maps.values():
+            if m.body == mapping.body or m.sysid is None or m.sysid == mapping.sysid:
+                continue
+            if self.select_links(m)[0] is link:
+                print("%s: warning: sysid %u and sysid %u are on the same link, "
+                      "both vehicles will see %s and %s" % (self.name, m.sysid, mapping.sysid,
+                                                            m.body, mapping.body))
+
+    def period(self, mapping):
+        rate = mapping.rate
+        if rate is None:
+            rate = self.settings.mocap_rate
+        if rate <= 0:
+            return 0
+        return 1.0 / rate
+
+    def reschedule(self):
+        '''spread the mapping deadlines evenly over their periods'''
+        now = time.time()
+        maps = list(self.maps.values())
+        for (i, m) in enumerate(maps):
+            m.deadline = now + self.period(m) * i / len(maps)
+
+    def select_links(self, mapping):
+        if mapping.sysid is not None:
+            return [self.mpstate.master(mapping.sysid)]
+        if mapping.links is None:
+            return [self.mpstate.master()]
+        if mapping.links == 'all':
+            return self.mpstate.mav_master
+        return [self.mpstate.mav_master[i] for i in mapping.links if i < len(self.mpstate.mav_master)]
+
+    def service(self, now=None):
+        '''send the newest sample of each mapping whose deadline has passed'''
+        self.drain()
+        if now is None:
+            now = time.time()
+        max_age = self.settings.mocap_max_age
+        for m in self.mappings():
+            if now < m.deadline:
+                continue
+            s = self.latest.get(m.body, None)
+            if s is None or s.sent:
+                continue
+            s.sent = True
+            st = self.get_stats(m.body)
+            if max_age > 0 and now - s.rx_time > max_age:
+                st.stale += 1
+                continue
+            period = self.period(m)
+            m.deadline += period
+            if m.deadline < now:
+                # more than a period behind, restart the schedule from now
+                m.deadline = now + period
+            capture_time = s.capture_time if s.capture_time is not None else s.rx_time
+            time_us = int(capture_time * 1.0e6)
+            for link in self.select_links(m):
+                if link is not None:
+                    self.sender(link, m, s, time_us)
+            capture_latency = None
+            if s.capture_time is not None:
+                capture_latency = now - s.capture_time
+            st.update_send(now, now - s.rx_time, capture_latency)
+
+    def status_lines(self):
+        '''text report of mappings and per body statistics'''
+        lines = []
+        for m in self.mappings():
+            lines.append(" %s at %.1fHz" % (m.describe(), 1.0 / max(self.period(m), 1.0e-6)))
+        for body in sorted(self.stats.keys()):
+            st = self.stats[body]
+            rate = 0
+            if st.interval:
+                rate = 1.0 / st.interval
+            line = " %s: rx %u sent %u superseded %u stale %u rate %.1fHz jitter %.1fms latency %.1fms (max %.1fms)" % (
+                body, st.received, st.sent, st.superseded, st.stale, rate,
+                st.jitter * 1000, st.latency * 1000, st.latency_max * 1000)
+            if st.capture_latency is not None:
+                line += " capture %.1fms" % (st.capture_latency * 1000)
+            lines.append(line)
+        if self.overflows:
+            lines.append(" queue overflows %u" % self.overflows)
+        return lines
+
+    def command(self, args):
+        '''handle the bridge subcommands of a module'''
+        usage = "<map BODY [sysid SYSID|links master|all|N,M] [rate HZ]|unmap BODY|mappings|stats|reset>"
+        if len(args) == 0:
+            print(usage)
+        elif args[0] == 'map':
+            if len(args) < 2:
+                print("usage: map BODY [sysid SYSID|links master|all|N,M] [rate HZ]")
+                return
+            sysid = None
+            links = None
+            rate = None
+            i = 2
+            while i + 1 < len(args):
+                if args[i] == 'sysid':
+                    sysid = int(args[i+1])
+                elif args[i] == 'links':
+                    links = mp_util.parse_links(args[i+1])
+                elif args[i] == 'rate':
+                    rate = float(args[i+1])
+                else:
+                    print("unknown map option %s" % args[i])
+                    return
+                i += 2
+            self.add_map(args[1], sysid=sysid, links=links, rate=rate)
+        elif args[0] == 'unmap':
+            if len(args) < 2:
+                print("usage: unmap BODY")
+                return
+            self.remove_map(args[1])
+        elif args[0] == 'mappings':
+            for m in self.mappings():
+                print(" " + m.describe())
+        elif args[0] == 'stats':
+            for line in self.status_lines():
+                print(line)
+        elif args[0] == 'reset':
+            self.stats = {}
+            self.overflows = 0
+        else:
+            print(usage)
+
+
+if __name__ == "__main__":
+    # simulate a 240Hz capture thread feeding many bodies
+    import threading
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--bodies", type=int, default=10, help="number of rigid bodies")
+    parser.add_argument("--capture-rate", type=float, default=240, help="capture frames per second")
+    parser.add_argument("--rate", type=float, default=100, help="send rate per vehicle")
+    parser.add_argument("--duration", type=float, default=3, help="seconds to run")
+    args = parser.parse_args()
+
+    class FakeMav(object):
+        def __init__(self):
+            self.count = 0
+
+        def att_pos_mocap_send(self, time_us, q, x, y, z):
+            self.count += 1
+
+    class FakeLink(object):
+        def __init__(self):
+            self.mav = FakeMav()
+
+    class FakeState(object):
+        def __init__(self, n):
+            self.mav_master = [FakeLink() for i in range(n)]
+            self.select_extra = {}
+
+        def master(self, sysid=-1):
+            if sysid == -1:
+                return self.mav_master[0]
+            return self.mav_master[sysid-1]
+
+    mpstate = FakeState(args.bodies)
+    bridge = MocapBridge(mpstate, 'sim', rate=args.rate)
+    for i in range(args.bodies):
+        bridge.add_map(i, sysid=i+1)
+    bridge.start()
+    running = True
+
+    def capture():
+        t = time.time()
+        while running:
+            t += 1.0 / args.capture_rate
+            time.sleep(max(0, t - time.time()))
+            for i in range(args.bodies):
+                bridge.push(i, (0.0, 0.0, -1.0), (1.0, 0.0, 0.0, 0.0), capture_time=t)
+
+    th = threading.Thread(target=capture)
+    th.start()
+    import select
+    end = time.time() + args.duration
+    while time.time() < end:
+        (rin, win, xin) = select.select(list(mpstate.select_extra.keys()), [], [], 0.01)
+        for fd in rin:
+            (fn, fargs) = mpstate.select_extra[fd]
+            fn(fargs)
+        bridge.service()
+    running = False
+    th.join()
+    for line in bridge.status_lines()[args.bodies:]:
+        print(line)
+    bridge.stop()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+'''
+per-module timing statistics for the mavlink_packet and idle_task hooks
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import json
+
+
+class HookStats(object):
+    '''timing statistics for one hook of one module'''
+    def __init__(self, max_samples=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.exceptions = 0
+        self.over_budget = 0
+        self.samples = collections.deque(maxlen=max_samples)
+        self.recent_over = collections.deque(maxlen=max_samples)
+
+    def record(self, dt, budget=None):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        self.samples.append(dt)
+        if budget is not None:
+            over = dt > budget
+            if over:
+                self.over_budget += 1
+            self.recent_over.append(over)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, pct):
+        '''return the pct percentile of the recent samples'''
+        if len(self.samples) == 0:
+            return 0.0
+        s = sorted(self.samples)
+        return s[min(len(s)-1, int(len(s) * pct / 100.0))]
+
+    def slow(self, fraction=0.1):
+        '''true if more than fraction of recent calls went over budget'''
+        if len(self.recent_over) < 10:
+            return False
+        return sum(self.recent_over) > fraction * len(self.recent_over)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean(),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'exceptions': self.exceptions,
+            'over_budget': self.over_budget,
+            'slow': self.slow(),
+        }
+
+
+class ModuleStats(object):
+    '''timing statistics for all modules, keyed by (module name, hook)'''
+    def __init__(self):
+        self.hooks = {}
+
+    def get(self, modname, hook):
+        key = (modname, hook)
+        if key not in self.hooks:
+            self.hooks[key] = HookStats()
+        return self.hooks[key]
+
+    def record(self, modname, hook, dt, budget=None, exception=False):
+        '''record one call of hook on module modname taking dt seconds'''
+        h = self.get(modname, hook)
+        h.record(dt, budget)
+        if exception:
+            h.exceptions += 1
+
+    def reset(self):
+        self.hooks = {}
+
+    def slow_modules(self):
+        '''return names of modules whose idle_task is regularly over budget'''
+        ret = []
+        for (modname, hook) in sorted(self.hooks.keys()):
+            if hook == 'idle_task' and self.hooks[(modname, hook)].slow():
+                ret.append(modname)
+        return ret
+
+    def to_dict(self):
+        ret = {}
+        for (modname, hook) in self.hooks:
+            if modname not in ret:
+                ret[modname] = {}
+            ret[modname][hook] = self.hooks[(modname, hook)].to_dict()
+        return ret
+
+    def save_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def report(self):
+        '''return a text report, busiest hooks first'''
+        lines = ["%-16s %-15s %8s %9s %9s %9s %9s %5s" % (
+            "Module", "Hook", "Calls", "Total(s)", "Mean(ms)", "P99(ms)", "Max(ms)", "Exc")]
+        keys = sorted(self.hooks.keys(), key=lambda k: self.hooks[k].total, reverse=True)
+        for (modname, hook) in keys:
+            h = self.hooks[(modname, hook)]
+            line = "%-16s %-15s %8u %9.3f %9.3f %9.3f %9.3f %5u" % (
+                modname, hook, h.count, h.total, h.mean()*1000,
+                h.percentile(99)*1000, h.max*1000, h.exceptions)
+            if hook == 'idle_task' and h.slow():
+                line += " SLOW"
+            lines.append(line)
+        return "\n".join(lines)
@@ -43,33 +43,65 @@ class ElevationModel():
             print("Error: Bad terrain source " + str(database))
             self.database = None
 
+    def GetTile(self, TileID, timeout=0):
+        '''return the SRTM tile for a (floor(lat), floor(lon)) TileID, or None
+        if it is not available yet'''
+        if TileID in self.tileDict:
+            return self.tileDict[TileID]
+        tile = self.downloader.getTile(TileID[0], TileID[1])
+        if tile == 0:
+            if timeout > 0:
+                t0 = time.time()
+                while time.time() < t0+timeout and tile == 0:
+                    tile = self.downloader.getTile(TileID[0], TileID[1])
+                    if tile == 0:
+                        time.sleep(0.1)
+        if tile == 0:
+            return None
+        self.tileDict[TileID] = tile
+        return tile
+
     def GetElevation(self, latitude, longitude, timeout=0):
         '''Returns the altitude (m ASL) of a given lat/long pair, or None if unknown'''
         if latitude is None or longitude is None:
             return None
         if self.database in ['SRTM1', 'SRTM3']:
             TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            tile = self.GetTile(TileID, timeout=timeout)
+            if tile is None:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         elif self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         else:
             return None
         return alt
 
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns an array of altitudes (m ASL) for arrays of latitude and
+        longitude, with NaN where the altitude is unknown. The points may
+        span any number of tiles'''
+        lats = numpy.asarray(latitudes, dtype=float)
+        lons = numpy.asarray(longitudes, dtype=float)
+        (lats, lons) = numpy.broadcast_arrays(lats, lons)
+        ret = numpy.full(lats.shape, numpy.nan)
+        if self.database in ['SRTM1', 'SRTM3']:
+            tile_lat = numpy.floor(lats)
+            tile_lon = numpy.floor(lons)
+            tile_ids = numpy.unique(numpy.stack((tile_lat.ravel(), tile_lon.ravel()), axis=1), axis=0)
+            for (tlat, tlon) in tile_ids:
+                tile = self.GetTile((tlat, tlon), timeout=timeout)
+                if tile is None:
+                    continue
+                mask = (tile_lat == tlat) & (tile_lon == tlon)
+                ret[mask] = tile.getAltitudeArray(lats[mask], lons[mask])
+        elif self.database == 'geoscience':
+            for idx in numpy.ndindex(lats.shape):
+                alt = self.mappy.getAltitudeAtPoint(lats[idx], lons[idx])
+                if alt is not None:
+                    ret[idx] = alt
+        return ret
+
 
 if __name__ == "__main__":
 
@@ -112,5 +144,11 @@ if __name__ == "__main__":
     t1 = time.time()+.000001
     print("Altitude at (%.6f, %.6f) is %u m. Pulled at %.1f FPS" % (lat, lon, alt, 1/(t1-t0)))
 
-
-
+    # batch lookup of a 1000x1000 grid
+    lats = numpy.linspace(args.lat-0.05, args.lat+0.05, 1000)
+    lons = numpy.linspace(args.lon-0.05, args.lon+0.05, 1000)
+    (lat_grid, lon_grid) = numpy.meshgrid(lats, lons)
+    t0 = time.time()
+    alts = EleModel.GetElevationArray(lat_grid, lon_grid, timeout=10)
+    t1 = time.time()+.000001
+    print("Batch of %u altitudes (mean %.1f m) pulled at %.0f points/s" % (alts.size, numpy.nanmean(alts), alts.size/(t1-t0)))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+'''
+compile once evaluation of mavlink expressions
+
+mavutil.evaluate_expression() parses the expression string on every
+call. compile_expression() parses it once, keeps the result in a cache
+keyed by the expression text, and records the message types the
+expression depends on so callers can skip messages that can't change
+its value. Simple MSG.field expressions are read with getattr() and
+never reach eval().
+
+Expressions use the same names as mavutil.evaluate_expression(): math
+and mavextra functions as globals and the current messages as locals,
+with an optional trailing {CONDITION}. evaluate() raises
+ExpressionError saying which message, field or operation failed;
+value() returns None on any error like evaluate_expression() does.
+
+AP_FLAKE8_CLEAN
+'''
+
+import ast
+import re
+
+from pymavlink import mavexpression
+
+re_msgtype = re.compile('^[A-Z_][A-Z0-9_]+$')
+re_simple = re.compile(r'^\s*([A-Z_][A-Z0-9_]+)\.([A-Za-z_][A-Za-z0-9_]*)\s*$')
+
+default_namespace = dict(vars(mavexpression))
+
+
+class ExpressionError(Exception):
+    '''an expression failed to compile or evaluate'''
+    def __init__(self, expression, reason, msgtype=None, field=None):
+        super(ExpressionError, self).__init__("%s: %s" % (expression, reason))
+        self.expression = expression
+        self.reason = reason
+        self.msgtype = msgtype
+        self.field = field
+
+
+class CompiledExpression(object):
+    '''an expression parsed once and evaluated many times'''
+    def __init__(self, expression, nocondition=False, namespace=None):
+        self.expression = expression
+        self.nocondition = nocondition
+        if namespace is None:
+            namespace = default_namespace
+        self.namespace = namespace
+        self.condition = None
+        body = expression
+        if expression.endswith('}'):
+            startidx = expression.rfind('{')
+            if startidx == -1:
+                raise ExpressionError(expression, "unmatched '}'")
+            self.condition = self._compile(expression[startidx+1:-1], 'condition')
+            body = expression[:startidx]
+        self.body = body
+        self.code = self._compile(body, 'expression')
+        self.simple = None
+        m = re_simple.match(body)
+        if m is not None and self.condition is None:
+            self.simple = (m.group(1), m.group(2))
+        self.msg_types = self._msg_types(body)
+        if self.condition is not None:
+            self.msg_types |= self._msg_types(expression[len(body)+1:-1])
+
+    def _compile(self, text, what):
+        try:
+            return compile(text.strip(), '<%s>' % what, 'eval')
+        except SyntaxError as ex:
+            raise ExpressionError(self.expression, "syntax error in %s at offset %s" % (what, ex.offset))
+
+    def _msg_types(self, text):
+        '''message type names referenced by text'''
+        ret = set()
+        for node in ast.walk(ast.parse(text.strip(), mode='eval')):
+            if isinstance(node, ast.Name) and re_msgtype.match(node.id) and node.id not in self.namespace:
+                ret.add(node.id)
+        return ret
+
+    def _error(self, ex, what):
+        '''turn an exception from eval into an ExpressionError'''
+        if isinstance(ex, NameError):
+            name = getattr(ex, 'name', None)
+            if name is None:
+                m = re.search("'([^']+)'", str(ex))
+                name = m.group(1) if m else None
+            if name is not None and re_msgtype.match(name):
+                return ExpressionError(self.expression, "no %s message" % name, msgtype=name)
+            return ExpressionError(self.expression, "unknown name %s in %s" % (name, what))
+        if isinstance(ex, AttributeError):
+            field = getattr(ex, 'name', None)
+            obj = getattr(ex, 'obj', None)
+            msgtype = None
+            if obj is not None and hasattr(obj, 'get_type'):
+                msgtype = obj.get_type()
+            if field is not None and msgtype is not None:
+                return ExpressionError(self.expression, "%s has no field %s" % (msgtype, field),
+                                       msgtype=msgtype, field=field)
+        return ExpressionError(self.expression, "%s in %s: %s" % (type(ex).__name__, what, ex))
+
+    def evaluate(self, messages):
+        '''evaluate against a dictionary of messages. Returns None if the
+        condition is false, raises ExpressionError on failure'''
+        if self.simple is not None:
+            (mtype, field) = self.simple
+            msg = messages.get(mtype, None)
+            if msg is not None:
+                try:
+                    return getattr(msg, field)
+                except AttributeError:
+                    raise ExpressionError(self.expression, "%s has no field %s" % (mtype, field),
+                                          msgtype=mtype, field=field)
+            if mtype not in self.namespace:
+                raise ExpressionError(self.expression, "no %s message" % mtype, msgtype=mtype)
+        if self.condition is not None:
+            try:
+                v = eval(self.condition, self.namespace, messages)
+            except Exception as ex:
+                raise self._error(ex, 'condition')
+            if not self.nocondition and not v:
+                return None
+        try:
+            return eval(self.code, self.namespace, messages)
+        except Exception as ex:
+            raise self._error(ex, 'expression')
+
+    def value(self, messages):
+        '''evaluate against a dictionary of messages, None on any error'''
+        try:
+            return self.evaluate(messages)
+        except ExpressionError:
+            return None
+
+
+expression_cache = {}
+
+
+def compile_expression(expression, nocondition=False, namespace=None):
+    '''return a cached CompiledExpression for expression. Raises
+    ExpressionError if it doesn't compile'''
+    key = (expression, nocondition, id(namespace))
+    ret = expression_cache.get(key, None)
+    if ret is None:
+        ret = CompiledExpression(expression, nocondition=nocondition, namespace=namespace)
+        if len(expression_cache) > 10000:
+            expression_cache.clear()
+        expression_cache[key] = ret
+    return ret
+
+
+def evaluate_expression(expression, messages, nocondition=False):
+    '''cached replacement for mavutil.evaluate_expression'''
+    try:
+        return compile_expression(expression, nocondition=nocondition).value(messages)
+    except ExpressionError:
+        return None
+
+
+if __name__ == "__main__":
+    # compare mavutil.evaluate_expression with compiled expressions
+    import time
+    from argparse import ArgumentParser
+    from pymavlink import mavutil
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100000, help="evaluations per expression")
+    args = parser.parse_args()
+
+    messages = {
+        'ATTITUDE': mavutil.mavlink.MAVLink_attitude_message(1000, 0.1, -0.2, 1.5, 0.01, 0.02, 0.03),
+        'VFR_HUD': mavutil.mavlink.MAVLink_vfr_hud_message(15.0, 16.0, 90, 50, 100.0, 1.2),
+    }
+    exprs = ['ATTITUDE.roll',
+             'degrees(ATTITUDE.pitch)',
+             'VFR_HUD.alt*2+VFR_HUD.climb{VFR_HUD.groundspeed>1}',
+             'wrap_180(degrees(ATTITUDE.yaw))']
+    print("%-50s %10s %10s %7s" % ("Expression", "eval(us)", "cached(us)", "speedup"))
+    for e in exprs:
+        assert mavutil.evaluate_expression(e, messages) == evaluate_expression(e, messages)
+        t0 = time.time()
+        for i in range(args.count):
+            mavutil.evaluate_expression(e, messages)
+        t1 = time.time()
+        c = compile_expression(e)
+        for i in range(args.count):
+            c.value(messages)
+        t2 = time.time()
+        print("%-50s %10.2f %10.2f %6.1fx" % (e, (t1-t0)*1e6/args.count, (t2-t1)*1e6/args.count, (t1-t0)/(t2-t1)))
+    for e in ['GPS_RAW_INT.lat', 'ATTITUDE.nofield', 'ATTITUDE.roll/0', 'ATTITUDE.roll +']:
+        try:
+            compile_expression(e).evaluate(messages)
+        except ExpressionError as ex:
+            print("%-50s error: %s" % (e, ex.reason))
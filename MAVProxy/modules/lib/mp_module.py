@@ -8,6 +8,10 @@ class MPModule(object):
     The base class for all modules
     '''
 
+    # message types wanted by mavlink_packet(), e.g.
+    # frozenset(['HEARTBEAT', 'ATTITUDE']). None means all messages
+    mavlink_packet_types = None
+
     def __init__(self, mpstate, name, description=None, public=False, multi_instance=False, multi_vehicle=False):
         '''
         Constructor
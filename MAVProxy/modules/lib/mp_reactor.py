@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+'''
+event driven reactor for the MAVProxy main loop
+
+File descriptors are registered once with a selectors based poller
+(epoll/kqueue where available) along with the handler to call when
+they become readable. Periodic work is driven from timer deadlines,
+so the poll timeout is the time until the next timer is due rather
+than a fixed select timeout.
+
+A closed file is dropped by epoll, and the next file opened often gets
+the same fd number back. Each registration therefore records the
+object owning the fd, and sync() registers the fd again when that
+object changes even if the number and handler are the same.
+
+AP_FLAKE8_CLEAN
+'''
+
+import heapq
+import selectors
+import time
+
+
+class MPTimer(object):
+    '''a periodic timer managed by MPReactor'''
+    def __init__(self, period, fn, args=None):
+        self.period = period
+        self.fn = fn
+        self.args = args
+        self.deadline = time.monotonic() + period
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class MPReactor(object):
+    '''selectors based fd->handler dispatcher with timer deadlines'''
+    def __init__(self, selector=None):
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self.selector = selector
+        self.handlers = {}
+        self.timers = []
+        self.max_timeout = 0.1
+
+    def register(self, fd, fn, args=None, owner=None):
+        '''register fd, calling fn(args) when it is readable. owner is the
+        object the fd belongs to, used by sync() to spot a reused fd'''
+        if fd in self.handlers:
+            self.unregister(fd)
+        try:
+            self.selector.register(fd, selectors.EVENT_READ, (fn, args))
+        except (ValueError, OSError):
+            # closed or unpollable file descriptor
+            return False
+        self.handlers[fd] = (fn, args, owner)
+        return True
+
+    def unregister(self, fd):
+        '''stop watching fd'''
+        if fd not in self.handlers:
+            return
+        self.handlers.pop(fd)
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def sync(self, sources):
+        '''make the registered set match sources, a dict of
+        fd -> (fn, args, owner)'''
+        for fd in list(self.handlers.keys()):
+            if fd not in sources:
+                self.unregister(fd)
+                continue
+            (fn, args, owner) = self.handlers[fd]
+            (new_fn, new_args, new_owner) = sources[fd]
+            if fn != new_fn or args != new_args or owner is not new_owner:
+                self.unregister(fd)
+        for fd in sources:
+            if fd not in self.handlers:
+                (fn, args, owner) = sources[fd]
+                self.register(fd, fn, args, owner)
+
+    def clear(self):
+        '''unregister all file descriptors'''
+        for fd in list(self.handlers.keys()):
+            self.unregister(fd)
+
+    def add_timer(self, period, fn, args=None):
+        '''call fn(args) every period seconds, returns a MPTimer'''
+        timer = MPTimer(period, fn, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def time_to_next_timer(self, now):
+        '''return seconds until the next timer is due'''
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return self.max_timeout
+        return max(0, min(self.max_timeout, self.timers[0].deadline - now))
+
+    def run_timers(self, now):
+        '''run all timers which are due'''
+        while self.timers and self.timers[0].deadline <= now:
+            timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            # don't try to catch up on missed deadlines, just skip them
+            timer.deadline += timer.period
+            if timer.deadline <= now:
+                timer.deadline = now + timer.period
+            heapq.heappush(self.timers, timer)
+            timer.fn(timer.args)
+
+    def run_once(self, max_timeout=None):
+        '''wait for events or the next timer, then dispatch'''
+        timeout = self.time_to_next_timer(time.monotonic())
+        if max_timeout is not None:
+            timeout = min(timeout, max_timeout)
+        if self.handlers:
+            try:
+                events = self.selector.select(timeout)
+            except (OSError, ValueError):
+                # a registered fd has gone bad; callers resync
+                self.clear()
+                events = []
+        else:
+            time.sleep(timeout)
+            events = []
+        for (key, mask) in events:
+            (fn, args) = key.data
+            fn(args)
+        self.run_timers(time.monotonic())
+        return len(events)
+
+    def close(self):
+        self.clear()
+        self.selector.close()
+
+
+if __name__ == "__main__":
+    # benchmark forwarding latency and CPU usage of the reactor against
+    # a select() loop that rebuilds its fd list and scans it linearly
+    import select
+    import socket
+    import struct
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--links", type=int, default=4, help="number of input links")
+    parser.add_argument("--outputs", type=int, default=16, help="number of UDP outputs")
+    parser.add_argument("--count", type=int, default=20000, help="number of packets")
+    parser.add_argument("--select-timeout", type=float, default=0.01, help="select timeout")
+    args = parser.parse_args()
+
+    def udp_pair():
+        rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rx.bind(('127.0.0.1', 0))
+        rx.setblocking(False)
+        tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        tx.connect(rx.getsockname())
+        return (tx, rx)
+
+    class Hop(object):
+        '''one input link forwarding to every output'''
+        def __init__(self, outputs, sink):
+            (self.tx, self.rx) = udp_pair()
+            self.outputs = outputs
+            self.sink = sink
+
+        def forward(self, args=None):
+            try:
+                pkt = self.rx.recv(300)
+            except BlockingIOError:
+                return
+            for out in self.outputs:
+                out.send(pkt)
+            self.sink.send(pkt)
+
+    def run(use_reactor):
+        outs = [udp_pair() for i in range(args.outputs)]
+        (sink_tx, sink_rx) = udp_pair()
+        sink_rx.setblocking(True)
+        sink_rx.settimeout(1)
+        out_tx = [o[0] for o in outs]
+        hops = [Hop(out_tx, sink_tx) for i in range(args.links)]
+        idle = [0]
+
+        def idle_task(a=None):
+            idle[0] += 1
+
+        reactor = MPReactor()
+        if use_reactor:
+            for h in hops:
+                reactor.register(h.rx.fileno(), h.forward)
+            reactor.add_timer(args.select_timeout, idle_task)
+
+        latencies = []
+        cpu0 = time.process_time()
+        t0 = time.monotonic()
+        for i in range(args.count):
+            hop = hops[i % len(hops)]
+            hop.tx.send(struct.pack('<d', time.monotonic()) + bytes(32))
+            if use_reactor:
+                reactor.run_once()
+            else:
+                rin = [h.rx.fileno() for h in hops] + [o[1].fileno() for o in outs]
+                (rin, win, xin) = select.select(rin, [], [], args.select_timeout)
+                idle_task()
+                for fd in rin:
+                    for h in hops:
+                        if fd == h.rx.fileno():
+                            h.forward()
+                    for o in outs:
+                        if fd == o[1].fileno():
+                            try:
+                                o[1].recv(300)
+                            except BlockingIOError:
+                                pass
+            pkt = sink_rx.recv(300)
+            latencies.append(time.monotonic() - struct.unpack('<d', pkt[:8])[0])
+            if use_reactor:
+                for o in outs:
+                    try:
+                        o[1].recv(300)
+                    except BlockingIOError:
+                        pass
+        elapsed = time.monotonic() - t0
+        cpu = time.process_time() - cpu0
+        latencies.sort()
+        print("%-8s %6.0f pkt/s  cpu %.2fs  latency mean %.1fus p99 %.1fus" % (
+            "reactor" if use_reactor else "select",
+            args.count / elapsed, cpu,
+            1.0e6 * sum(latencies) / len(latencies),
+            1.0e6 * latencies[int(len(latencies)*0.99)]))
+        reactor.close()
+
+    run(False)
+    run(True)
@@ -131,6 +131,23 @@ def gps_offset(lat, lon, east, north):
     distance = sqrt(east**2 + north**2)
     return gps_newpos(lat, lon, bearing, distance)
 
+def gps_offset_array(lat, lon, east, north):
+    '''gps_offset for numpy arrays of positions and offsets, returning
+    arrays of (lat, lon)'''
+    import numpy
+    (lat, lon, east, north) = numpy.broadcast_arrays(*[numpy.asarray(v, dtype=float) for v in (lat, lon, east, north)])
+    lat1 = numpy.clip(numpy.radians(lat), -pi/2+1.0e-15, pi/2-1.0e-15)
+    lon1 = numpy.radians(lon)
+    tc = -numpy.arctan2(east, north)
+    d = numpy.sqrt(east**2 + north**2)/radius_of_earth
+    lat2 = numpy.clip(lat1 + d * numpy.cos(tc), -pi/2 + 1.0e-15, pi/2 - 1.0e-15)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        dphi = numpy.log(numpy.tan(lat2/2+pi/4)/numpy.tan(lat1/2+pi/4))
+        q = numpy.where(numpy.abs(lat2-lat1) < 1.0e-15, numpy.cos(lat1), (lat2-lat1)/dphi)
+    dlon = -d*numpy.sin(tc)/q
+    lon2 = numpy.fmod(lon1+dlon+pi, 2*pi)-pi
+    return (numpy.degrees(lat2), numpy.degrees(lon2))
+
 
 def mkdir_p(dir):
     '''like mkdir -p'''
@@ -374,6 +391,16 @@ def null_term(str):
         str = str[:idx]
     return str
 
+
+def parse_links(s):
+    '''parse a links option: master, all or comma separated link numbers.
+    Returns None for the master link, 'all', or a list of link numbers'''
+    if s is None or s == '' or s == 'master':
+        return None
+    if s == 'all':
+        return 'all'
+    return [int(x) for x in s.split(',')]
+
     
 def decode_devid(devid, pname):
     '''decode one device ID. Used for 'devid' command in mavproxy and MAVExplorer'''
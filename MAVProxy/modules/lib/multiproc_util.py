@@ -61,11 +61,12 @@ class WrapFileHandle(object):
 
     def __getstate__(self):
         # capture the filehandle state
+        # binary mode files have no encoding, errors or newlines
         self._name = self._filehandle.name
         self._mode = self._filehandle.mode
-        self._encoding = self._filehandle.encoding
-        self._errors = self._filehandle.errors
-        self._newlines = self._filehandle.newlines
+        self._encoding = getattr(self._filehandle, 'encoding', None)
+        self._errors = getattr(self._filehandle, 'errors', None)
+        self._newlines = getattr(self._filehandle, 'newlines', None)
         self._offset = self._filehandle.tell()
         
         # copy the dict since we change it
@@ -83,7 +84,10 @@ class WrapFileHandle(object):
         encoding = dict['_encoding']
         errors = dict['_errors']
         newlines = dict['_newlines']
-        filehandle = open(name, mode=mode, encoding=encoding, errors=errors, newline=newlines)
+        if 'b' in mode:
+            filehandle = open(name, mode=mode)
+        else:
+            filehandle = open(name, mode=mode, encoding=encoding, errors=errors, newline=newlines)
         
         # set the seek pointer
         offset = dict['_offset']
@@ -154,6 +158,30 @@ class WrapMMap(object):
         # restore the mmap
         self._mm = mm  
 
+def wrap_mlog(mlog):
+    '''Wrap the filehandle and mmap of a DFReader / mavmmaplog for pickling'''
+
+    if hasattr(mlog,'filehandle'):
+        filehandle = mlog.filehandle
+    elif hasattr(mlog,'f'):
+        filehandle = mlog.f
+    data_map = mlog.data_map
+    data_len = mlog.data_len
+    if hasattr(mlog,'filehandle'):
+        mlog.filehandle = WrapFileHandle(filehandle)
+    elif hasattr(mlog,'f'):
+        mlog.f = WrapFileHandle(filehandle)
+    mlog.data_map = WrapMMap(data_map, filehandle, data_len)
+
+def unwrap_mlog(mlog):
+    '''Restore a DFReader / mavmmaplog wrapped by wrap_mlog'''
+
+    if hasattr(mlog,'filehandle'):
+        mlog.filehandle = mlog.filehandle.unwrap()
+    elif hasattr(mlog,'f'):
+        mlog.f = mlog.f.unwrap()
+    mlog.data_map = mlog.data_map.unwrap()
+
 mutex = multiproc.Lock()
 
 class MPChildTask(object):
@@ -281,32 +309,241 @@ class MPDataLogChildTask(MPChildTask):
     def wrap(self):
         '''Apply custom pickle wrappers to non-pickleable attributes'''
 
-        # wrap filehandle and mmap in mlog for pickling
-        if hasattr(self._mlog,'filehandle'):
-            filehandle = self._mlog.filehandle
-        elif hasattr(self._mlog,'f'):
-            filehandle = self._mlog.f
-        data_map = self._mlog.data_map
-        data_len = self._mlog.data_len
-        if hasattr(self._mlog,'filehandle'):
-            self._mlog.filehandle = WrapFileHandle(filehandle)
-        elif hasattr(self._mlog,'f'):
-            self._mlog.f = WrapFileHandle(filehandle)
-        self._mlog.data_map = WrapMMap(data_map, filehandle, data_len)
+        wrap_mlog(self._mlog)
 
     # @override
     def unwrap(self):
         '''Unwrap custom pickle wrappers of non-pickleable attributes'''
 
-        # restore the state of mlog
-        if hasattr(self._mlog,'filehandle'):
-            self._mlog.filehandle = self._mlog.filehandle.unwrap()
-        elif hasattr(self._mlog,'f'):
-            self._mlog.f = self._mlog.f.unwrap()
-        self._mlog.data_map = self._mlog.data_map.unwrap()
+        unwrap_mlog(self._mlog)
 
     @property
     def mlog(self):
         '''The dataflash or telemetry log (DFReader / mavmmaplog)'''
 
         return self._mlog
+
+def message_offsets(mlog, mtype):
+    '''Return the file offsets of all messages of type mtype in a log'''
+
+    key = getattr(mlog, 'name_to_id', {}).get(mtype, mtype)
+    try:
+        offsets = mlog.offsets[key]
+    except (KeyError, IndexError, TypeError):
+        return []
+    if isinstance(mlog.counts, dict):
+        count = mlog.counts.get(key, len(offsets))
+    else:
+        count = mlog.counts[key]
+    return offsets[:count]
+
+def read_message_at(mlog, offset):
+    '''Decode the message starting at offset in a log'''
+
+    mlog.offset = offset
+    if hasattr(mlog, 'remaining'):
+        mlog.remaining = mlog.data_len - offset
+    if not hasattr(mlog, 'clock'):
+        # mavmmaplog reads through its file handle
+        mlog.f.seek(offset)
+    return mlog.recv_msg()
+
+def range_safe(mlog):
+    '''Returns True if messages of mlog can be decoded starting anywhere
+    in the file with correct timestamps'''
+
+    if not hasattr(mlog, 'offsets'):
+        return False
+    clock = getattr(mlog, 'clock', None)
+    if not hasattr(mlog, 'clock'):
+        # telemetry logs have a timestamp on every message
+        return True
+    from pymavlink import DFReader
+    return isinstance(clock, DFReader.DFReaderClock_usec) and hasattr(mlog, 'remaining')
+
+def extract_columns(mlog, wanted, start, end):
+    '''Collect the wanted fields of messages starting in the byte range
+    [start, end) of a log, using the log's per type offset index'''
+
+    from MAVProxy.modules.lib.log_cache import ColumnCollector
+    offsets = []
+    for mtype in wanted.keys():
+        offsets.extend([ofs for ofs in message_offsets(mlog, mtype) if start <= ofs < end])
+    offsets.sort()
+    collector = ColumnCollector(wanted)
+    for ofs in offsets:
+        m = read_message_at(mlog, ofs)
+        if m is None:
+            continue
+        if m.get_type() in wanted:
+            collector.add(m, ofs)
+    return collector.result()
+
+def log_worker(conn):
+    '''Worker process for LogWorkerPool. Logs are received once and kept
+    so later requests don't need to re-parse them'''
+
+    logs = {}
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request[0] == 'close':
+            break
+        if request[0] == 'log':
+            (key, mlog) = request[1:]
+            unwrap_mlog(mlog)
+            logs[key] = mlog
+            continue
+        (job, part, key, wanted, start, end) = request[1:]
+        try:
+            ret = extract_columns(logs[key], wanted, start, end)
+            conn.send((job, part, ret, None))
+        except Exception as ex:
+            conn.send((job, part, None, str(ex)))
+
+class LogWorkerPool(object):
+    '''A pool of worker processes that extract columns from logs
+
+        Each log is split into byte ranges which are decoded in parallel
+        by the workers over their own memory map of the file, using the
+        offset index the log already has. The log object is sent to each
+        worker once (as WrapFileHandle / WrapMMap) and kept there, so
+        later graphs of the same log reuse the workers without forking
+        or re-parsing.
+    '''
+
+    def __init__(self, num_workers=None, ranges_per_worker=2):
+        if num_workers is None:
+            num_workers = min(4, os.cpu_count() or 1)
+        self.num_workers = num_workers
+        self.ranges_per_worker = ranges_per_worker
+        self.workers = []
+        self.jobs = {}
+        self.next_job = 0
+        self.cond = threading.Condition()
+        self.reader = None
+
+    def start(self):
+        '''Start the worker processes'''
+
+        for i in range(self.num_workers):
+            (parent_conn, child_conn) = multiproc.Pipe()
+            child = multiproc.Process(target=log_worker, args=(child_conn,))
+            child.daemon = True
+            child.start()
+            child_conn.close()
+            self.workers.append({'child' : child, 'conn' : parent_conn, 'logs' : set()})
+        # results are read in a thread so a worker sending a large result
+        # can never block us sending it the next request
+        self.reader = threading.Thread(target=self.read_results, name='log_pool')
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_results(self):
+        '''Collect results from the workers'''
+
+        from multiprocessing.connection import wait
+        conns = [w['conn'] for w in self.workers]
+        while conns:
+            for conn in wait(conns):
+                try:
+                    (job, part, ret, err) = conn.recv()
+                except (EOFError, OSError):
+                    conns.remove(conn)
+                    with self.cond:
+                        # fail everything outstanding on a dead worker
+                        for parts in self.jobs.values():
+                            for i in range(len(parts)):
+                                if parts[i] is None:
+                                    parts[i] = (None, 'worker exited')
+                        self.cond.notify_all()
+                    continue
+                with self.cond:
+                    if job in self.jobs:
+                        self.jobs[job][part] = (ret, err)
+                        self.cond.notify_all()
+
+    def split(self, mlog):
+        '''Return the byte ranges to extract mlog in'''
+
+        if not range_safe(mlog):
+            return [(0, mlog.data_len)]
+        n = self.num_workers * self.ranges_per_worker
+        bounds = [(mlog.data_len * i) // n for i in range(n+1)]
+        return [(bounds[i], bounds[i+1]) for i in range(n)]
+
+    def submit(self, mlog, wanted):
+        '''Start extracting the wanted fields (a dict of message type to a
+        set of field names, or None for all fields) from mlog. Returns a
+        job for result()'''
+
+        if self.reader is None:
+            self.start()
+        key = (mlog.filename, mlog.data_len)
+        ranges = self.split(mlog)
+        with self.cond:
+            job = self.next_job
+            self.next_job += 1
+            self.jobs[job] = [None] * len(ranges)
+        for i in range(len(ranges)):
+            worker = self.workers[i % len(self.workers)]
+            if key not in worker['logs']:
+                with mutex:
+                    wrap_mlog(mlog)
+                    try:
+                        worker['conn'].send(('log', key, mlog))
+                    finally:
+                        unwrap_mlog(mlog)
+                worker['logs'].add(key)
+            (start, end) = ranges[i]
+            worker['conn'].send(('extract', job, i, key, wanted, start, end))
+        return job
+
+    def result(self, job):
+        '''Wait for a job, returning a MessageColumns or None on error'''
+
+        from MAVProxy.modules.lib.log_cache import MessageColumns
+        with self.cond:
+            while None in self.jobs[job]:
+                self.cond.wait()
+            parts = self.jobs.pop(job)
+        for (ret, err) in parts:
+            if err is not None:
+                print("Log extract failed: %s" % err)
+                return None
+        columns = MessageColumns()
+        columns.merge([ret for (ret, err) in parts])
+        return columns
+
+    def extract(self, mlog, wanted):
+        '''Extract the wanted fields from mlog, see submit()'''
+
+        return self.result(self.submit(mlog, wanted))
+
+    def close(self):
+        '''Stop the worker processes'''
+
+        for w in self.workers:
+            try:
+                w['conn'].send(('close',))
+            except (EOFError, OSError):
+                pass
+            w['child'].join(2)
+        self.workers = []
+
+log_pool = None
+
+def shared_log_pool(num_workers=None):
+    '''Return the LogWorkerPool shared by all graphs, starting it if
+    needed. The pool is restarted if num_workers changes'''
+
+    global log_pool
+    if log_pool is not None and num_workers is not None and log_pool.num_workers != num_workers:
+        log_pool.close()
+        log_pool = None
+    if log_pool is None:
+        log_pool = LogWorkerPool(num_workers)
+        log_pool.start()
+    return log_pool
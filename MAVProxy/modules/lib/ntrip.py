@@ -177,8 +177,12 @@ class NtripClient(object):
             return None
         # normal data read
         while True:
+            if self.rtcm3.read(bytes()):
+                # another packet from the last block
+                self.last_id = self.rtcm3.get_packet_ID()
+                return self.rtcm3.get_packet()
             try:
-                data = self.socket.recv(1)
+                data = self.socket.recv(4096)
             except ssl.SSLWantReadError:
                     return None
             except IOError as e:
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+'''
+on-disk cache of vehicle parameters
+
+Parameters are stored in index order, one file per system ID,
+component ID and firmware identity (board version, firmware version
+and git hash from AUTOPILOT_VERSION), with the parameter count and the
+_HASH_CHECK value if the autopilot gave one. Each parameter keeps its
+MAV_PARAM_TYPE so that integer parameters are set with the right type
+without fetching them first.
+
+AP_FLAKE8_CLEAN
+'''
+
+import json
+import os
+
+from MAVProxy.modules.lib import mp_util
+
+CACHE_VERSION = 2
+
+
+def identity_from_version(m):
+    '''firmware identity from an AUTOPILOT_VERSION message'''
+    custom = bytearray(m.flight_custom_version)
+    return (m.board_version, m.flight_sw_version, ''.join(['%02x' % b for b in custom]))
+
+
+def cache_dir():
+    path = mp_util.dot_mavproxy('param_cache')
+    mp_util.mkdir_p(path)
+    return path
+
+
+def cache_path(sysid, identity):
+    (board, fw, custom) = identity
+    return os.path.join(cache_dir(), "%u_%u_%08x_%08x_%s.json" % (sysid[0], sysid[1], board, fw, custom))
+
+
+def save(sysid, identity, count, param_hash, params):
+    '''store a list of (name, value, param_type) in index order'''
+    path = cache_path(sysid, identity)
+    tmpname = path + '.tmp'
+    data = {
+        'version': CACHE_VERSION,
+        'count': count,
+        'hash': param_hash,
+        'params': params,
+    }
+    try:
+        with open(tmpname, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmpname, path)
+    except (IOError, OSError, TypeError, ValueError) as ex:
+        print("Failed to save parameter cache %s: %s" % (path, ex))
+        return False
+    return True
+
+
+def load(sysid, identity):
+    '''return (count, hash, params) cached for a vehicle, or None'''
+    path = cache_path(sysid, identity)
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version', None) != CACHE_VERSION:
+        return None
+    params = data.get('params', None)
+    count = data.get('count', 0)
+    if not isinstance(params, list) or len(params) != count:
+        return None
+    if not all(isinstance(p, list) and len(p) == 3 for p in params):
+        return None
+    return (count, data.get('hash', None), params)
@@ -1,8 +1,143 @@
 import time, os
+import hashlib
+import pickle
 from pymavlink import mavutil, mavparm
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
+# bump when the ParamDoc layout changes so old indexes get rebuilt
+INDEX_VERSION = 1
+
+def parse_code(code):
+    '''value and bit codes are integers, but allow for floats'''
+    try:
+        return int(code)
+    except ValueError:
+        return float(code)
+
+class ParamDoc(object):
+    '''metadata for one parameter, precompiled from the XML'''
+    __slots__ = ['name', 'humanName', 'documentation', 'user', 'fields', 'values', 'bitmask', 'range']
+
+    def __init__(self, name, humanName, documentation, user=None):
+        self.name = name
+        self.humanName = humanName
+        self.documentation = documentation
+        self.user = user
+        # list of (name, text), in XML order
+        self.fields = []
+        # code -> description
+        self.values = {}
+        # bit number -> description, or None if not a bitmask
+        self.bitmask = None
+        # (min, max) from the Range field, or None
+        self.range = None
+
+    def get(self, attr, default=None):
+        '''attribute lookup in the style of the XML element this replaces'''
+        return getattr(self, attr, default)
+
+    def field(self, name):
+        '''text of the named field, or None'''
+        for (n, v) in self.fields:
+            if n == name:
+                return v
+        return None
+
+    def __str__(self):
+        ret = [self.name, str(self.humanName), str(self.documentation)]
+        ret.extend(["%s: %s" % f for f in self.fields])
+        ret.extend(["%s: %s" % (k, v) for (k, v) in self.values.items()])
+        if self.bitmask is not None:
+            ret.extend(["%s: %s" % (k, v) for (k, v) in self.bitmask.items()])
+        return '\n'.join(ret)
+
+def param_doc_from_element(name, p):
+    '''build a ParamDoc from a <param> element'''
+    doc = ParamDoc(name, p.get('humanName'), p.get('documentation'), p.get('user'))
+    for c in p:
+        if c.tag == 'field':
+            doc.fields.append((c.get('name'), c.text or ''))
+        elif c.tag == 'values':
+            for v in c:
+                doc.values[parse_code(v.get('code'))] = v.text or ''
+        elif c.tag == 'bitmask':
+            doc.bitmask = {}
+            for b in c:
+                doc.bitmask[int(b.get('code'))] = b.text or ''
+    if doc.bitmask is None:
+        # no "bitmask" subtree, split the traditional "Bitmask" field
+        field = doc.field('Bitmask')
+        if field is not None:
+            doc.bitmask = {}
+            for v in field.split(','):
+                a2 = v.split(':')
+                if len(a2) == 2:
+                    try:
+                        doc.bitmask[int(a2[0])] = a2[1]
+                    except ValueError:
+                        pass
+    field = doc.field('Range')
+    if field is not None:
+        a = field.split()
+        try:
+            doc.range = (float(a[0]), float(a[1]))
+        except (ValueError, IndexError):
+            pass
+    return doc
+
+def build_index(path):
+    '''parse a parameter XML file into a map of name to ParamDoc'''
+    from xml.etree import ElementTree
+    tree = ElementTree.parse(path).getroot()
+    htree = {}
+    vehicle = tree.find('vehicles/parameters')
+    if vehicle is not None:
+        for p in vehicle.findall('param'):
+            n = p.get('name').split(':')[1]
+            htree[n] = param_doc_from_element(n, p)
+    for lib in tree.findall('libraries/parameters'):
+        for p in lib.findall('param'):
+            n = p.get('name')
+            htree[n] = param_doc_from_element(n, p)
+    return htree
+
+def index_path(path):
+    '''where the precompiled index for an XML file lives'''
+    path = os.path.abspath(path)
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    idxdir = mp_util.dot_mavproxy('param_index')
+    mp_util.mkdir_p(idxdir)
+    return os.path.join(idxdir, "%s_%s.pickle" % (os.path.basename(path), digest))
+
+def load_index(path):
+    '''return the parameter metadata for an XML file, using the
+    precompiled index if it is up to date with the file and rebuilding
+    it otherwise'''
+    st = os.stat(path)
+    stamp = (INDEX_VERSION, st.st_mtime_ns, st.st_size)
+    ipath = index_path(path)
+    try:
+        with open(ipath, 'rb') as f:
+            (istamp, htree) = pickle.load(f)
+        if istamp == stamp:
+            return htree
+    except Exception:
+        pass
+    try:
+        htree = build_index(path)
+    except Exception as ex:
+        print("Failed to parse %s: %s" % (path, ex))
+        return None
+    try:
+        tmpname = ipath + '.tmp'
+        with open(tmpname, 'wb') as f:
+            pickle.dump((stamp, htree), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, ipath)
+    except (IOError, OSError) as ex:
+        print("Failed to save %s: %s" % (ipath, ex))
+    return htree
+
 class ParamHelp:
     def __init__(self):
         self.xml_filepath = None
@@ -67,18 +202,9 @@ class ParamHelp:
             if verbose:
                 print("Param XML (%s) does not exist" % path)
             return None
-        xml = open(path,'rb').read()
-        from lxml import objectify
-        objectify.enable_recursive_str()
-        tree = objectify.fromstring(xml)
-        htree = {}
-        for p in tree.vehicles.parameters.param:
-            n = p.get('name').split(':')[1]
-            htree[n] = p
-        for lib in tree.libraries.parameters:
-            for p in lib.param:
-                n = p.get('name')
-                htree[n] = p
+        htree = load_index(path)
+        if htree is None:
+            return None
         self.last_htree = htree
         self.last_pair = (self.xml_filepath, self.vehicle_name)
         return htree
@@ -106,38 +232,12 @@ class ParamHelp:
             print("%s" % (param,))
 
     def get_Values_from_help(self, help):
-        children = help.getchildren()
-        for c in children:
-            if str(c).startswith("values"):
-                return c.getchildren()
-        return []
+        '''map of value code to description'''
+        return help.values
 
     def get_bitmask_from_help(self, help):
-        # check for presence of "bitmask" subtree, use it by preference:
-        children = help.getchildren()
-        for c in children:
-            if str(c).startswith("bitmask"):
-                ret = {}
-                for entry in c.getchildren():
-                    ret[int(entry.get('code'))] = str(entry)
-                return ret
-
-        # "bitmask" subtree not present, split the traditional
-        # "Bitmask" field ourselves:
-        if not hasattr(help, 'field'):
-            return None
-        field = help.field
-        if not hasattr(field, 'attrib'):
-            return None
-        if field.attrib.get('name',None) != 'Bitmask':
-            return None
-        a = str(field).split(',')
-        ret = {}
-        for v in a:
-            a2 = v.split(':')
-            if len(a2) == 2:
-                ret[a2[0]] = a2[1]
-        return ret
+        '''map of bit number to description, or None if not a bitmask'''
+        return help.bitmask
 
     def param_info(self, param, value):
         '''return info string for a param value'''
@@ -165,10 +265,7 @@ class ParamHelp:
             print(e)
             pass
         try:
-            values = self.get_Values_from_help(help)
-            for v in values:
-                if int(v.get('code')) == int(value):
-                    return v
+            return self.get_Values_from_help(help).get(int(value), None)
         except Exception as e:
             pass
         return None
@@ -189,21 +286,18 @@ class ParamHelp:
                 help = htree[h]
                 print("%s: %s\n" % (h, help.get('humanName')))
                 print(help.get('documentation'))
-                try:
-                    print("\n")
-                    for f in help.field:
-                        if f.get('name') == 'Bitmask':
-                            # handled specially below
-                            continue
-                        print("%s : %s" % (f.get('name'), str(f)))
-                except Exception as e:
-                    pass
+                print("\n")
+                for (name, f) in help.fields:
+                    if name == 'Bitmask':
+                        # handled specially below
+                        continue
+                    print("%s : %s" % (name, f))
                 try:
                     values = self.get_Values_from_help(help)
                     if len(values):
                         print("\nValues: ")
-                        for v in values:
-                            print("\t%3u : %s" % (int(v.get('code')), str(v)))
+                        for (code, v) in values.items():
+                            print("\t%3u : %s" % (int(code), v))
                 except Exception as e:
                     print("Caught exception %s" % repr(e))
                     pass
@@ -241,17 +335,13 @@ class ParamHelp:
 
             # we'll ignore the Values field if there's a bitmask field
             # involved as they're usually just examples.
-            has_bitmask = False
-            for f in getattr(help, "field", []):
-                if f.get('name') == "Bitmask":
-                    has_bitmask = True
-                    break
+            has_bitmask = help.field("Bitmask") is not None
             if not has_bitmask:
                 values = self.get_Values_from_help(help)
                 if len(values) == 0:
                     # no prescribed values list
                     continue
-                value_values = [float(x.get("code")) for x in values]
+                value_values = [float(x) for x in values.keys()]
                 if value not in value_values:
                     print("%s: value %f not in Values (%s)" %
                           (param, value, str(value_values)))
@@ -260,3 +350,17 @@ class ParamHelp:
         if problems_found:
             print("Remember to `param download` before trusting the checking!  Also, remember that parameter documentation is for *master*!")
 
+
+if __name__ == "__main__":
+    import sys
+    # compare parsing the XML with loading the precompiled index
+    for path in sys.argv[1:]:
+        t0 = time.time()
+        htree = build_index(path)
+        t1 = time.time()
+        load_index(path)
+        t2 = time.time()
+        load_index(path)
+        t3 = time.time()
+        print("%s: %u params, parse %.3fs, index build %.3fs, index load %.3fs" % (
+            path, len(htree), t1-t0, t2-t1, t3-t2))
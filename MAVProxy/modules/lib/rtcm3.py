@@ -4,11 +4,44 @@
 RTCMv3_PREAMBLE = 0xD3
 POLYCRC24 = 0x1864CFB
 
+import collections
 import struct
 
+
+def make_crc_table():
+    '''table for byte at a time CRC24Q'''
+    table = []
+    for i in range(256):
+        crc = i << 16
+        for j in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= POLYCRC24
+        table.append(crc)
+    return tuple(table)
+
+CRC_TABLE = make_crc_table()
+
+
+def crc24(data):
+    '''calculate 24 bit crc of a bytes like object'''
+    table = CRC_TABLE
+    crc = 0
+    for b in memoryview(data).cast('B'):
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ b]
+    return crc
+
+
+def packet_ID(pkt):
+    '''return the message ID of a complete packet, or None'''
+    if pkt is None or len(pkt) < 8:
+        return None
+    id, = struct.unpack_from('>H', pkt, 3)
+    return id >> 4
+
+
 class RTCM3:
     def __init__(self, debug=False):
-        self.crc_table = None
         self.debug = debug
         self.reset()
 
@@ -18,91 +51,68 @@ class RTCM3:
 
     def get_packet_ID(self):
         '''get get of packet, or None'''
-        if self.parsed_pkt is None or len(self.parsed_pkt) < 8:
-            return None
-        id, = struct.unpack('>H', self.parsed_pkt[3:5])
-        id >>= 4
-        return id
+        return packet_ID(self.parsed_pkt)
 
     def reset(self):
         '''reset state'''
-        self.pkt = bytearray()
-        self.pkt_len = 0
+        self.buf = bytearray()
+        self.packets = collections.deque()
         self.parsed_pkt = None
+        self.discarded = 0
 
-    def parse(self):
-        '''parse packet'''
-        parity = self.pkt[-3:]
-        crc1 = parity[0] << 16 | parity[1] << 8 | parity[2]
-        crc2 = self.crc24(self.pkt[:-3])
-        if crc1 != crc2:
-            if self.debug:
-                print("crc fail len=%u" % len(self.pkt))
-            # look for preamble
-            idx = self.pkt[1:].find(bytearray([RTCMv3_PREAMBLE]))
-            if idx >= 0:
-                self.pkt = self.pkt[1+idx:]
-                if len(self.pkt) >= 3:
-                    self.pkt_len, = struct.unpack('>H', self.pkt[1:3])
-                    self.pkt_len &= 0x3ff
-                else:
-                    self.pkt_len = 0
-            else:
-                self.reset()
-            return False
-
-        # got a good packet
-        self.parsed_pkt = self.pkt
-        self.pkt = bytearray()
-        self.pkt_len = 0
-        return True
+    def crc24(self, bytes):
+        '''calculate 24 bit crc'''
+        return crc24(bytes)
+
+    def feed(self, data):
+        '''add a block of bytes, returning a list of complete packets.
+        Bytes that can't be part of a packet are counted in discarded'''
+        buf = self.buf
+        buf.extend(data)
+        ret = []
+        ofs = 0
+        n = len(buf)
+        mv = memoryview(buf)
+        while True:
+            idx = buf.find(RTCMv3_PREAMBLE, ofs)
+            if idx == -1:
+                self.discarded += n - ofs
+                ofs = n
+                break
+            self.discarded += idx - ofs
+            ofs = idx
+            if n - ofs < 3:
+                break
+            pkt_len = ((buf[ofs+1] << 8) | buf[ofs+2]) & 0x3ff
+            if pkt_len == 0:
+                ofs += 1
+                self.discarded += 1
+                continue
+            total = pkt_len + 6
+            if n - ofs < total:
+                break
+            crc1 = (buf[ofs+total-3] << 16) | (buf[ofs+total-2] << 8) | buf[ofs+total-1]
+            if crc1 != crc24(mv[ofs:ofs+total-3]):
+                if self.debug:
+                    print("crc fail len=%u" % total)
+                # resync on the next preamble
+                ofs += 1
+                self.discarded += 1
+                continue
+            ret.append(bytearray(mv[ofs:ofs+total]))
+            ofs += total
+        mv.release()
+        if ofs > 0:
+            del buf[:ofs]
+        return ret
 
     def read(self, byte):
-        '''read in one byte, return true if a full packet is available'''
-
-        #import random
-        #if random.uniform(0,1000) < 1:
-        #    return False
-
-        byte = ord(byte)
-        if len(self.pkt) == 0 and byte != RTCMv3_PREAMBLE:
-            # discard
+        '''read in one or more bytes, return true if a full packet is available'''
+        self.packets.extend(self.feed(byte))
+        if len(self.packets) == 0:
             return False
-
-        self.pkt.append(byte)
-        if self.pkt_len == 0 and len(self.pkt) >= 3:
-            self.pkt_len, = struct.unpack('>H', self.pkt[1:3])
-            self.pkt_len &= 0x3ff
-            if self.pkt_len == 0:
-                self.reset()
-                return False
-
-        if self.pkt_len > 0 and len(self.pkt) >= 3 + self.pkt_len + 3:
-            remainder = self.pkt[6+self.pkt_len:]
-            self.pkt = self.pkt[:6+self.pkt_len]
-            # got header, packet body and parity
-            ret = self.parse()
-            self.pkt.extend(remainder)
-            return ret
-
-        # need more bytes
-        return False
-
-    def crc24(self, bytes):
-        '''calculate 24 bit crc'''
-        if self.crc_table is None:
-            # initialise table
-            self.crc_table = [0] * 256
-            for i in range(256):
-                self.crc_table[i] = i<<16
-                for j in range(8):
-                    self.crc_table[i] <<= 1
-                    if (self.crc_table[i] & 0x1000000):
-                        self.crc_table[i] ^= POLYCRC24
-        crc = 0
-        for b in bytes:
-            crc = ((crc<<8)&0xFFFFFF) ^ self.crc_table[(crc>>16) ^ b]
-        return crc
+        self.parsed_pkt = self.packets.popleft()
+        return True
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
@@ -117,11 +127,11 @@ if __name__ == '__main__':
     rtcm3 = RTCM3(args.debug)
     f = open(args.filename, 'rb')
     while True:
-        b = f.read(1)
+        b = f.read(4096)
         if len(b) == 0:
             if args.follow:
                 time.sleep(0.1)
                 continue
             break
-        if rtcm3.read(b):
-            print("packet len %u ID %u" % (len(rtcm3.get_packet()), rtcm3.get_packet_ID()))
+        for pkt in rtcm3.feed(b):
+            print("packet len %u ID %u" % (len(pkt), packet_ID(pkt)))
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+'''
+GPS correction injection shared by the ntrip, DGPS and gpsinject modules
+
+Sources submit RTCM3 frames or other GPS data. A frame already sent
+from a different source within dedup_window seconds is dropped, while
+a source repeating its own frames is not. Frames queue
+by priority, chosen from the RTCM message ID, and a byte rate limit
+sends base station observations before slow changing ephemeris and
+station data on thin links. Frames that wait longer than max_age are
+dropped. RTCM frames are split into GPS_RTCM_DATA fragments with a
+sequence number shared by all sources, and sent to the master link, to
+all links or to a list of link numbers.
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import random
+import time
+
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import rtcm3
+
+RTCM_FRAGMENT_LEN = 180
+INJECT_DATA_LEN = 110
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+def default_priority(msg_id):
+    '''observations first, then station data, then ephemeris'''
+    if msg_id is None:
+        return PRIORITY_NORMAL
+    if 1001 <= msg_id <= 1004 or 1009 <= msg_id <= 1012 or 1071 <= msg_id <= 1137:
+        return PRIORITY_HIGH
+    if msg_id in (1019, 1020, 1041, 1042, 1044, 1045, 1046):
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
+
+
+def rtcm_fragments(data, seq):
+    '''split data into GPS_RTCM_DATA (flags, len, data) fragments'''
+    blen = len(data)
+    if blen > 4*RTCM_FRAGMENT_LEN:
+        raise ValueError("RTCM message too large: %u" % blen)
+    nfrags = max(1, (blen + RTCM_FRAGMENT_LEN - 1) // RTCM_FRAGMENT_LEN)
+    flags = (seq & 0x1F) << 3
+    if nfrags > 1:
+        flags |= 1
+    ret = []
+    for i in range(nfrags):
+        chunk = bytearray(data[i*RTCM_FRAGMENT_LEN:(i+1)*RTCM_FRAGMENT_LEN])
+        clen = len(chunk)
+        chunk.extend(bytearray(RTCM_FRAGMENT_LEN - clen))
+        ret.append((flags | (i << 1), clen, chunk))
+    if 1 < nfrags < 4 and blen % RTCM_FRAGMENT_LEN == 0:
+        # the receiver knows the last fragment by it being short
+        ret.append((flags | (nfrags << 1), 0, bytearray(RTCM_FRAGMENT_LEN)))
+    return ret
+
+
+class InjectStats(object):
+    '''counts and byte rates for one message ID'''
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.sent = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.last_len = 0
+        self.rate = 0.0
+        self.rate_bytes = 0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'bytes': self.bytes,
+            'sent': self.sent,
+            'duplicates': self.duplicates,
+            'dropped': self.dropped,
+            'last_len': self.last_len,
+            'rate': self.rate,
+        }
+
+
+class Frame(object):
+    '''a queued frame'''
+    def __init__(self, data, msg_id, source, kind, links, repeat, frag_drop_pct, target, max_age):
+        self.data = data
+        self.msg_id = msg_id
+        self.source = source
+        self.kind = kind
+        self.links = links
+        self.repeat = repeat
+        self.frag_drop_pct = frag_drop_pct
+        self.target = target
+        self.max_age = max_age
+        self.queued = time.time()
+
+    def stats_key(self):
+        if self.kind == 'rtcm':
+            return self.msg_id
+        return self.kind
+
+
+class RTCMInjector(object):
+    '''queue, shape and send GPS corrections to vehicle links'''
+    def __init__(self, mpstate):
+        self.mpstate = mpstate
+        self.settings = mp_settings.MPSettings(
+            [('rate_limit', int, 0),
+             ('dedup_window', float, 5.0),
+             ('max_age', float, 5.0)])
+        self.priorities = {}
+        self.queues = [collections.deque() for i in range(PRIORITY_LOW+1)]
+        self.seen = collections.OrderedDict()
+        self.seq = 0
+        self.tokens = 0.0
+        self.last_service = time.time()
+        self.last_rate = time.time()
+        self.stats = {}
+        self.bytes_sent = 0
+
+    def set_priority(self, msg_id, priority):
+        '''override the priority of an RTCM message ID, None restores the default'''
+        if priority is None:
+            self.priorities.pop(msg_id, None)
+        else:
+            self.priorities[msg_id] = max(PRIORITY_HIGH, min(PRIORITY_LOW, priority))
+
+    def priority(self, msg_id):
+        if msg_id in self.priorities:
+            return self.priorities[msg_id]
+        return default_priority(msg_id)
+
+    def get_stats(self, key):
+        if key not in self.stats:
+            self.stats[key] = InjectStats()
+        return self.stats[key]
+
+    def is_duplicate(self, data, source, now):
+        '''true if the same frame came from a different source within
+        dedup_window. A source repeating its own frames, such as the
+        station description every second, is never throttled'''
+        while self.seen:
+            (k, (ksource, t)) = next(iter(self.seen.items()))
+            if now - t <= self.settings.dedup_window:
+                break
+            self.seen.popitem(last=False)
+        key = bytes(data)
+        if key in self.seen and self.seen[key][0] != source:
+            return True
+        self.seen[key] = (source, now)
+        self.seen.move_to_end(key)
+        return False
+
+    def submit(self, data, source=None, links=None, repeat=1, frag_drop_pct=0):
+        '''submit one complete RTCM3 frame. Returns False if it was dropped'''
+        msg_id = rtcm3.packet_ID(data)
+        return self.enqueue(data, msg_id, source, 'rtcm', links, repeat, frag_drop_pct, None,
+                            dedup=True)
+
+    def submit_raw(self, data, source=None, links=None):
+        '''submit data that isn't RTCM3, sent as GPS_RTCM_DATA without deduplication'''
+        return self.enqueue(data, None, source, 'rtcm', links, 1, 0, None)
+
+    def submit_inject(self, data, target, source=None, links=None, priority=PRIORITY_LOW):
+        '''submit up to INJECT_DATA_LEN bytes for GPS_INJECT_DATA to target (sysid, compid)'''
+        return self.enqueue(data, None, source, 'inject', links, 1, 0, target,
+                            priority=priority, max_age=None)
+
+    def enqueue(self, data, msg_id, source, kind, links, repeat, frag_drop_pct, target,
+                dedup=False, priority=None, max_age=0):
+        now = time.time()
+        if max_age == 0:
+            max_age = self.settings.max_age
+        frame = Frame(data, msg_id, source, kind, links, repeat, frag_drop_pct, target, max_age)
+        st = self.get_stats(frame.stats_key())
+        st.count += 1
+        st.bytes += len(data)
+        st.rate_bytes += len(data)
+        st.last_len = len(data)
+        if kind == 'rtcm' and len(data) > 4*RTCM_FRAGMENT_LEN:
+            # can't send this with GPS_RTCM_DATA
+            st.dropped += 1
+            return False
+        if dedup and self.is_duplicate(data, source, now):
+            st.duplicates += 1
+            return False
+        if priority is None:
+            priority = self.priority(msg_id)
+        self.queues[priority].append(frame)
+        self.service()
+        return True
+
+    def select_links(self, links):
+        '''links is None for the master link, 'all', or a list of link numbers'''
+        if links is None:
+            return [self.mpstate.master()]
+        if links == 'all':
+            return self.mpstate.mav_master
+        return [self.mpstate.mav_master[i] for i in links if i < len(self.mpstate.mav_master)]
+
+    def wire_bytes(self, frame):
+        '''bytes of message payload a frame costs on the link'''
+        if frame.kind == 'inject':
+            return INJECT_DATA_LEN
+        nfrags = max(1, (len(frame.data) + RTCM_FRAGMENT_LEN - 1) // RTCM_FRAGMENT_LEN)
+        return nfrags * RTCM_FRAGMENT_LEN * frame.repeat
+
+    def send(self, frame):
+        '''send a frame on its links'''
+        links = self.select_links(frame.links)
+        if frame.kind == 'inject':
+            msg = bytearray(frame.data)
+            msg.extend(bytearray(INJECT_DATA_LEN - len(msg)))
+            for link in links:
+                link.mav.gps_inject_data_send(frame.target[0], frame.target[1], len(frame.data), msg)
+            return
+        fragments = rtcm_fragments(frame.data, self.seq)
+        self.seq += 1
+        for (flags, flen, chunk) in fragments:
+            for link in links:
+                for i in range(frame.repeat):
+                    if frame.frag_drop_pct > 0 and random.random() * 100 < frame.frag_drop_pct:
+                        continue
+                    link.mav.gps_rtcm_data_send(flags, flen, chunk)
+
+    def service(self):
+        '''send queued frames, highest priority first, within the rate limit'''
+        now = time.time()
+        dt = now - self.last_service
+        self.last_service = now
+        rate_limit = self.settings.rate_limit
+        # allow at most half a second of burst
+        burst = rate_limit * 0.5
+        if rate_limit > 0:
+            self.tokens = min(self.tokens + dt * rate_limit, burst)
+        for q in self.queues:
+            while q:
+                frame = q[0]
+                if frame.max_age is not None and now - frame.queued > frame.max_age:
+                    q.popleft()
+                    self.get_stats(frame.stats_key()).dropped += 1
+                    continue
+                cost = self.wire_bytes(frame)
+                if rate_limit > 0:
+                    if self.tokens < cost and self.tokens < burst:
+                        # wait for tokens, a frame bigger than the burst
+                        # goes once the bucket is full. Nothing of lower
+                        # priority goes ahead of it
+                        self.update_rates(now)
+                        return
+                    self.tokens -= cost
+                q.popleft()
+                self.send(frame)
+                self.bytes_sent += cost
+                self.get_stats(frame.stats_key()).sent += 1
+        self.update_rates(now)
+
+    def update_rates(self, now):
+        '''update the per ID byte rates once a second'''
+        dt = now - self.last_rate
+        if dt < 1:
+            return
+        self.last_rate = now
+        for st in self.stats.values():
+            st.rate = 0.9 * st.rate + 0.1 * st.rate_bytes / dt
+            st.rate_bytes = 0
+
+    def pending(self):
+        '''number of frames waiting to be sent'''
+        return sum([len(q) for q in self.queues])
+
+    def stats_dict(self):
+        '''statistics keyed by message ID'''
+        ret = {}
+        for (k, st) in self.stats.items():
+            ret[str(k)] = st.to_dict()
+        return ret
+
+    def status_lines(self):
+        '''text report of per ID statistics'''
+        lines = []
+        for k in sorted(self.stats.keys(), key=lambda x: str(x)):
+            st = self.stats[k]
+            lines.append(" %6s: %u (len %u) sent %u dup %u drop %u %.1f bytes/sec" % (
+                k, st.count, st.last_len, st.sent, st.duplicates, st.dropped, st.rate))
+        lines.append(" queued %u, sent %u bytes" % (self.pending(), self.bytes_sent))
+        return lines
+
+    def command(self, args):
+        '''handle an inject subcommand for a module'''
+        usage = "inject <status|set|priority ID <0|1|2|default>>"
+        if len(args) == 0:
+            print(usage)
+        elif args[0] == 'status':
+            for line in self.status_lines():
+                print(line)
+        elif args[0] == 'set':
+            self.settings.command(args[1:])
+        elif args[0] == 'priority':
+            if len(args) < 3:
+                for k in sorted(self.priorities.keys()):
+                    print(" %u: %u" % (k, self.priorities[k]))
+                return
+            if args[2] == 'default':
+                self.set_priority(int(args[1]), None)
+            else:
+                self.set_priority(int(args[1]), int(args[2]))
+        else:
+            print(usage)
+
+
+injectors = {}
+
+
+def shared_injector(mpstate):
+    '''the injector shared by all correction sources of an mpstate'''
+    if id(mpstate) not in injectors:
+        injectors[id(mpstate)] = RTCMInjector(mpstate)
+    return injectors[id(mpstate)]
+
+
+# sources with a links setting parse it the same way as the mocap bridge
+parse_links = mp_util.parse_links
@@ -19,8 +19,8 @@ import pickle
 import os.path
 import os
 import zipfile
-import array
 import math
+import numpy
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
@@ -327,6 +327,13 @@ class SRTMDownloader():
             pass
 
 
+def npy_cache_name(f):
+    """return the filename of the decompressed .npy cache for a tile zip"""
+    if f.endswith('.hgt.zip'):
+        return f[:-8] + '.npy'
+    return f + '.npy'
+
+
 class SRTMTile:
     """Base class for all SRTM tiles.
         Each SRTM tile is size x size pixels big and contains
@@ -334,26 +341,54 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+
+        The first time a tile is loaded it is decompressed into a native
+        endian .npy file next to the zip, later loads memory-map that file.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        npy = npy_cache_name(f)
+        self.data = None
+        try:
+            if os.path.getmtime(npy) >= os.path.getmtime(f):
+                self.data = numpy.load(npy, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            self.data = None
+        if self.data is None:
+            self.data = self.load_zip(f)
+            self.save_npy(npy)
+        self.size = self.data.shape[0]
+        if self.size not in (1201, 3601) or self.data.shape != (self.size, self.size):
+            raise InvalidTileError(lat, lon)
+
+    def load_zip(self, f):
+        """decompress a tile zip into a 2D array, row 0 is the north edge"""
         try:
             zipf = zipfile.ZipFile(f, 'r')
         except Exception:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         names = zipf.namelist()
         if len(names) != 1:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
+        size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
         # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+        if size not in (1201, 3601) or len(data) != 2 * size * size:
+            raise InvalidTileError(self.lat, self.lon)
+        # the file is big-endian, convert to native
+        return numpy.frombuffer(data, dtype='>i2').astype(numpy.int16).reshape(size, size)
+
+    def save_npy(self, npy):
+        """save the decompressed tile, then switch to a memory-mapped copy"""
+        try:
+            tmpname = npy + '.tmp.npy'
+            numpy.save(tmpname, self.data)
+            os.replace(tmpname, npy)
+            self.data = numpy.load(npy, mmap_mode='r')
+        except (IOError, OSError):
+            # read-only cache directory, keep the in-memory copy
+            pass
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -390,12 +425,7 @@ class SRTMTile:
     def getPixelValue(self, x, y):
         """Get the value of a pixel from the data, handling voids in the
             SRTM data."""
-        assert x < self.size, "x: %d<%d" % (x, self.size)
-        assert y < self.size, "y: %d<%d" % (y, self.size)
-        # Same as calcOffset, inlined for performance reasons
-        offset = x + self.size * (self.size - y - 1)
-        #print(offset)
-        value = self.data[offset]
+        value = int(self.data[self.size - y - 1, x])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
@@ -405,20 +435,16 @@ class SRTMTile:
         """Get the altitude of a lat lon pair, using the four neighbouring
             pixels for interpolation.
         """
-        # print("-----\nFromLatLon", lon, lat)
         lat -= self.lat
         lon -= self.lon
-        # print("lon, lat", lon, lat)
         if lat < 0.0 or lat >= 1.0 or lon < 0.0 or lon >= 1.0:
             raise WrongTileError(self.lat, self.lon, self.lat+lat, self.lon+lon)
         x = lon * (self.size - 1)
         y = lat * (self.size - 1)
-        # print("x,y", x, y)
         x_int = int(x)
         x_frac = x - int(x)
         y_int = int(y)
         y_frac = y - int(y)
-        # print("frac", x_int, x_frac, y_int, y_frac)
         value00 = self.getPixelValue(x_int, y_int)
         value10 = self.getPixelValue(x_int+1, y_int)
         value01 = self.getPixelValue(x_int, y_int+1)
@@ -426,10 +452,35 @@ class SRTMTile:
         value1 = self._avg(value00, value10, x_frac)
         value2 = self._avg(value01, value11, x_frac)
         value  = self._avg(value1,  value2, y_frac)
-        # print("%4d %4d | %4d\n%4d %4d | %4d\n-------------\n%4d" % (
-        #        value00, value10, value1, value01, value11, value2, value))
         return value
 
+    def getAltitudeArray(self, lats, lons):
+        """Get the altitudes for arrays of lat/lon, which must all lie
+            within this tile, with bilinear interpolation.
+        """
+        lats = numpy.asarray(lats, dtype=float) - self.lat
+        lons = numpy.asarray(lons, dtype=float) - self.lon
+        if numpy.any((lats < 0.0) | (lats >= 1.0) | (lons < 0.0) | (lons >= 1.0)):
+            raise WrongTileError(self.lat, self.lon, self.lat+lats.min(), self.lon+lons.min())
+        x = lons * (self.size - 1)
+        y = lats * (self.size - 1)
+        x_int = x.astype(numpy.intp)
+        y_int = y.astype(numpy.intp)
+        x_frac = x - x_int
+        y_frac = y - y_int
+        # data row 0 is the north edge
+        row = self.size - 1 - y_int
+        data = self.data
+        value00 = data[row, x_int].astype(float)
+        value10 = data[row, x_int+1].astype(float)
+        value01 = data[row-1, x_int].astype(float)
+        value11 = data[row-1, x_int+1].astype(float)
+        for v in (value00, value10, value01, value11):
+            v[v == -32768] = -1
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
@@ -439,6 +490,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return numpy.zeros(numpy.shape(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+'''
+batched telemetry log writer
+
+Packets are appended into preallocated chunk buffers rather than being
+queued one at a time. A writer thread calls service() to write full
+chunks to disk, rotating the log file by size or age and optionally
+compressing finished segments. The file format is unchanged, each
+segment is a normal tlog.
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import gzip
+import os
+import shutil
+import struct
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+timestamp_struct = struct.Struct('>Q')
+
+
+def compress_file(filename, method):
+    '''compress filename with method (gzip or zstd), removing the original.
+    Returns the compressed filename'''
+    if method == 'zstd' and zstandard is None:
+        print("zstandard not installed, using gzip for %s" % filename)
+        method = 'gzip'
+    if method == 'zstd':
+        outname = filename + '.zst'
+        with open(filename, 'rb') as fin, open(outname, 'wb') as fout:
+            with zstandard.ZstdCompressor().stream_writer(fout) as zout:
+                shutil.copyfileobj(fin, zout, 1 << 20)
+    else:
+        outname = filename + '.gz'
+        with open(filename, 'rb') as fin, gzip.open(outname, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+    os.unlink(filename)
+    return outname
+
+
+class TLogWriter(object):
+    '''append packets into chunk buffers, written out by service()'''
+    def __init__(self, chunk_size=65536, event=None):
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.event = event
+        if self.event is None:
+            self.event = threading.Event()
+        self.free = []
+        self.ready = collections.deque()
+        self.buf = bytearray(chunk_size)
+        self.ofs = 0
+        self.last_swap = time.time()
+        self.flush_every_packet = False
+        self.filename = None
+        self.file = None
+        self.segment = 0
+        self.segment_start = 0
+        self.segment_bytes = 0
+        self.bytes_written = 0
+
+    def _swap(self):
+        '''move the current buffer to the ready list. Called with lock held'''
+        if self.ofs == 0:
+            return
+        self.ready.append((self.buf, self.ofs))
+        if self.free:
+            self.buf = self.free.pop()
+        else:
+            self.buf = bytearray(self.chunk_size)
+        self.ofs = 0
+        self.last_swap = time.time()
+        self.event.set()
+
+    def _append(self, data, usec=None):
+        n = len(data)
+        if usec is not None:
+            n += 8
+        with self.lock:
+            if self.ofs + n > self.chunk_size:
+                self._swap()
+            if n > self.chunk_size:
+                # too big for a chunk, queue it on its own
+                if usec is not None:
+                    data = timestamp_struct.pack(usec) + bytes(data)
+                self.ready.append((bytes(data), n))
+                self.event.set()
+                return
+            ofs = self.ofs
+            if usec is not None:
+                timestamp_struct.pack_into(self.buf, ofs, usec)
+                ofs += 8
+            self.buf[ofs:ofs+len(data)] = data
+            self.ofs = ofs + len(data)
+            if self.flush_every_packet:
+                self._swap()
+
+    def put(self, data):
+        '''append raw bytes; compatible with the old log queue'''
+        self._append(data)
+
+    def write_packet(self, usec, msgbuf):
+        '''append a tlog record: 64 bit big-endian usec timestamp then the packet'''
+        self._append(msgbuf, usec=usec)
+
+    def segment_name(self, segment):
+        '''return the filename for a segment; the first keeps the original name'''
+        if segment == 0:
+            return self.filename
+        (root, ext) = os.path.splitext(self.filename)
+        return "%s.%03u%s" % (root, segment, ext)
+
+    def open(self, filename, mode='wb'):
+        '''open the log file, data put before this is kept'''
+        with self.file_lock:
+            self.filename = filename
+            self.file = open(filename, mode=mode)
+            self.segment = 0
+            self.segment_start = time.time()
+            self.segment_bytes = self.file.tell()
+
+    def rotate(self, compress=None):
+        '''start a new segment, compressing the finished one in the background'''
+        old_name = self.segment_name(self.segment)
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.segment_name(self.segment), mode='wb')
+        self.segment_start = time.time()
+        self.segment_bytes = 0
+        if compress in ['gzip', 'zstd']:
+            t = threading.Thread(target=compress_file, args=(old_name, compress), name='tlog_compress')
+            t.daemon = True
+            t.start()
+
+    def service(self, flush=False, interval=1.0, rotate_size=0, rotate_time=0, compress=None):
+        '''write out ready chunks. Partially filled chunks are written once
+        they are interval seconds old. rotate_size is in bytes and
+        rotate_time in seconds, zero disables rotation'''
+        with self.lock:
+            self.flush_every_packet = flush
+            if flush or time.time() - self.last_swap >= interval:
+                self._swap()
+            self.event.clear()
+        if self.file is None:
+            return
+        with self.file_lock:
+            wrote = False
+            while True:
+                with self.lock:
+                    if not self.ready:
+                        break
+                    (buf, n) = self.ready.popleft()
+                if self.segment_bytes > 0 and (
+                        (rotate_size > 0 and self.segment_bytes + n > rotate_size) or
+                        (rotate_time > 0 and time.time() - self.segment_start >= rotate_time)):
+                    self.rotate(compress)
+                self.file.write(memoryview(buf)[:n])
+                self.segment_bytes += n
+                self.bytes_written += n
+                wrote = True
+                if isinstance(buf, bytearray) and len(buf) == self.chunk_size:
+                    with self.lock:
+                        if len(self.free) < 8:
+                            self.free.append(buf)
+            if wrote and flush:
+                self.file.flush()
+
+    def close(self):
+        '''write everything out and close the file'''
+        self.service(interval=0)
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -3,10 +3,11 @@
 """
   MAVProxy message console, implemented in a child process
 """
+import collections
 import threading
 import sys, time
 
-from MAVProxy.modules.lib.wxconsole_util import Value, Text
+from MAVProxy.modules.lib.wxconsole_util import Value, Text, ValueBatch
 from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import multiproc
@@ -14,12 +15,19 @@ from MAVProxy.modules.lib import multiproc
 class MessageConsole(textconsole.SimpleConsole):
     '''
     a message console for MAVProxy
+
+    Status values are coalesced in the parent: only the latest value
+    for each name is kept, unchanged values are dropped, and pending
+    values are sent as one batch status_rate times a second. Text is
+    sent immediately and in order
     '''
     def __init__(self,
-                 title='MAVProxy: console'):
+                 title='MAVProxy: console',
+                 status_rate=10.0):
         textconsole.SimpleConsole.__init__(self)
         self.title = title
         self.menu_callback = None
+        self.status_rate = status_rate
         self.parent_pipe_recv,self.child_pipe_send = multiproc.Pipe(duplex=False)
         self.child_pipe_recv,self.parent_pipe_send = multiproc.Pipe(duplex=False)
         self.close_event = multiproc.Event()
@@ -28,9 +36,18 @@ class MessageConsole(textconsole.SimpleConsole):
         self.child.start()
         self.child_pipe_send.close()
         self.child_pipe_recv.close()
+        # parent only state, created after the child starts so it is
+        # never pickled
+        self.status_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.status_values = {}
+        self.status_pending = collections.OrderedDict()
         t = threading.Thread(target=self.watch_thread)
         t.daemon = True
         t.start()
+        t = threading.Thread(target=self.status_thread)
+        t.daemon = True
+        t.start()
 
     def child_task(self):
         '''child process - this holds all the GUI elements'''
@@ -60,29 +77,61 @@ class MessageConsole(textconsole.SimpleConsole):
         except EOFError:
             pass
 
+    def status_thread(self):
+        '''send pending status values at status_rate'''
+        while not self.close_event.is_set():
+            rate = self.status_rate
+            time.sleep(1.0/rate if rate > 0 else 0.1)
+            try:
+                self.flush_status()
+            except Exception:
+                break
+
+    def send(self, obj):
+        '''send an object to the child, one sender at a time'''
+        with self.send_lock:
+            self.parent_pipe_send.send(obj)
+
     def set_layout(self, layout):
         '''set window layout'''
-        self.parent_pipe_send.send(layout)
+        self.send(layout)
         
     def write(self, text, fg='black', bg='white'):
         '''write to the console'''
         try:
-            self.parent_pipe_send.send(Text(text, fg, bg))
+            self.send(Text(text, fg, bg))
         except Exception:
             pass
 
     def set_status(self, name, text='', row=0, fg='black', bg='white'):
         '''set a status value'''
+        key = (text, row, fg, bg)
+        with self.status_lock:
+            if self.status_values.get(name, None) == key:
+                return
+            self.status_values[name] = key
+            self.status_pending[name] = Value(name, text, row, fg, bg)
+        if self.status_rate <= 0:
+            self.flush_status()
+
+    def flush_status(self):
+        '''send all pending status values as one batch'''
+        with self.status_lock:
+            if len(self.status_pending) == 0:
+                return
+            values = list(self.status_pending.values())
+            self.status_pending.clear()
         if self.is_alive():
-            self.parent_pipe_send.send(Value(name, text, row, fg, bg))
+            self.send(ValueBatch(values))
 
     def set_menu(self, menu, callback):
         if self.is_alive():
-            self.parent_pipe_send.send(menu)
+            self.send(menu)
             self.menu_callback = callback
 
     def close(self):
         '''close the console'''
+        self.flush_status()
         self.close_event.set()
         if self.is_alive():
             self.child.join(2)
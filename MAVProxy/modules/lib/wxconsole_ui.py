@@ -3,7 +3,7 @@ import time
 import platform
 import socket
 from MAVProxy.modules.lib import mp_menu
-from MAVProxy.modules.lib.wxconsole_util import Value, Text
+from MAVProxy.modules.lib.wxconsole_util import Value, Text, ValueBatch
 from MAVProxy.modules.lib.wx_loader import wx
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import icon
@@ -89,6 +89,31 @@ class ConsoleFrame(wx.Frame):
             self.last_layout_send = now
             self.state.child_pipe_send.send(win_layout.get_wx_window_layout(self))
 
+    def set_value(self, obj):
+        '''set a status field, creating it if needed'''
+        if not obj.name in self.values:
+            # create a new status field
+            value = wx.StaticText(self.panel, -1, obj.text)
+            # possibly add more status rows
+            for i in range(len(self.status), obj.row+1):
+                self.status.append(wx.BoxSizer(wx.HORIZONTAL))
+                self.vbox.Insert(len(self.status)-1, self.status[i], 0, flag=wx.ALIGN_LEFT | wx.TOP)
+                self.vbox.Layout()
+            self.status[obj.row].Add(value, border=5)
+            self.status[obj.row].AddSpacer(20)
+            self.values[obj.name] = value
+        value = self.values[obj.name]
+        value.SetForegroundColour(obj.fg)
+        value.SetBackgroundColour(obj.bg)
+        # workaround wx bug on windows
+        value._foregroundColour = obj.fg
+        value.SetLabel(obj.text)
+        if platform.system() == 'Windows':
+            # more working around wx bugs in windows; without
+            # these the display does not update on colour change
+            value.Refresh()
+            value.Update()
+
     def on_timer(self, event):
         state = self.state
         if state.close_event.wait(0.001):
@@ -114,28 +139,12 @@ class ConsoleFrame(wx.Frame):
                 
             if isinstance(obj, Value):
                 # request to set a status field
-                if not obj.name in self.values:
-                    # create a new status field
-                    value = wx.StaticText(self.panel, -1, obj.text)
-                    # possibly add more status rows
-                    for i in range(len(self.status), obj.row+1):
-                        self.status.append(wx.BoxSizer(wx.HORIZONTAL))
-                        self.vbox.Insert(len(self.status)-1, self.status[i], 0, flag=wx.ALIGN_LEFT | wx.TOP)
-                        self.vbox.Layout()
-                    self.status[obj.row].Add(value, border=5)
-                    self.status[obj.row].AddSpacer(20)
-                    self.values[obj.name] = value
-                value = self.values[obj.name]
-                value.SetForegroundColour(obj.fg)
-                value.SetBackgroundColour(obj.bg)
-                # workaround wx bug on windows
-                value._foregroundColour = obj.fg
-                value.SetLabel(obj.text)
-                if platform.system() == 'Windows':
-                    # more working around wx bugs in windows; without
-                    # these the display does not update on colour change
-                    value.Refresh()
-                    value.Update()
+                self.set_value(obj)
+                self.panel.Layout()
+            elif isinstance(obj, ValueBatch):
+                # coalesced status fields, laid out once
+                for v in obj.values:
+                    self.set_value(v)
                 self.panel.Layout()
             elif isinstance(obj, Text):
                 '''request to add text to the console'''
@@ -6,6 +6,8 @@ support for a GCS attached DGPS system
 import socket, errno
 from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import rtcm3
+from MAVProxy.modules.lib import rtcm_inject
 
 class DGPSModule(mp_module.MPModule):
     def __init__(self, mpstate):
@@ -16,60 +18,35 @@ class DGPSModule(mp_module.MPModule):
         self.port.bind(("127.0.0.1", self.portnum))
         mavutil.set_close_on_exec(self.port.fileno())
         self.port.setblocking(0)
-        self.inject_seq_nr = 0
+        self.rtcm3 = rtcm3.RTCM3()
+        self.injector = rtcm_inject.shared_injector(mpstate)
+        self.add_command('dgps', self.cmd_dgps, "DGPS control", ["<inject> <status|set|priority>"])
         print("DGPS: Listening for RTCM packets on UDP://%s:%s" % ("127.0.0.1", self.portnum))
-    
-    def send_rtcm_msg(self, data):
-        msglen = 180;
-        
-        if (len(data) > msglen * 4):
-            print("DGPS: Message too large", len(data))
-            return
-        
-        # How many messages will we send?
-        msgs = 0
-        if (len(data) % msglen == 0):
-            msgs = len(data) // msglen
-        else:
-            msgs = (len(data) // msglen) + 1
-
-        for a in range(0, msgs):
-            
-            flags = 0
-            
-            # Set the fragment flag if we're sending more than 1 packet.
-            if (msgs) > 1:
-                flags = 1
-            
-            # Set the ID of this fragment
-            flags |= (a & 0x3) << 1
-            
-            # Set an overall sequence number
-            flags |= (self.inject_seq_nr & 0x1f) << 3
-            
-            
-            amount = min(len(data) - a * msglen, msglen)
-            datachunk = data[a*msglen : a*msglen + amount]
-
-            self.master.mav.gps_rtcm_data_send(
-                flags,
-                len(datachunk),
-                bytearray(datachunk.ljust(180, b'\0')))
-        
-        # Send a terminal 0-length message if we sent 2 or 3 exactly-full messages.     
-        if (msgs < 4) and (len(data) % msglen == 0) and (len(data) > msglen):
-            flags = 1 | (msgs & 0x3)  << 1 | (self.inject_seq_nr & 0x1f) << 3
-            self.master.mav.gps_rtcm_data_send(
-                flags,
-                0,
-                bytearray("".ljust(180, '\0')))
-            
-        self.inject_seq_nr += 1
 
+    def cmd_dgps(self, args):
+        '''dgps command handling'''
+        if len(args) > 0 and args[0] == "inject":
+            self.injector.command(args[1:])
+        else:
+            print("Usage: dgps inject <status|set|priority>")
 
+    def send_rtcm_msg(self, data):
+        '''pass RTCM3 frames to the injector, other data is sent as it is'''
+        if len(data) == 0:
+            return
+        if len(self.rtcm3.buf) == 0 and data[0] != rtcm3.RTCMv3_PREAMBLE:
+            # not RTCM3 and not the rest of a partial frame, eg. SBP or UBX
+            if len(data) > 180 * 4:
+                print("DGPS: Message too large", len(data))
+                return
+            self.injector.submit_raw(data, source='DGPS')
+            return
+        for pkt in self.rtcm3.feed(data):
+            self.injector.submit(pkt, source='DGPS')
 
     def idle_task(self):
         '''called in idle time'''
+        self.injector.service()
         try:
             data = self.port.recv(1024) # Attempt to read up to 1024 bytes.
         except socket.error as e:
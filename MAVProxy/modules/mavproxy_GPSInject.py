@@ -9,6 +9,7 @@ import os
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import rtcm_inject
 import urllib.request
 
 OFFLINE_MBX = "https://firmware.ardupilot.org/AssistNow/OFFLINE.UBX"
@@ -33,9 +34,11 @@ class GPSInjectModule(mp_module.MPModule):
         self.started = False
         self.start_pending = False
         self.last_send = None
+        self.injector = rtcm_inject.shared_injector(mpstate)
 
     def idle_task(self):
         '''called on idle'''
+        self.injector.service()
         if not self.started and not self.start_pending:
             return
         if self.buf is None:
@@ -81,11 +84,9 @@ class GPSInjectModule(mp_module.MPModule):
             n = min(max_send, len(self.buf) - self.sent_bytes)
             n = min(n, cansend)
             msg = self.buf[self.sent_bytes:self.sent_bytes+n]
-            self.master.mav.gps_inject_data_send(
-                self.target_system,
-                self.target_component,
-                len(msg),
-                bytearray(msg.ljust(max_send, bytes([0]))))
+            # queued behind RTCM corrections when the injector is rate limited
+            self.injector.submit_inject(msg, (self.target_system, self.target_component),
+                                        source='gpsinject')
             self.sent_bytes += n
             if self.sent_bytes == len(self.buf):
                 self.sent_bytes = 0
@@ -69,6 +69,8 @@ class ADSBVehicle(object):
 
 class ADSBModule(mp_module.MPModule):
 
+    mavlink_packet_types = frozenset(['ADSB_VEHICLE'])
+
     def __init__(self, mpstate):
         super(ADSBModule, self).__init__(mpstate, "adsb", "ADS-B data support", public = True)
         self.threat_vehicles = {}
@@ -43,6 +43,8 @@ arming_masks = {
 full_arming_mask = 0b1111111111111111111111110
 
 class ArmModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['HEARTBEAT'])
+
     def __init__(self, mpstate):
         super(ArmModule, self).__init__(mpstate, "arm", "arm/disarm handling", public=True)
         checkables = "<" + "|".join(arming_masks.keys()) + ">"
@@ -8,6 +8,8 @@ from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib.mp_settings import MPSetting
 
 class BatteryModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['BATTERY_STATUS', 'BATTERY2', 'POWER_STATUS'])
+
     def __init__(self, mpstate):
         super(BatteryModule, self).__init__(mpstate, "battery", "battery commands")
         self.add_command('bat', self.cmd_bat, "show battery information")
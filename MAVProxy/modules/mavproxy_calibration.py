@@ -7,6 +7,8 @@ from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_module
 
 class CalibrationModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['STATUSTEXT', 'MAG_CAL_PROGRESS', 'MAG_CAL_REPORT'])
+
     def __init__(self, mpstate):
         super(CalibrationModule, self).__init__(mpstate, "calibration")
         self.add_command('ground', self.cmd_ground,   'do a ground start')
@@ -642,27 +642,18 @@ class chat_openai():
         # get description
         param_desc_dict['description'] = param_info.get('documentation')
 
-        # iterate over fields to get units and range
-        param_fields = param_info.find('field')
-        if param_fields is not None:
-            for field in param_info.field:
-                field_name = field.get('name')
-                if field_name == 'Units':
-                    param_desc_dict['units'] = str(field)
-                if field_name == 'Range':
-                    if ' ' in str(field):
-                        param_desc_dict['min'] = str(field).split(' ')[0]
-                        param_desc_dict['max'] = str(field).split(' ')[1]
-
-        # iterate over values
-        param_values = param_info.find('values')
-        if param_values is not None:
-            param_value_dict = {}
-            for c in param_values.getchildren():
-                value_int = int(c.get('code'))
-                param_value_dict[value_int] = str(c)
-            if len(param_value_dict) > 0:
-                param_desc_dict['values'] = param_value_dict
+        # get units and range
+        units = param_info.field('Units')
+        if units is not None:
+            param_desc_dict['units'] = units
+        param_range = param_info.field('Range')
+        if param_range is not None and ' ' in param_range:
+            param_desc_dict['min'] = param_range.split(' ')[0]
+            param_desc_dict['max'] = param_range.split(' ')[1]
+
+        # get values
+        if len(param_info.values) > 0:
+            param_desc_dict['values'] = dict(param_info.values)
 
         # return dictionary
         return param_desc_dict
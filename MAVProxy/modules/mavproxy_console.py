@@ -11,6 +11,7 @@ from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib import textconsole
 from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_expression
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import wxsettings
@@ -22,8 +23,14 @@ class DisplayItem:
     def __init__(self, fmt, expression, row):
         self.expression = expression.strip('"\'')
         self.format = fmt.strip('"\'')
-        re_caps = re.compile('[A-Z_][A-Z0-9_]+')
-        self.msg_types = set(re.findall(re_caps, expression))
+        try:
+            self.compiled = mp_expression.compile_expression(self.expression)
+            self.msg_types = self.compiled.msg_types
+        except mp_expression.ExpressionError as ex:
+            print(ex)
+            self.compiled = None
+            re_caps = re.compile('[A-Z_][A-Z0-9_]+')
+            self.msg_types = set(re.findall(re_caps, expression))
         self.row = row
 
 class ConsoleModule(mp_module.MPModule):
@@ -79,6 +86,7 @@ class ConsoleModule(mp_module.MPModule):
 
         self.console_settings = mp_settings.MPSettings([
             ('debug_level', int, 0),
+            ('status_rate', float, 10.0),
         ])
 
         self.vehicle_list = []
@@ -163,6 +171,8 @@ class ConsoleModule(mp_module.MPModule):
     def cmd_set(self, args):
         '''set console options'''
         self.console_settings.command(args)
+        if isinstance(self.console, wxconsole.MessageConsole):
+            self.console.status_rate = self.console_settings.status_rate
 
     def remove_menu(self, menu):
         '''add a new menu'''
@@ -776,7 +786,9 @@ class ConsoleModule(mp_module.MPModule):
             if type in self.user_added[id].msg_types:
                 d = self.user_added[id]
                 try:
-                    val = mavutil.evaluate_expression(d.expression, self.master.messages)
+                    if d.compiled is None:
+                        raise mp_expression.ExpressionError(d.expression, "failed to compile")
+                    val = d.compiled.evaluate(self.master.messages)
                     console_string = d.format % val
                 except Exception as ex:
                     console_string = "????"
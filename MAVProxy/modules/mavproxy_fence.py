@@ -23,6 +23,8 @@ class FenceModule(mission_item_protocol.MissionItemProtocolModule):
     upload/download
     '''
 
+    mavlink_packet_types = mission_item_protocol.MissionItemProtocolModule.mavlink_packet_types | frozenset(['SYS_STATUS'])
+
     def __init__(self, mpstate):
         super(FenceModule, self).__init__(mpstate, "fence", "fence point management (new)", public=True)
         self.present = False
@@ -5,6 +5,9 @@ import io
 import time, os, sys
 import struct
 import random
+import posixpath
+import zlib
+from collections import deque, OrderedDict
 from pymavlink import mavutil
 
 try:
@@ -16,6 +19,7 @@ except ImportError:
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_util
 
 # opcodes
 OP_None = 0
@@ -94,13 +98,108 @@ class WriteQueue:
         self.size = size
         self.last_send = 0
 
+class ReadGaps:
+    '''gaps in a file being read, as (offset, length) tuples. Gaps with a
+    read outstanding are kept in the order the reads were sent so that
+    timeouts only need to look at the oldest'''
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.unsent = OrderedDict()
+
+    def __len__(self):
+        return len(self.pending) + len(self.unsent)
+
+    def __contains__(self, gap):
+        return gap in self.pending or gap in self.unsent
+
+    def add(self, gap):
+        self.unsent[gap] = 0
+
+    def remove(self, gap):
+        '''remove a filled gap, returning False if it was not a gap'''
+        if self.pending.pop(gap, None) is not None:
+            return True
+        return self.unsent.pop(gap, None) is not None
+
+    def sent(self, gap, t):
+        '''note that a read for a gap was sent at time t'''
+        self.unsent.pop(gap, None)
+        self.pending.pop(gap, None)
+        self.pending[gap] = t
+
+    def next_unsent(self):
+        for gap in self.unsent:
+            return gap
+        return None
+
+    def unsent_gaps(self):
+        return list(self.unsent.keys())
+
+    def expire(self, cutoff):
+        '''move reads sent before cutoff back to unsent, oldest first,
+        returning the number expired'''
+        count = 0
+        while len(self.pending) > 0:
+            (gap, t) = next(iter(self.pending.items()))
+            if t >= cutoff:
+                break
+            self.pending.pop(gap)
+            self.unsent[gap] = 0
+            self.unsent.move_to_end(gap, last=False)
+            count += 1
+        return count
+
+class FTPSync:
+    '''state of a sync of a remote directory tree to a local directory'''
+    def __init__(self, remote_dir, local_dir):
+        self.remote_dir = remote_dir.rstrip('/') or '/'
+        self.local_dir = local_dir
+        # remote directories still to list
+        self.dirs = deque([self.remote_dir])
+        # (remote, local, size) of files still to compare
+        self.files = deque()
+        self.stage = 'list'
+        # the directory or file the current list or crc request is for
+        self.current = None
+        self.retries = 0
+        self.unchanged = 0
+        self.fetched = 0
+        self.failed = 0
+        self.total_bytes = 0
+        # failed gets of each file, they are retried up to max_attempts
+        self.attempts = {}
+        self.max_attempts = 3
+        self.start = time.time()
+
+    def local_path(self, remote):
+        rel = posixpath.relpath(remote, self.remote_dir)
+        return os.path.join(self.local_dir, *rel.split('/'))
+
+def crc32_file(path):
+    '''CRC32 of a local file, as calculated by OP_CalcFileCRC32. This
+    is the plain table CRC32 with a zero seed and no final inversion'''
+    crc = 0
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(65536)
+                if len(buf) == 0:
+                    break
+                crc = zlib.crc32(buf, crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+    except (IOError, OSError):
+        return None
+    return crc
+
 class FTPModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['FILE_TRANSFER_PROTOCOL'])
+
     def __init__(self, mpstate):
         super(FTPModule, self).__init__(mpstate, "ftp", public=True)
         self.add_command('ftp', self.cmd_ftp, "file transfer",
                          ["<list|get|rm|rmdir|rename|mkdir|crc|cancel|status>",
                           "set (FTPSETTING)",
-                          "put (FILENAME) (FILENAME)"])
+                          "put (FILENAME) (FILENAME)",
+                          "sync"])
         self.ftp_settings = mp_settings.MPSettings(
             [('debug', int, 0),
              ('pkt_loss_tx', int, 0),
@@ -123,9 +222,13 @@ class FTPModule(mp_module.MPModule):
         self.put_callback = None
         self.put_callback_progress = None
         self.total_size = 0
-        self.read_gaps = []
-        self.read_gap_times = {}
+        self.read_gaps = ReadGaps()
         self.last_gap_send = 0
+        # gap reads allowed in flight after EOF, see update_gap_window()
+        self.gap_window = float(self.ftp_settings.max_backlog)
+        self.gap_loss = 0.0
+        self.read_packets = 0
+        self.read_lost = 0
         self.read_retries = 0
         self.read_total = 0
         self.duplicates = 0
@@ -148,10 +251,16 @@ class FTPModule(mp_module.MPModule):
         self.write_pending = 0
         self.write_last_send = None
         self.warned_component = False
+        self.list_callback = None
+        self.list_entries = None
+        self.crc_callback = None
+        self.sync = None
+        self.get_queue = deque()
+        self.queue_item = None
 
     def cmd_ftp(self, args):
         '''FTP operations'''
-        usage = "Usage: ftp <list|get|put|rm|rmdir|rename|mkdir|crc>"
+        usage = "Usage: ftp <list|get|put|rm|rmdir|rename|mkdir|crc|sync>"
         if len(args) < 1:
             print(usage)
             return
@@ -173,6 +282,8 @@ class FTPModule(mp_module.MPModule):
             self.cmd_mkdir(args[1:])
         elif args[0] == 'crc':
             self.cmd_crc(args[1:])
+        elif args[0] == 'sync':
+            self.cmd_sync(args[1:])
         elif args[0] == 'status':
             self.cmd_status()
         elif args[0] == 'cancel':
@@ -201,6 +312,11 @@ class FTPModule(mp_module.MPModule):
     def terminate_session(self):
         '''terminate current session'''
         self.send(FTP_OP(self.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
+        if self.queue_item is not None:
+            # a queued get that did not finish
+            item = self.queue_item
+            self.queue_item = None
+            self.queue_item_done(item, False, 0)
         self.fh = None
         self.filename = None
         self.write_list = None
@@ -215,9 +331,8 @@ class FTPModule(mp_module.MPModule):
         if self.put_callback_progress is not None:
             self.put_callback_progress(None)
             self.put_callback_progress = None
-        self.read_gaps = []
+        self.read_gaps = ReadGaps()
         self.read_total = 0
-        self.read_gap_times = {}
         self.last_read = None
         self.last_burst_read = None
         self.session = (self.session + 1) % 256
@@ -227,13 +342,18 @@ class FTPModule(mp_module.MPModule):
         if self.ftp_settings.debug > 0:
             print("Terminated session")
 
-    def cmd_list(self, args):
-        '''list files'''
+    def cmd_list(self, args, callback=None):
+        '''list files. With a callback the entries are passed to it as a
+        list of (type, name, size) instead of being printed, or None
+        on failure'''
         if len(args) > 0:
             dname = args[0]
         else:
             dname = '/'
-        print("Listing %s" % dname)
+        self.list_callback = callback
+        self.list_entries = []
+        if callback is None:
+            print("Listing %s" % dname)
         enc_dname = bytearray(dname, 'ascii')
         self.total_size = 0
         self.dir_offset = 0
@@ -242,6 +362,9 @@ class FTPModule(mp_module.MPModule):
 
     def handle_list_reply(self, op, m):
         '''handle OP_ListDirectory reply'''
+        if self.list_callback is not None and not self.is_reply_to_last_op(op):
+            # a late reply to a retried request
+            return
         if op.opcode == OP_Ack:
             dentries = sorted(op.payload.split(b'\x00'))
             #print(dentries)
@@ -257,21 +380,36 @@ class FTPModule(mp_module.MPModule):
                 except Exception:
                     continue
                 if d[0] == 'D':
-                    print(" D %s" % d[1:])
+                    if self.list_callback is not None:
+                        self.list_entries.append(('D', d[1:], 0))
+                    else:
+                        print(" D %s" % d[1:])
                 elif d[0] == 'F':
                     (name, size) = d[1:].split('\t')
                     size = int(size)
                     self.total_size += size
-                    print("   %s\t%u" % (name, size))
-                else:
+                    if self.list_callback is not None:
+                        self.list_entries.append(('F', name, size))
+                    else:
+                        print("   %s\t%u" % (name, size))
+                elif self.list_callback is None:
                     print(d)
             # ask for more
             more = self.last_op
             more.offset = self.dir_offset
             self.send(more)
         elif op.opcode == OP_Nack and len(op.payload) == 1 and op.payload[0] == ERR_EndOfFile:
-            print("Total size %.2f kByte" % (self.total_size / 1024.0))
+            if self.list_callback is not None:
+                callback = self.list_callback
+                self.list_callback = None
+                callback(self.list_entries)
+            else:
+                print("Total size %.2f kByte" % (self.total_size / 1024.0))
             self.total_size = 0
+        elif self.list_callback is not None:
+            callback = self.list_callback
+            self.list_callback = None
+            callback(None)
         else:
             print('LIST: %s' % op)
 
@@ -294,6 +432,10 @@ class FTPModule(mp_module.MPModule):
         self.read_retries = 0
         self.duplicates = 0
         self.reached_eof = False
+        self.gap_window = float(max(1, self.ftp_settings.max_backlog))
+        self.gap_loss = 0.0
+        self.read_packets = 0
+        self.read_lost = 0
         self.burst_size = self.ftp_settings.burst_read_size
         if self.burst_size < 1:
             self.burst_size = 239
@@ -344,7 +486,11 @@ class FTPModule(mp_module.MPModule):
                     print(self.fh.read().decode('utf-8'))
             else:
                 print("Wrote %u bytes to %s in %.2fs %.1fkByte/s" % (ofs, self.filename, dt, rate))
+            item = self.queue_item
+            self.queue_item = None
             self.terminate_session()
+            if item is not None:
+                self.queue_item_done(item, True, ofs)
             return True
         return False
 
@@ -382,9 +528,7 @@ class FTPModule(mp_module.MPModule):
             if op.offset < ofs:
                 # writing an earlier portion, possibly remove a gap
                 gap = (op.offset, len(op.payload))
-                if gap in self.read_gaps:
-                    self.read_gaps.remove(gap)
-                    self.read_gap_times.pop(gap)
+                if self.read_gaps.remove(gap):
                     if self.ftp_settings.debug > 0:
                         print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
                 else:
@@ -401,16 +545,17 @@ class FTPModule(mp_module.MPModule):
                 gap = (ofs, op.offset-ofs)
                 max_read = self.burst_size
                 while True:
+                    self.read_lost += 1
                     if gap[1] <= max_read:
-                        self.read_gaps.append(gap)
-                        self.read_gap_times[gap] = 0
+                        self.read_gaps.add(gap)
                         break
                     g = (gap[0], max_read)
-                    self.read_gaps.append(g)
-                    self.read_gap_times[g] = 0
+                    self.read_gaps.add(g)
                     gap = (gap[0] + max_read, gap[1] - max_read)
+                self.read_packets += 1
                 self.write_payload(op)
             else:
+                self.read_packets += 1
                 self.write_payload(op)
             if op.burst_complete:
                 if op.size > 0 and op.size < self.burst_size:
@@ -460,9 +605,8 @@ class FTPModule(mp_module.MPModule):
             self.backlog -= 1
         if op.opcode == OP_Ack and self.fh is not None:
             gap = (op.offset, op.size)
-            if gap in self.read_gaps:
-                self.read_gaps.remove(gap)
-                self.read_gap_times.pop(gap)
+            if self.read_gaps.remove(gap):
+                self.update_gap_window(0, 1)
                 ofs = self.fh.tell()
                 self.write_payload(op)
                 self.fh.seek(ofs)
@@ -671,30 +815,184 @@ class FTPModule(mp_module.MPModule):
         if op.opcode != OP_Ack:
             print("Create directory failed %s" % op)
 
-    def cmd_crc(self, args):
-        '''get crc'''
+    def cmd_crc(self, args, callback=None):
+        '''get crc. With a callback the crc is passed to it instead of
+        being printed, or None on failure'''
         if len(args) < 1:
             print("Usage: crc NAME")
             return
         name = args[0]
         self.filename = name
         self.op_start = time.time()
-        print("Getting CRC for %s" % name)
+        self.crc_callback = callback
+        if callback is None:
+            print("Getting CRC for %s" % name)
         enc_name = bytearray(name, 'ascii')
         op = FTP_OP(self.seq, self.session, OP_CalcFileCRC32, len(enc_name), 0, 0, 0, bytearray(enc_name))
         self.send(op)
 
     def handle_crc_reply(self, op, m):
         '''handle crc reply'''
-        if op.opcode == OP_Ack and op.size == 4:
+        if self.crc_callback is not None and not self.is_reply_to_last_op(op):
+            # a late reply to a retried request
+            return
+        if self.crc_callback is not None:
+            callback = self.crc_callback
+            self.crc_callback = None
+            if op.opcode == OP_Ack and op.size == 4:
+                callback(struct.unpack("<I", op.payload)[0])
+            else:
+                callback(None)
+        elif op.opcode == OP_Ack and op.size == 4:
             crc, = struct.unpack("<I", op.payload)
             now = time.time()
             print("crc: %s 0x%08x in %.1fs" % (self.filename, crc, now - self.op_start))
         else:
             print("crc failed %s" % op)
 
+    def is_reply_to_last_op(self, op):
+        '''check if a reply is for the last request sent'''
+        return self.last_op is not None and (op.seq - self.last_op.seq) % 256 == 1
+
+    def cmd_sync(self, args):
+        '''copy a remote directory tree to a local directory, skipping
+        files whose size and CRC already match'''
+        if len(args) < 2:
+            print("Usage: ftp sync REMOTE_DIR LOCAL_DIR")
+            return
+        if self.sync is not None:
+            print("sync already in progress")
+            return
+        self.sync = FTPSync(args[0], args[1])
+        print("Syncing %s to %s" % (self.sync.remote_dir, self.sync.local_dir))
+        self.sync_next()
+
+    def sync_next(self):
+        '''start the next list or crc request of a sync'''
+        sync = self.sync
+        sync.retries = 0
+        if sync.stage == 'list':
+            if len(sync.dirs) > 0:
+                sync.current = sync.dirs.popleft()
+                self.cmd_list([sync.current], callback=self.sync_list_reply)
+                return
+            sync.stage = 'compare'
+        if sync.stage == 'compare':
+            while len(sync.files) > 0:
+                (remote, local, size) = sync.files.popleft()
+                if not os.path.exists(local) or os.path.getsize(local) != size:
+                    self.get_queue.append((remote, local, size))
+                    continue
+                # same size, compare the CRC
+                sync.current = (remote, local, size)
+                self.cmd_crc([remote], callback=self.sync_crc_reply)
+                return
+            sync.current = None
+            sync.stage = 'transfer'
+            print("FTP sync: %u files to fetch, %u unchanged" % (len(self.get_queue), sync.unchanged))
+
+    def sync_list_reply(self, entries):
+        '''handle the listing of one directory of a sync'''
+        sync = self.sync
+        if sync is None or sync.stage != 'list':
+            return
+        if entries is None:
+            print("FTP sync: failed to list %s" % sync.current)
+            sync.failed += 1
+            entries = []
+        for (etype, name, size) in entries:
+            if name in ['.', '..'] or '/' in name:
+                continue
+            remote = posixpath.join(sync.current, name)
+            if etype == 'D':
+                sync.dirs.append(remote)
+            else:
+                sync.files.append((remote, sync.local_path(remote), size))
+        sync.current = None
+        self.sync_next()
+
+    def sync_crc_reply(self, crc):
+        '''handle the CRC of a remote file of the same size as the local copy'''
+        sync = self.sync
+        if sync is None or sync.stage != 'compare' or sync.current is None:
+            return
+        (remote, local, size) = sync.current
+        sync.current = None
+        if crc is not None and crc == crc32_file(local):
+            sync.unchanged += 1
+            if self.ftp_settings.debug > 0:
+                print("FTP sync: %s unchanged" % remote)
+        else:
+            self.get_queue.append((remote, local, size))
+        self.sync_next()
+
+    def queue_item_done(self, item, success, size):
+        '''note the end of a queued get'''
+        (remote, local, expected_size) = item
+        if self.sync is None:
+            return
+        if success:
+            self.sync.fetched += 1
+            self.sync.total_bytes += size
+        else:
+            attempts = self.sync.attempts.get(remote, 0) + 1
+            self.sync.attempts[remote] = attempts
+            if attempts < self.sync.max_attempts:
+                self.get_queue.append(item)
+                return
+            print("FTP sync: failed to fetch %s" % remote)
+            self.sync.failed += 1
+
+    def check_sync(self, now):
+        '''retry lost list and crc requests, and run the get queue'''
+        sync = self.sync
+        if sync is None:
+            return
+        timeout = max(1.0, 2*self.ftp_settings.retry_time)
+        if sync.stage == 'compare' and sync.current is not None:
+            # allow the autopilot time to read the file for the CRC
+            timeout += sync.current[2] / 200.0e3
+        if sync.current is not None and now - self.last_op_time > timeout:
+            sync.retries += 1
+            if sync.retries > 3:
+                print("FTP sync: no reply for %s" % str(sync.current))
+                if sync.stage == 'list':
+                    self.list_callback = None
+                    self.sync_list_reply(None)
+                else:
+                    self.crc_callback = None
+                    self.sync_crc_reply(None)
+                return
+            if self.ftp_settings.debug > 0:
+                print("FTP sync: retry %s" % str(sync.current))
+            self.send(self.last_op)
+        if sync.stage != 'transfer':
+            return
+        if self.queue_item is not None or self.fh is not None or self.write_list is not None:
+            return
+        if len(self.get_queue) > 0:
+            item = self.get_queue.popleft()
+            (remote, local, size) = item
+            dname = os.path.dirname(local)
+            if dname:
+                mp_util.mkdir_p(dname)
+            self.cmd_get([remote, local])
+            self.queue_item = item
+        else:
+            dt = time.time() - sync.start
+            print("FTP sync of %s complete: %u fetched (%u bytes), %u unchanged, %u failed in %.1fs" % (
+                sync.remote_dir, sync.fetched, sync.total_bytes, sync.unchanged, sync.failed, dt))
+            self.sync = None
+
     def cmd_cancel(self):
         '''cancel any pending op'''
+        if self.sync is not None or len(self.get_queue) > 0:
+            print("Cancelled sync with %u files queued" % len(self.get_queue))
+        self.sync = None
+        self.get_queue.clear()
+        self.queue_item = None
+        self.list_callback = None
+        self.crc_callback = None
         self.terminate_session()
 
     def cmd_status(self):
@@ -705,7 +1003,14 @@ class FTPModule(mp_module.MPModule):
             ofs = self.fh.tell()
             dt = time.time() - self.op_start
             rate = (ofs / dt) / 1024.0
-            print("Transfer at offset %u with %u gaps %u retries %.1f kByte/sec" % (ofs, len(self.read_gaps), self.read_retries, rate))
+            loss = 100.0 * self.read_lost / max(1, self.read_lost + self.read_packets)
+            print("Transfer at offset %u with %u gaps %u retries %.1f kByte/sec loss %.1f%% window %.1f" % (
+                ofs, len(self.read_gaps), self.read_retries, rate, loss, self.gap_window))
+        if self.sync is not None:
+            sync = self.sync
+            print("Sync of %s (%s): %u dirs to list, %u files to compare, %u queued, %u fetched, %u unchanged, %u failed" % (
+                sync.remote_dir, sync.stage, len(sync.dirs), len(sync.files), len(self.get_queue),
+                sync.fetched, sync.unchanged, sync.failed))
 
     def op_parse(self, m):
         '''parse a FILE_TRANSFER_PROTOCOL msg'''
@@ -771,45 +1076,54 @@ class FTPModule(mp_module.MPModule):
             print("Gap read of %u at %u rem=%u blog=%u" % (length, offset, len(self.read_gaps), self.backlog))
         read = FTP_OP(self.seq, self.session, OP_ReadFile, length, 0, 0, offset, None)
         self.send(read)
-        self.read_gaps.remove(g)
-        self.read_gaps.append(g)
         self.last_gap_send = time.time()
-        self.read_gap_times[g] = self.last_gap_send
+        self.read_gaps.sent(g, self.last_gap_send)
         self.backlog += 1
 
+    def update_gap_window(self, lost, received):
+        '''adapt the number of gap reads in flight to the measured loss.
+        A lost read holds its place in the window until retry_time
+        passes, so the window grows with loss to keep the reads flowing
+        at the same rate'''
+        for i in range(lost):
+            self.gap_loss = 0.9 * self.gap_loss + 0.1
+        for i in range(received):
+            self.gap_loss = 0.9 * self.gap_loss
+        base = max(1, self.ftp_settings.max_backlog)
+        extra = self.gap_loss * self.ftp_settings.retry_time / 0.05
+        self.gap_window = min(base + extra, 4.0 * base)
+
     def check_read_send(self):
-        '''see if we should send another gap read'''
+        '''see if we should send more gap reads'''
         if len(self.read_gaps) == 0:
             return
-        g = self.read_gaps[0]
         now = time.time()
-        dt = now - self.read_gap_times[g]
         if not self.reached_eof:
             # send gap reads once
-            for g in self.read_gap_times.keys():
-                if self.read_gap_times[g] == 0:
-                    self.send_gap_read(g)
-            return
-        if self.read_gap_times[g] > 0 and dt > self.ftp_settings.retry_time:
-            if self.backlog > 0:
-                self.backlog -= 1
-            self.read_gap_times[g] = 0
-
-        if self.read_gap_times[g] != 0:
-            # still pending
-            return
-        if not self.reached_eof and self.backlog >= self.ftp_settings.max_backlog:
-            # don't fill queue too far until we have got past the burst
+            self.gap_loss = self.read_lost / float(max(1, self.read_lost + self.read_packets))
+            self.update_gap_window(0, 0)
+            for g in self.read_gaps.unsent_gaps():
+                self.send_gap_read(g)
             return
+        expired = self.read_gaps.expire(now - self.ftp_settings.retry_time)
+        if expired > 0:
+            self.backlog = max(0, self.backlog - expired)
+            self.update_gap_window(expired, 0)
         if now - self.last_gap_send < 0.05:
             # don't send too fast
             return
-        self.send_gap_read(g)
+        while self.backlog < int(self.gap_window):
+            g = self.read_gaps.next_unsent()
+            if g is None:
+                break
+            self.send_gap_read(g)
 
     def idle_task(self):
         '''check for file gaps and lost requests'''
         now = time.time()
 
+        self.check_sync(now)
+
         # see if we lost an open reply
         if self.op_start is not None and now - self.op_start > 1.0 and self.last_op.opcode == OP_OpenFileRO:
             self.op_start = now
@@ -4,10 +4,10 @@
   uses lib/live_graph.py for display
 """
 
-from pymavlink import mavutil
 import re, os, sys
 
 from MAVProxy.modules.lib import live_graph
+from MAVProxy.modules.lib import mp_expression
 
 from MAVProxy.modules.lib import mp_module
 
@@ -74,16 +74,18 @@ class GraphModule(mp_module.MPModule):
             g.close()
         self.graphs = []
 
-    def mavlink_packet(self, msg):
-        '''handle an incoming mavlink packet'''
-
-        # check for any closed graphs
+    def idle_task(self):
+        '''check for closed graphs and send any values held back by batching'''
         for i in range(len(self.graphs) - 1, -1, -1):
             if not self.graphs[i].is_alive():
                 self.graphs[i].close()
                 self.graphs.pop(i)
+        for g in self.graphs:
+            if g.livegraph is not None:
+                g.livegraph.flush()
 
-        # add data to the rest
+    def mavlink_packet(self, msg):
+        '''handle an incoming mavlink packet'''
         for g in self.graphs:
             g.add_mavlink_packet(msg)
 
@@ -96,8 +98,6 @@ class Graph():
     '''a graph instance'''
     def __init__(self, state, fields):
         self.fields = fields[:]
-        self.field_types = []
-        self.msg_types = set()
         self.state = state
 
         for i in range(len(self.fields)):
@@ -107,10 +107,6 @@ class Graph():
                 self.fields[i] = "NAMED_VALUE_FLOAT['%s'].%s" % (m.group(1), m.group(2))
 
         re_caps = re.compile('[A-Z_][A-Z0-9_]+')
-        for f in self.fields:
-            caps = set(re.findall(re_caps, f))
-            self.msg_types = self.msg_types.union(caps)
-            self.field_types.append(caps)
         print("Adding graph: %s" % self.fields)
 
         fields = [ self.pretty_print_fieldname(x) for x in self.fields ]
@@ -127,6 +123,20 @@ class Graph():
 
         self.fields = fields[:]
         self.values = [None] * len(self.fields)
+        self.expressions = []
+        self.field_types = []
+        self.msg_types = set()
+        for f in self.fields:
+            try:
+                e = mp_expression.compile_expression(f)
+                caps = e.msg_types
+            except mp_expression.ExpressionError as ex:
+                print("Bad graph expression: %s" % ex.reason)
+                e = None
+                caps = set(re.findall(re_caps, f))
+            self.expressions.append(e)
+            self.msg_types = self.msg_types.union(caps)
+            self.field_types.append(caps)
         self.livegraph = live_graph.LiveGraph(fields,
                                               timespan=state.timespan,
                                               tickresolution=state.tickresolution,
@@ -159,8 +169,10 @@ class Graph():
         for i in range(len(self.fields)):
             if mtype not in self.field_types[i]:
                 continue
-            f = self.fields[i]
-            self.values[i] = mavutil.evaluate_expression(f, self.state.master.messages)
+            e = self.expressions[i]
+            if e is None:
+                continue
+            self.values[i] = e.value(self.state.master.messages)
             if self.values[i] is not None:
                 have_value = True
         if have_value and self.livegraph is not None:
@@ -16,7 +16,6 @@ import fnmatch
 import json
 import math
 import os
-import struct
 import sys
 import time
 import traceback
@@ -26,9 +25,15 @@ if sys.version_info[0] >= 3:
 else:
     import StringIO
 
+from MAVProxy.modules.lib import mavframer
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
 
+try:
+    from wsproto.connection import ConnectionState
+except ImportError:
+    ConnectionState = None
+
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import MPMenuCallTextDialog
     from MAVProxy.modules.lib.mp_menu import MPMenuSubMenu
@@ -54,6 +59,34 @@ activityPackets = frozenset([
     'SYS_STATUS',
 ])
 radioStatusPackets = frozenset(['RADIO', 'RADIO_STATUS'])
+# message types which are always decoded by the fast forwarding path,
+# as the link handling and the status cache rely on them, and modules
+# read the latest copy from master.messages
+fastfwdPackets = frozenset([
+    'ATTITUDE',
+    'COMMAND_ACK',
+    'COMPASSMOT_STATUS',
+    'GIMBAL_REPORT',
+    'GLOBAL_POSITION_INT',
+    'GOPRO_HEARTBEAT',
+    'GPS2_RAW',
+    'GPS_RAW',
+    'GPS_RAW_INT',
+    'HEARTBEAT',
+    'HIGH_LATENCY2',
+    'HOME_POSITION',
+    'MISSION_ACK',
+    'MISSION_CURRENT',
+    'NAV_CONTROLLER_OUTPUT',
+    'PARAM_VALUE',
+    'RC_CHANNELS',
+    'SIMSTATE',
+    'STATUSTEXT',
+    'SYS_STATUS',
+    'TERRAIN_REPORT',
+    'TIMESYNC',
+    'VFR_HUD',
+])
 
 preferred_ports = [
     '*FTDI*',
@@ -74,8 +107,42 @@ preferred_ports = [
 ]
 
 
+def build_dispatch_table(modules):
+    '''return (table, default) where table maps msgid to the list of
+    modules to pass that message to, and default is the list for msgids
+    not in table. Modules which don't override mavlink_packet are left out'''
+    catch_all = []
+    wanted = []
+    for mod in modules:
+        if type(mod).mavlink_packet is mp_module.MPModule.mavlink_packet:
+            continue
+        types = getattr(mod, 'mavlink_packet_types', None)
+        if types is None:
+            catch_all.append(mod)
+            wanted.append((mod, None))
+            continue
+        msgids = set()
+        for t in types:
+            msgid = mavframer.message_id(t)
+            if msgid is not None:
+                msgids.add(msgid)
+        wanted.append((mod, msgids))
+    table = {}
+    for (mod, msgids) in wanted:
+        if msgids is None:
+            continue
+        for msgid in msgids:
+            if msgid not in table:
+                # keep the modules in load order
+                table[msgid] = [m for (m, ids) in wanted if ids is None or msgid in ids]
+    return (table, catch_all)
+
+
 class LinkModule(mp_module.MPModule):
 
+    # the link module sees every message in master_callback
+    mavlink_packet_types = frozenset()
+
     def __init__(self, mpstate):
         super(LinkModule, self).__init__(mpstate, "link", "link control", public=True, multi_vehicle=True)
         self.add_command('link', self.cmd_link, "link control",
@@ -102,6 +169,8 @@ class LinkModule(mp_module.MPModule):
         self.datarate_logging_timer = mavutil.periodic_event(1)
         self.old_streamrate = 0
         self.old_streamrate2 = 0
+        self.fastfwd_decode_ids = None
+        (self.dispatch_table, self.dispatch_default) = ({}, [])
 
         # a list of TimeSync requests which are listening for and
         # sending TIMESYNC messages at the moment:
@@ -548,7 +617,7 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.write_packet(usec, m.get_msgbuf())
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -1010,7 +1079,7 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.write_packet(usec, m.get_msgbuf())
 
         # keep the last message of each type around
         self.status.msgs[mtype] = m
@@ -1053,20 +1122,19 @@ class LinkModule(mp_module.MPModule):
             # GCS
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if mtype not in self.no_fwd_types:
-                    for r in self.mpstate.mav_outputs:
-                        if hasattr(r, 'ws') and r.ws is not None:
-                            from wsproto.connection import ConnectionState
-                            if r.ws.state != ConnectionState.OPEN:  # Ensure Websocket handshake is done
-                                continue
-                        r.write(m.get_msgbuf())
+                    mbuf = m.get_msgbuf()
+                    for r in self.forward_outputs():
+                        r.write(mbuf)
 
             sysid = m.get_srcSystem()
             target_sysid = self.target_system
+            if self.mpstate.settings.modstats:
+                stats = self.mpstate.module_stats
+            else:
+                stats = None
 
-            # pass to modules
-            for (mod, pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            # pass to modules which want this message type
+            for mod in self.dispatch_table.get(m.get_msgId(), self.dispatch_default):
                 # Do not send other-system-or-component heartbeat packets to non-multi-vehicle modules
                 if not self.message_is_from_primary_vehicle(m) and not mod.multi_vehicle and mtype == 'HEARTBEAT':
                     continue
@@ -1079,9 +1147,13 @@ class LinkModule(mp_module.MPModule):
                         # only pass packets not from our target to modules that
                         # have marked themselves as being multi-vehicle capable
                         continue
+                if stats is not None:
+                    t0 = time.perf_counter()
+                exception = False
                 try:
                     mod.mavlink_packet(m)
                 except Exception as msg:
+                    exception = True
                     exc_type, exc_value, exc_traceback = sys.exc_info()
                     if self.mpstate.settings.moddebug > 3:
                         traceback.print_exception(
@@ -1095,6 +1167,115 @@ class LinkModule(mp_module.MPModule):
                                                   limit=2, file=sys.stdout)
                     elif self.mpstate.settings.moddebug == 1:
                         print(msg)
+                if stats is not None:
+                    stats.record(mod.name, 'mavlink_packet', time.perf_counter() - t0, exception=exception)
+
+    def forward_outputs(self):
+        '''return the outputs which are ready to have packets forwarded to them'''
+        ret = []
+        for r in self.mpstate.mav_outputs:
+            if getattr(r, 'ws', None) is not None and ConnectionState is not None:
+                if r.ws.state != ConnectionState.OPEN:  # Ensure Websocket handshake is done
+                    continue
+            ret.append(r)
+        return ret
+
+    def rebuild_dispatch_table(self):
+        '''rebuild the msgid -> modules table used to deliver packets to
+        modules, and the msgids the fast forwarding path must decode'''
+        (self.dispatch_table, self.dispatch_default) = build_dispatch_table(
+            [mod for (mod, pm) in self.mpstate.modules])
+        if len(self.dispatch_default) > 0:
+            # some module wants everything
+            self.fastfwd_decode_ids = None
+            return
+        self.fastfwd_decode_ids = set(self.dispatch_table.keys())
+        for t in fastfwdPackets:
+            msgid = mavframer.message_id(t)
+            if msgid is not None:
+                self.fastfwd_decode_ids.add(msgid)
+
+    def master_decode_buffer(self, master, buf):
+        '''parse buf with the full parser, which calls master_callback'''
+        try:
+            master.mav.parse_buffer(buf)
+        except mavutil.mavlink.MAVError as e:
+            self.status.mav_error += 1
+            if self.mpstate.settings.moddebug > 1:
+                print("MAV error: %s" % e)
+
+    def master_fastpath(self, master, buf):
+        '''process raw bytes from master, only decoding messages somebody
+        is interested in and forwarding the rest as the original bytes'''
+        framer = getattr(master, 'framer', None)
+        if framer is None:
+            framer = mavframer.MAVFramer()
+            master.framer = framer
+        decode_ids = self.fastfwd_decode_ids
+        if self.status.watch is not None:
+            # watch patterns are matched against decoded messages
+            decode_ids = None
+        crc_errors = framer.crc_errors
+        frames = framer.push(buf)
+        self.status.mav_error += framer.crc_errors - crc_errors
+        master.mav.total_bytes_received += len(buf)
+        outputs = self.forward_outputs()
+        for f in frames:
+            if f.msgid is None:
+                # noise or a message we can't check; use the full parser
+                self.master_decode_buffer(master, f.buf)
+                continue
+            if decode_ids is None or f.msgid in decode_ids:
+                master.mav.total_packets_received += 1
+                try:
+                    m = master.mav.decode(bytearray(f.buf))
+                except mavutil.mavlink.MAVError:
+                    self.status.mav_error += 1
+                    continue
+                self.master_callback(m, master)
+                continue
+            self.master_forward_frame(master, f, outputs)
+
+    def master_forward_frame(self, master, f, outputs):
+        '''handle an undecoded frame, keeping the link accounting that
+        master_callback and post_message would do'''
+        master.mav.total_packets_received += 1
+        sysid = f.srcSystem
+        if sysid in self.mpstate.sysid_outputs:
+            self.mpstate.sysid_outputs[sysid].write(f.buf)
+            return
+        self.status.counters['MasterIn'][master.linknum] += 1
+
+        # packet loss accounting, as done in mavutil post_message
+        src_tuple = (sysid, f.srcComponent)
+        if src_tuple != (ord('3'), ord('D')):
+            last_seq = master.last_seq.get(src_tuple, -1)
+            seq = (last_seq+1) % 256
+            if seq != f.seq and last_seq != -1:
+                master.mav_loss += (f.seq - seq) % 256
+            master.last_seq[src_tuple] = f.seq
+            master.mav_count += 1
+
+        mtype = mavframer.message_name(f.msgid)
+        if self.mpstate.logqueue:
+            usec = self.get_usec()
+            usec = (usec & ~3) | master.linknum
+            self.mpstate.logqueue.write_packet(usec, f.buf)
+
+        if mtype not in self.status.msg_count:
+            self.status.msg_count[mtype] = 0
+        self.status.msg_count[mtype] += 1
+
+        if master.link_delayed and self.mpstate.settings.checkdelay:
+            # don't process delayed packets that cause double reporting
+            if mtype in delayedPackets:
+                return
+        if not self.mpstate.settings.mavfwd_rate and mtype == 'REQUEST_DATA_STREAM':
+            return
+        if mtype in self.no_fwd_types:
+            return
+        for r in outputs:
+            r.write(f.buf)
 
     def cmd_vehicle(self, args):
         '''handle vehicle commands'''
@@ -1175,3 +1356,39 @@ class LinkModule(mp_module.MPModule):
 def init(mpstate):
     '''initialise module'''
     return LinkModule(mpstate)
+
+
+if __name__ == '__main__':
+    # benchmark per-message module dispatch cost as the number of
+    # loaded modules grows, with and without declared message types
+    import timeit
+
+    class CatchAllModule(mp_module.MPModule):
+        def __init__(self, want):
+            self.want = want
+
+        def mavlink_packet(self, m):
+            if m.get_type() == self.want:
+                pass
+
+    class DeclaredModule(CatchAllModule):
+        def __init__(self, want):
+            super(DeclaredModule, self).__init__(want)
+            self.mavlink_packet_types = frozenset([want])
+
+    mav = mavutil.mavlink.MAVLink(None)
+    msg = mav.decode(bytearray(mav.attitude_encode(0, 0, 0, 0, 0, 0, 0).pack(mav)))
+    others = ['GPS_RAW_INT', 'VFR_HUD', 'SYS_STATUS', 'RC_CHANNELS', 'BATTERY_STATUS']
+    count = 20000
+    print("modules  catch-all(us/msg)  declared(us/msg)")
+    for nmods in 5, 10, 20, 40, 80:
+        wants = ['ATTITUDE'] + [others[i % len(others)] for i in range(nmods-1)]
+        results = []
+        for cls in CatchAllModule, DeclaredModule:
+            (table, default) = build_dispatch_table([cls(w) for w in wants])
+
+            def dispatch():
+                for mod in table.get(msg.get_msgId(), default):
+                    mod.mavlink_packet(msg)
+            results.append(1.0e6 * timeit.timeit(dispatch, number=count) / count)
+        print("%7u  %17.2f  %16.2f" % (nmods, results[0], results[1]))
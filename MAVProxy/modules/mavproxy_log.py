@@ -8,25 +8,33 @@ import os
 import time
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib.log_download import WindowedDownload
 
 
 class LogModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['LOG_ENTRY', 'LOG_DATA'])
+
     def __init__(self, mpstate):
         super(LogModule, self).__init__(mpstate, "log", "log transfer")
-        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
+        self.log_settings = mp_settings.MPSettings(
+            [('window', int, 64),
+             ('window_max', int, 2048),
+             ('links', str, 'master'),
+             ('resume', bool, True)])
+        self.add_command('log', self.cmd_log, "log file handling",
+                         ['<download|status|erase|resume|cancel|list>',
+                          'set (LOGSETTING)'])
+        self.add_completion_function('(LOGSETTING)', self.log_settings.completion)
         self.reset()
 
     def reset(self):
-        self.download_set = set()
-        self.download_file = None
+        self.download = None
         self.download_lognum = None
         self.download_filename = None
-        self.download_start = None
-        self.download_last_timestamp = None
-        self.download_ofs = 0
-        self.retries = 0
         self.entries = {}
         self.download_queue = []
+        self.link_idx = 0
         self.last_status = time.time()
 
     def mavlink_packet(self, m):
@@ -50,110 +58,109 @@ class LogModule(mp_module.MPModule):
 
     def handle_log_data(self, m):
         '''handling incoming log data'''
-        if self.download_file is None:
+        dl = self.download
+        if dl is None or m.id != dl.lognum:
             return
-        # lose some data
-        # import random
-        # if random.uniform(0,1) < 0.05:
-        #    print('dropping ', str(m))
-        #    return
-        if m.ofs != self.download_ofs:
-            self.download_file.seek(m.ofs)
-            self.download_ofs = m.ofs
-        if m.count != 0:
-            s = bytearray(m.data[:m.count])
-            self.download_file.write(s)
-            self.download_set.add(m.ofs // 90)
-            self.download_ofs += m.count
-        self.download_last_timestamp = time.time()
-        if m.count == 0 or (m.count < 90 and len(self.download_set) == 1 + (m.ofs // 90)):
-            dt = time.time() - self.download_start
-            self.download_file.close()
-            size = os.path.getsize(self.download_filename)
-            speed = size / (1000.0 * dt)
-            status = (
-                f"Finished downloading {self.download_filename} " +
-                f"({size} bytes {dt:0.1f} seconds, " +
-                f"{speed:.1f} kbyte/sec " +
-                f"{self.retries} retries)"
-            )
-            self.console.set_status('LogDownload', status, row=4)
-            print(status)
-            self.download_file = None
-            self.download_filename = None
-            self.download_set = set()
-            self.master.mav.log_request_end_send(
-                self.target_system,
-                self.target_component
-            )
-            if len(self.download_queue):
-                self.log_download_next()
+        if dl.handle_data(m.ofs, m.count, m.data):
+            self.log_download_finished()
+            return
+        self.send_requests()
         self.update_status()
 
-    def handle_log_data_missing(self):
-        '''handling missing incoming log data'''
-        if len(self.download_set) == 0:
+    def request_links(self):
+        '''links to send LOG_REQUEST_DATA on'''
+        links = self.log_settings.links
+        if links == 'all':
+            return self.mpstate.mav_master
+        if links == 'master' or links == '':
+            return [self.master]
+        ret = []
+        for x in links.split(','):
+            try:
+                i = int(x)
+            except ValueError:
+                continue
+            if i < len(self.mpstate.mav_master):
+                ret.append(self.mpstate.mav_master[i])
+        if len(ret) == 0:
+            ret = [self.master]
+        return ret
+
+    def send_requests(self):
+        '''send the next LOG_REQUEST_DATA when the download wants one'''
+        dl = self.download
+        if dl is None:
             return
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        if len(diff) == 0:
-            self.master.mav.log_request_data_send(
-                self.target_system,
-                self.target_component,
-                self.download_lognum,
-                (1 + highest) * 90,
-                0xffffffff
-            )
-            self.retries += 1
-        else:
-            num_requests = 0
-            while num_requests < 20:
-                start = min(diff)
-                diff.remove(start)
-                end = start
-                while end + 1 in diff:
-                    end += 1
-                    diff.remove(end)
-                self.master.mav.log_request_data_send(
-                    self.target_system,
-                    self.target_component,
-                    self.download_lognum,
-                    start * 90,
-                    (end + 1 - start) * 90
-                )
-                num_requests += 1
-                self.retries += 1
-                if len(diff) == 0:
-                    break
+        r = dl.next_request()
+        if r is None:
+            return
+        (ofs, count) = r
+        # the vehicle serves one request at a time, so several links give
+        # failover rather than parallel transfer
+        links = self.request_links()
+        link = links[self.link_idx % len(links)]
+        self.link_idx += 1
+        link.mav.log_request_data_send(
+            self.target_system,
+            self.target_component,
+            dl.lognum,
+            ofs,
+            count
+        )
+
+    def log_download_finished(self):
+        '''close a completed download and start the next queued one'''
+        dl = self.download
+        dl.close()
+        dt = time.time() - dl.start_time
+        size = os.path.getsize(dl.filename)
+        speed = dl.bytes_received / (1000.0 * max(dt, 0.001))
+        status = (
+            f"Finished downloading {dl.filename} " +
+            f"({size} bytes {dt:0.1f} seconds, " +
+            f"{speed:.1f} kbyte/sec " +
+            f"{dl.retries} retries)"
+        )
+        self.console.set_status('LogDownload', status, row=4)
+        print(status)
+        self.download = None
+        self.download_filename = None
+        self.master.mav.log_request_end_send(
+            self.target_system,
+            self.target_component
+        )
+        if len(self.download_queue):
+            self.log_download_next()
 
     def log_status(self, console=False):
         '''show download status'''
-        if self.download_filename is None:
+        dl = self.download
+        if dl is None:
             print("No download")
             return
-        dt = time.time() - self.download_start
-        speed = os.path.getsize(self.download_filename) / (1000.0 * dt)
-        m = self.entries.get(self.download_lognum, None)
-        file_size = os.path.getsize(self.download_filename)
-        if m is None:
+        received = dl.received_bytes()
+        if dl.size is None:
             size = 0
             pct = 0
-        elif m.size == 0:
+        elif dl.size == 0:
             size = 0
             pct = 100
         else:
-            size = m.size
-            pct = (100.0*file_size)/size
-        highest = 0
-        if len(self.download_set):
-            highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
+            size = dl.size
+            pct = (100.0*received)/size
+        speed = dl.speed() / 1000.0
+        rtt = 0
+        if dl.srtt is not None:
+            rtt = dl.srtt * 1000
         status = (
-            f"Downloading {self.download_filename} - " +
-            f"{os.path.getsize(self.download_filename)}/{size} bytes " +
+            f"Downloading {dl.filename} - " +
+            f"{received}/{size} bytes " +
             f"{pct:.1f}% {speed:.1f} kbyte/s " +
-            f"({self.retries} retries {len(diff)} missing)"
+            f"(window {dl.window} rtt {rtt:.0f}ms loss {dl.loss*100:.1f}% " +
+            f"{dl.retries} retries {dl.missing()} missing)"
         )
+        if len(self.download_queue):
+            status += f" {len(self.download_queue)} queued"
         if console:
             self.console.set_status('LogDownload', status, row=4)
         else:
@@ -164,7 +171,9 @@ class LogModule(mp_module.MPModule):
             return
         latest = self.download_queue.pop()
         filename = self.default_log_filename(latest)
-        if os.path.isfile(filename) and os.path.getsize(filename) == self.entries.get(latest).to_dict()["size"]:
+        entry = self.entries.get(latest, None)
+        if (entry is not None and os.path.isfile(filename) and not os.path.exists(filename + '.bitmap') and
+                os.path.getsize(filename) == entry.size):
             print("Skipping existing %s" % (filename))
             self.log_download_next()
         else:
@@ -190,31 +199,48 @@ class LogModule(mp_module.MPModule):
         self.download_queue = self.download_queue[fromnum:len(self.download_queue)]
         self.log_download_next()
 
+    def log_download_queue(self, lognums):
+        '''add logs to the download queue, starting the first if idle'''
+        for n in lognums:
+            if n not in self.download_queue and (self.download is None or n != self.download.lognum):
+                self.download_queue.insert(0, n)
+        if self.download is None:
+            self.log_download_next()
+        else:
+            print("Queued %s" % str(list(reversed(self.download_queue))))
+
     def log_download(self, log_num, filename):
         '''download a log file'''
-        print("Downloading log %u as %s" % (log_num, filename))
+        if self.download is not None:
+            self.download.close()
+        size = None
+        entry = self.entries.get(log_num, None)
+        if entry is not None:
+            size = entry.size
+        dl = WindowedDownload(log_num, filename, size=size,
+                              window=self.log_settings.window,
+                              window_max=max(self.log_settings.window, self.log_settings.window_max))
+        if not self.log_settings.resume and os.path.exists(dl.state_filename):
+            os.unlink(dl.state_filename)
+        resumed = dl.open()
+        if resumed > 0:
+            print("Resuming log %u as %s (%u bytes already downloaded)" % (log_num, filename, dl.received_bytes()))
+        else:
+            print("Downloading log %u as %s" % (log_num, filename))
+        self.download = dl
         self.download_lognum = log_num
-        self.download_file = open(filename, "wb")
-        self.master.mav.log_request_data_send(
-            self.target_system,
-            self.target_component,
-            log_num,
-            0,
-            0xFFFFFFFF
-        )
         self.download_filename = filename
-        self.download_set = set()
-        self.download_start = time.time()
-        self.download_last_timestamp = time.time()
-        self.download_ofs = 0
-        self.retries = 0
+        if dl.complete:
+            self.log_download_finished()
+            return
+        self.send_requests()
 
     def default_log_filename(self, log_num):
         return "log%u.bin" % log_num
 
     def cmd_log(self, args):
         '''log commands'''
-        usage = "usage: log <list|download|erase|resume|status|cancel>"
+        usage = "usage: log <list|download|erase|resume|status|cancel|set>"
         if len(args) < 1:
             print(usage)
             return
@@ -223,7 +249,6 @@ class LogModule(mp_module.MPModule):
             self.log_status()
         elif args[0] == "list":
             print("Requesting log list")
-            self.download_set = set()
             self.master.mav.log_request_list_send(
                 self.target_system,
                 self.target_component,
@@ -244,13 +269,27 @@ class LogModule(mp_module.MPModule):
             )
 
         elif args[0] == "cancel":
-            if self.download_file is not None:
-                self.download_file.close()
+            if self.download is not None:
+                # keep the partial download so it can be resumed
+                self.download.close()
+                self.master.mav.log_request_end_send(
+                    self.target_system,
+                    self.target_component
+                )
             self.reset()
 
+        elif args[0] == "set":
+            self.log_settings.command(args[1:])
+
         elif args[0] == "download":
             if len(args) < 2:
-                print("usage: log download all | log download <lognumber> <filename> | log download from <lognumber>|log download range FIRST LAST") # noqa:E501
+                print("usage: log download all | log download <lognumber> <filename> | log download from <lognumber>|log download range FIRST LAST|log download queue <lognumber>...") # noqa:E501
+                return
+            if args[1] == 'queue':
+                if len(args) < 3:
+                    print("Usage: log download queue LOGNUM...")
+                    return
+                self.log_download_queue([int(x) for x in args[2:]])
                 return
             if args[1] == 'all':
                 self.log_download_all()
@@ -284,15 +323,13 @@ class LogModule(mp_module.MPModule):
     def update_status(self):
         '''update log download status in console'''
         now = time.time()
-        if self.download_file is not None and now - self.last_status > 0.5:
+        if self.download is not None and now - self.last_status > 0.5:
             self.last_status = now
             self.log_status(True)
 
     def idle_task(self):
-        '''handle missing log data'''
-        if self.download_last_timestamp is not None and time.time() - self.download_last_timestamp > 0.7:
-            self.download_last_timestamp = time.time()
-            self.handle_log_data_missing()
+        '''send requests for the next window and missing log data'''
+        self.send_requests()
         self.update_status()
 
 
@@ -7,6 +7,7 @@ June 2012
 
 import sys, os, math
 import functools
+import threading
 import time
 import datetime
 from MAVProxy.modules.lib import mp_util
@@ -50,6 +51,9 @@ class MapModule(mp_module.MPModule):
         self.unload_check_interval = 0.1 # seconds
         self.trajectory_layers = set()
         self.vehicle_type_override = {}
+        self.seed_tile = None
+        self.seeder = None
+        self.seed_report_period = mavutil.periodic_event(0.2)
         self.map_settings = mp_settings.MPSettings(
             [ ('showgpspos', int, 1),
               ('showgps2pos', int, 1),
@@ -75,6 +79,7 @@ class MapModule(mp_module.MPModule):
         service='MicrosoftHyb'
         if 'MAP_SERVICE' in os.environ:
             service = os.environ['MAP_SERVICE']
+        tile_store = os.environ.get('MAP_TILE_STORE', 'files')
         import platform
         from MAVProxy.modules.mavproxy_map import mp_slipmap
         title = "Map"
@@ -84,7 +89,7 @@ class MapModule(mp_module.MPModule):
         terrain_module = self.module('terrain')
         if terrain_module is not None:
             elevation = terrain_module.ElevationModel.database
-        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title)
+        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title, tile_store=tile_store)
         if self.instance == 1:
             self.mpstate.map = self.map
             mpstate.map_functions = { 'draw_lines' : self.draw_lines }
@@ -98,7 +103,9 @@ class MapModule(mp_module.MPModule):
                                                                 'follow',
                                                                 'menu',
                                                                 'marker',
-                                                                'clear'])
+                                                                'clear',
+                                                                'tilecache <import|export>',
+                                                                'seed <mission|fence|kml|bbox|status|stop>'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
         self.default_popup = MPMenuSubMenu('Popup', items=[])
@@ -348,9 +355,147 @@ class MapModule(mp_module.MPModule):
             self.cmd_set_roi(args)
         elif args[0] == "setposition":
             self.cmd_set_position(args)
+        elif args[0] == "tilecache":
+            self.cmd_map_tilecache(args[1:])
+        elif args[0] == "seed":
+            self.cmd_map_seed(args[1:])
         else:
             print("usage: map <icon|set>")
 
+    def seed_polygons(self, source, args):
+        '''return a list of (lat,lon) polygons for a map seed source'''
+        if source == "bbox":
+            if len(args) < 4:
+                return None
+            return [[(float(args[0]), float(args[1])), (float(args[2]), float(args[3]))]]
+        if source == "mission":
+            wpmod = self.module('wp')
+            if wpmod is None:
+                print("wp module not loaded")
+                return None
+            return wpmod.wploader.polygon_list()
+        if source == "fence":
+            fencemod = self.module('fence')
+            if fencemod is None:
+                print("fence module not loaded")
+                return None
+            ret = []
+            for polygon in fencemod.inclusion_polygons() + fencemod.exclusion_polygons():
+                points = []
+                for p in polygon:
+                    (lat, lon) = (p.x, p.y)
+                    if p.get_type() == 'MISSION_ITEM_INT':
+                        (lat, lon) = (lat*1e-7, lon*1e-7)
+                    points.append((lat, lon))
+                ret.append(points)
+            for circle in fencemod.inclusion_circles() + fencemod.exclusion_circles():
+                (lat, lon) = (circle.x, circle.y)
+                if circle.get_type() == 'MISSION_ITEM_INT':
+                    (lat, lon) = (lat*1e-7, lon*1e-7)
+                ret.append([mp_util.gps_newpos(lat, lon, 315, circle.param1*math.sqrt(2)),
+                            mp_util.gps_newpos(lat, lon, 135, circle.param1*math.sqrt(2))])
+            return ret
+        if source == "kml":
+            kmlmod = self.module('kmlread')
+            if kmlmod is None:
+                print("kmlread module not loaded")
+                return None
+            ret = []
+            for layer in kmlmod.allayers:
+                if len(args) > 0 and layer.key not in args:
+                    continue
+                if hasattr(layer, 'points'):
+                    ret.append(layer.points)
+                elif hasattr(layer, 'latlon'):
+                    ret.append([layer.latlon])
+            return ret
+        return None
+
+    def cmd_map_seed(self, args):
+        '''download map tiles for an area for offline use'''
+        from MAVProxy.modules.mavproxy_map import mp_tile
+        usage = "Usage: map seed <mission|fence|kml [LAYER...]|bbox LAT1 LON1 LAT2 LON2> MINZOOM MAXZOOM [estimate]\n       map seed <status|stop>"
+        if len(args) < 1:
+            print(usage)
+            return
+        if args[0] == "status":
+            if self.seeder is None:
+                print("No map seed running")
+            else:
+                print(self.seeder.progress())
+            return
+        if args[0] == "stop":
+            if self.seeder is not None:
+                self.seeder.stop()
+                print("Stopped map seed: %s" % self.seeder.progress())
+                self.seeder = None
+            return
+        estimate = args[-1] == "estimate"
+        if estimate:
+            args = args[:-1]
+        if len(args) < 3:
+            print(usage)
+            return
+        try:
+            (min_zoom, max_zoom) = (int(args[-2]), int(args[-1]))
+            polygons = self.seed_polygons(args[0], args[1:-2])
+        except ValueError:
+            print(usage)
+            return
+        if polygons is None:
+            print(usage)
+            return
+        if len(polygons) == 0:
+            print("Nothing to seed for %s" % args[0])
+            return
+        if self.seeder is not None:
+            self.seeder.stop()
+        if self.seed_tile is None:
+            self.seed_tile = mp_tile.MPTile(service=self.map.service,
+                                            tile_store=self.map.tile_store,
+                                            max_zoom=max(19, max_zoom))
+        self.seed_tile.set_service(self.map.service)
+        seeder = mp_tile.TileSeeder(self.seed_tile, polygons, min_zoom, max_zoom)
+
+        def plan_and_start():
+            seeder.plan()
+            print("map seed: %s" % seeder.summary())
+            if not estimate:
+                seeder.start()
+        if not estimate:
+            self.seeder = seeder
+        t = threading.Thread(target=plan_and_start, name='map_seed')
+        t.daemon = True
+        t.start()
+
+    def cmd_map_tilecache(self, args):
+        '''convert the tile cache between file and MBTiles storage'''
+        from MAVProxy.modules.mavproxy_map import mp_tile
+        usage = "Usage: map tilecache <import|export> [SERVICE]"
+        if len(args) < 1 or args[0] not in ["import", "export"]:
+            print(usage)
+            return
+        if len(args) > 1:
+            service = args[1]
+        else:
+            service = self.map.service
+        if service not in mp_tile.TILE_SERVICES:
+            print("Unknown tile service %s" % service)
+            return
+        if args[0] == "import":
+            # tile files into the MBTiles database
+            (src, dst) = ('files', 'mbtiles')
+        else:
+            (src, dst) = ('mbtiles', 'files')
+
+        def convert():
+            cache_path = mp_tile.default_cache_path()
+            count = mp_tile.tilecache_convert(cache_path, service, src, dst)
+            print("Copied %u %s tiles from %s to %s" % (count, service, src, dst))
+        t = threading.Thread(target=convert, name='tilecache')
+        t.daemon = True
+        t.start()
+
     def cmd_map_circle(self, args):
         usage = '''
 Usage: map circle <lat> <lon> <radius> <colour>
@@ -899,6 +1044,11 @@ Usage: map circle <radius> <colour>
         # check for any events from the map
         self.map.check_events()
 
+        if self.seeder is not None and self.seeder.started and self.seed_report_period.trigger():
+            if self.seeder.remaining() == 0:
+                print("map seed: %s" % self.seeder.progress())
+                self.seeder = None
+
     def create_vehicle_icon(self, name, colour, follow=False, vehicle_type=None):
         '''add a vehicle to the map'''
         from MAVProxy.modules.mavproxy_map import mp_slipmap
@@ -1380,19 +1530,16 @@ Usage: map circle <radius> <colour>
         y = np.arange(-0.5 * grid_extent, 0.5 * grid_extent, grid_spacing)
         x_grid, y_grid = np.meshgrid(x, y)
 
-        def terrain_surface(lat, lon, x, y):
+        def terrain_surface(lat, lon, x_grid, y_grid):
             """
             Calculate terrain altitudes for the NED offsets (x, y)
             centred on (lat, lon).
             """
-            alt = []
-            for east in y:
-                alt_y = []
-                for north in x:
-                    (lat2, lon2) = mp_util.gps_offset(lat, lon, east, north)
-                    alt_y.append(elevation_model.GetElevation(lat2, lon2))
-                alt.append(alt_y)
-            return alt
+            # flat earth offsets are well within a grid cell over the
+            # contour extent
+            lat2 = lat + np.degrees(x_grid / mp_util.radius_of_earth)
+            lon2 = lon + np.degrees(y_grid / (mp_util.radius_of_earth * math.cos(math.radians(lat))))
+            return elevation_model.GetElevationArray(lat2, lon2)
 
         def ned_to_latlon(contours, lat, lon):
             """
@@ -1413,7 +1560,7 @@ Usage: map circle <radius> <colour>
             return contours_latlon
 
         # generate surface and contours
-        z_grid = np.array(terrain_surface(lat, lon, x, y))
+        z_grid = terrain_surface(lat, lon, x_grid, y_grid)
         _, (ax1) = plt.subplots(1, 1, figsize=(10,10))
         cs = ax1.contour(x_grid, y_grid, z_grid, levels=levels)
         contours = ned_to_latlon(cs.allsegs, lat, lon)
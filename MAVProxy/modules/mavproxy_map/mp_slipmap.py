@@ -40,7 +40,8 @@ class MPSlipMap():
                  elevation=None,
                  download=True,
                  show_flightmode_legend=True,
-                 timelim_pipe=None):
+                 timelim_pipe=None,
+                 tile_store='files'):
 
         self.lat = lat
         self.lon = lon
@@ -49,6 +50,7 @@ class MPSlipMap():
         self.ground_width = ground_width
         self.download = download
         self.service = service
+        self.tile_store = tile_store
         self.tile_delay = tile_delay
         self.debug = debug
         self.max_zoom = max_zoom
@@ -88,7 +90,8 @@ class MPSlipMap():
                                  service=self.service,
                                  tile_delay=self.tile_delay,
                                  debug=self.debug,
-                                 max_zoom=self.max_zoom)
+                                 max_zoom=self.max_zoom,
+                                 tile_store=self.tile_store)
         state.layers = {}
         state.info = {}
         state.need_redraw = True
@@ -1,3 +1,4 @@
+import cv2
 import functools
 import math
 from MAVProxy.modules.lib import mp_elevation
@@ -344,7 +345,12 @@ class MPSlipMapPanel(wx.Panel):
         wx.Panel.__init__(self, parent)
         self.state = state
         self.img = None
+        # map_img is the cached base map with brightness applied, only
+        # rebuilt when base_view() changes. Overlays are drawn on a copy
+        # in overlay_img
         self.map_img = None
+        self.overlay_img = None
+        self.last_base_view = None
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
@@ -410,6 +416,14 @@ class MPSlipMapPanel(wx.Panel):
         return (state.lat, state.lon, state.width, state.height,
                 state.ground_width, state.mt.tiles_pending())
 
+    def base_view(self):
+        '''return a tuple representing the base map image, which only
+        changes when the view moves or new tiles arrive'''
+        state = self.state
+        return (state.lat, state.lon, state.width, state.height,
+                state.ground_width, state.brightness, state.download,
+                state.mt.get_service(), state.mt.tile_version)
+
     def coordinates(self, x, y):
         '''return coordinates of a pixel in the map'''
         state = self.state
@@ -575,22 +589,29 @@ class MPSlipMapPanel(wx.Panel):
         if view_same and not state.need_redraw:
             return
 
-        # get the new map
-        self.map_img = state.mt.area_to_image(state.lat, state.lon,
-                                              state.width, state.height, state.ground_width)
-        if state.brightness != 0: # valid state.brightness range is [-255, 255]
-            brightness = np.uint8(np.abs(state.brightness))
-            if state.brightness > 0:
-                self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
-            else:
-                self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
-            
+        # get the new map if the view or the available tiles have changed
+        base_view = self.base_view()
+        if self.map_img is None or base_view != self.last_base_view:
+            self.map_img = state.mt.area_to_image(state.lat, state.lon,
+                                                  state.width, state.height, state.ground_width)
+            if state.brightness != 0: # valid state.brightness range is [-255, 255]
+                brightness = float(abs(state.brightness))
+                # saturating add/subtract
+                if state.brightness > 0:
+                    self.map_img = cv2.add(self.map_img, (brightness, brightness, brightness, 0))
+                else:
+                    self.map_img = cv2.subtract(self.map_img, (brightness, brightness, brightness, 0))
+            self.last_base_view = base_view
+
         # find display bounding box
         (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
         bounds = (lat2, state.lon, state.lat-lat2, mp_util.wrap_180(lon2-state.lon))
 
-        # get the image
-        img = self.map_img.copy()
+        # get the image, re-using the overlay buffer
+        if self.overlay_img is None or self.overlay_img.shape != self.map_img.shape:
+            self.overlay_img = np.empty_like(self.map_img)
+        np.copyto(self.overlay_img, self.map_img)
+        img = self.overlay_img
 
         # possibly draw a grid
         if state.grid:
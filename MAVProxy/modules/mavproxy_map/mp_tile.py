@@ -20,11 +20,13 @@ see also:
 import collections
 import errno
 import hashlib
+import heapq
 import sys
 import math
 import threading
 import os
 import pathlib
+import sqlite3
 import string
 import time
 import cv2
@@ -33,15 +35,13 @@ import numpy as np
 from math import log, tan, radians, degrees, sin, cos, exp, pi, asin, atan
 
 if sys.version_info.major < 3:
-    from urllib2 import Request as url_request
-    from urllib2 import urlopen as url_open
-    from urllib2 import URLError as url_error
+    import httplib as http_client
+    from urlparse import urlparse as url_parse
+    from urlparse import urljoin as url_join
 else:
-    from urllib.request import Request as url_request
-    from urllib.request import urlopen as url_open
-    from urllib.error import URLError as actual_url_error
-    from http.client import RemoteDisconnected
-    url_error = (RemoteDisconnected, actual_url_error)
+    import http.client as http_client
+    from urllib.parse import urlparse as url_parse
+    from urllib.parse import urljoin as url_join
 
 from MAVProxy.modules.lib import mp_util
 
@@ -80,6 +80,12 @@ BLANK_TILES = set(["d16657bbee25d7f15c583f5c5bf23f50",
 TILES_WIDTH = 256
 TILES_HEIGHT = 256
 
+# typical size in bytes of a downloaded tile, for estimates
+TILE_SIZE_ESTIMATE = 20000
+
+# tile store backends
+TILE_STORES = ['files', 'mbtiles']
+
 class TileServiceInfo:
     '''a lookup object for the URL templates'''
     def __init__(self, x, y, zoom):
@@ -111,6 +117,9 @@ class TileInfo:
         self.zoom = zoom
         self.service = service
         (self.offsetx, self.offsety) = offset
+        # download queue state
+        self.view = None
+        self.priority = None
         self.refresh_time()
 
     def key(self):
@@ -175,21 +184,428 @@ class TileInfoScaled(TileInfo):
 
 
 
+def default_cache_path():
+    '''return the default tile cache directory'''
+    try:
+        return os.path.join(os.environ['HOME'], '.tilecache')
+    except Exception:
+        if 'LOCALAPPDATA' in os.environ:
+            return os.path.join(os.environ['LOCALAPPDATA'], '.tilecache')
+        import tempfile
+        return os.path.join(tempfile.gettempdir(), '.tilecache')
+
+
+class TileStoreFiles:
+    '''tile store with one image file per tile under cache_path/service'''
+    def __init__(self, cache_path, service):
+        self.root = os.path.join(cache_path, service)
+
+    def path(self, zoom, x, y):
+        return os.path.join(self.root, '%u' % zoom, '%u' % y, '%u.img' % x)
+
+    def get(self, zoom, x, y):
+        '''return (data, mtime) for a tile, or None'''
+        path = self.path(zoom, x, y)
+        try:
+            mtime = os.path.getmtime(path)
+            with open(path, 'rb') as f:
+                return (f.read(), mtime)
+        except (IOError, OSError):
+            return None
+
+    def mtime(self, zoom, x, y):
+        '''return modification time of a tile, or None'''
+        try:
+            return os.path.getmtime(self.path(zoom, x, y))
+        except (IOError, OSError):
+            return None
+
+    def stat(self, zoom, x, y):
+        '''return (size, mtime) of a tile, or None'''
+        try:
+            st = os.stat(self.path(zoom, x, y))
+        except (IOError, OSError):
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def touch(self, zoom, x, y):
+        '''reset the refresh time of a tile'''
+        pathlib.Path(self.path(zoom, x, y)).touch()
+
+    def put(self, zoom, x, y, data, mtime=None):
+        '''store encoded image data for a tile'''
+        path = self.path(zoom, x, y)
+        mp_util.mkdir_p(os.path.dirname(path))
+        h = open(path+'.tmp','wb')
+        h.write(data)
+        h.close()
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        os.rename(path+'.tmp', path)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def tiles(self):
+        '''iterate over (zoom, x, y, data, mtime) for all tiles in the store'''
+        if not os.path.isdir(self.root):
+            return
+        for zdir in os.listdir(self.root):
+            if not zdir.isdigit():
+                continue
+            for ydir in os.listdir(os.path.join(self.root, zdir)):
+                if not ydir.isdigit():
+                    continue
+                for fname in os.listdir(os.path.join(self.root, zdir, ydir)):
+                    if not fname.endswith('.img') or not fname[:-4].isdigit():
+                        continue
+                    (zoom, x, y) = (int(zdir), int(fname[:-4]), int(ydir))
+                    r = self.get(zoom, x, y)
+                    if r is not None:
+                        yield (zoom, x, y, r[0], r[1])
+
+    def close(self):
+        pass
+
+
+class TileStoreMBTiles:
+    '''tile store in a single MBTiles (SQLite) file, cache_path/service.mbtiles
+
+    MBTiles rows use the TMS scheme, so y is flipped on the way in and out.
+    An extra mtime column is kept for tile refresh, other readers ignore it.
+    '''
+    def __init__(self, cache_path, service=None, filename=None):
+        if filename is None:
+            filename = os.path.join(cache_path, service + '.mbtiles')
+        self.filename = filename
+        self.service = service
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _open(self):
+        '''open the database, creating it if needed. Called with lock held'''
+        if self.db is not None:
+            return self.db
+        mp_util.mkdir_p(os.path.dirname(os.path.abspath(self.filename)))
+        db = sqlite3.connect(self.filename, check_same_thread=False)
+        db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                   'tile_row INTEGER, tile_data BLOB, mtime REAL)')
+        db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+        columns = [row[1] for row in db.execute('PRAGMA table_info(tiles)')]
+        if 'mtime' not in columns:
+            # an MBTiles file from another tool
+            db.execute('ALTER TABLE tiles ADD COLUMN mtime REAL')
+        if db.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] == 0:
+            name = self.service or os.path.basename(self.filename)
+            db.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)',
+                           [('name', name), ('type', 'baselayer'), ('version', '1'),
+                            ('description', 'MAVProxy tile cache'), ('format', 'jpg')])
+        db.commit()
+        self.db = db
+        return db
+
+    def get(self, zoom, x, y):
+        '''return (data, mtime) for a tile, or None'''
+        with self.lock:
+            row = self._open().execute(
+                'SELECT tile_data, mtime FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (zoom, x, (1<<zoom)-1-y)).fetchone()
+        if row is None:
+            return None
+        (data, mtime) = row
+        if mtime is None:
+            mtime = time.time()
+        return (bytes(data), mtime)
+
+    def mtime(self, zoom, x, y):
+        '''return modification time of a tile, or None'''
+        with self.lock:
+            row = self._open().execute(
+                'SELECT mtime FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (zoom, x, (1<<zoom)-1-y)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def stat(self, zoom, x, y):
+        '''return (size, mtime) of a tile, or None'''
+        with self.lock:
+            row = self._open().execute(
+                'SELECT LENGTH(tile_data), mtime FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (zoom, x, (1<<zoom)-1-y)).fetchone()
+        if row is None:
+            return None
+        (size, mtime) = row
+        if mtime is None:
+            mtime = time.time()
+        return (size, mtime)
+
+    def touch(self, zoom, x, y):
+        '''reset the refresh time of a tile'''
+        with self.lock:
+            db = self._open()
+            db.execute('UPDATE tiles SET mtime=? WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                       (time.time(), zoom, x, (1<<zoom)-1-y))
+            db.commit()
+
+    def put(self, zoom, x, y, data, mtime=None, commit=True):
+        '''store encoded image data for a tile'''
+        if mtime is None:
+            mtime = time.time()
+        with self.lock:
+            db = self._open()
+            db.execute('INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, mtime) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (zoom, x, (1<<zoom)-1-y, sqlite3.Binary(data), mtime))
+            if commit:
+                db.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+
+    def tiles(self):
+        '''iterate over (zoom, x, y, data, mtime) for all tiles in the store'''
+        with self.lock:
+            rows = self._open().execute(
+                'SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall()
+        for (zoom, x, row) in rows:
+            y = (1<<zoom)-1-row
+            r = self.get(zoom, x, y)
+            if r is not None:
+                yield (zoom, x, y, r[0], r[1])
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+def tilecache_convert(cache_path, service, src_store, dst_store):
+    '''copy the tiles for a service between tile store types, for
+    example from 'files' to 'mbtiles'. Returns the number of tiles copied'''
+    src = open_tile_store(src_store, cache_path, service)
+    dst = open_tile_store(dst_store, cache_path, service)
+    count = copy_tiles(src, dst)
+    src.close()
+    dst.close()
+    return count
+
+
+def open_tile_store(store, cache_path, service):
+    '''return a tile store object of the given type'''
+    if store == 'files':
+        return TileStoreFiles(cache_path, service)
+    if store == 'mbtiles':
+        return TileStoreMBTiles(cache_path, service)
+    raise TileException('unknown tile store %s' % store)
+
+
+def copy_tiles(src, dst):
+    '''copy all tiles from one store to another, returning the count'''
+    count = 0
+    for (zoom, x, y, data, mtime) in src.tiles():
+        if isinstance(dst, TileStoreMBTiles):
+            dst.put(zoom, x, y, data, mtime=mtime, commit=False)
+        else:
+            dst.put(zoom, x, y, data, mtime=mtime)
+        count += 1
+    if isinstance(dst, TileStoreMBTiles):
+        dst.commit()
+    return count
+
+
+def point_in_polygon(lat, lon, polygon):
+    '''return true if lat/lon is inside a polygon of (lat,lon) points'''
+    inside = False
+    n = len(polygon)
+    for i in range(n):
+        (lat1, lon1) = polygon[i]
+        (lat2, lon2) = polygon[(i+1) % n]
+        if (lon1 > lon) != (lon2 > lon):
+            if lat < lat1 + (lon - lon1) * (lat2 - lat1) / (lon2 - lon1):
+                inside = not inside
+    return inside
+
+
+class TileSeeder:
+    '''download every tile covering a set of polygons over a zoom range,
+    for offline use. Polygons are lists of (lat,lon); one with less than
+    three points is treated as its bounding box. Tiles already in the
+    tile store and newer than refresh_age are skipped, so an interrupted
+    seed resumes where it left off when run again'''
+    def __init__(self, mt, polygons, min_zoom, max_zoom):
+        self.mt = mt
+        self.polygons = [p for p in polygons if len(p) > 0]
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.tiles = []
+        self.total = 0
+        self.cached = 0
+        self.cached_bytes = 0
+        self.started = False
+
+    def polygon_tiles(self, polygon, zoom):
+        '''return the set of (x,y) tiles at a zoom level covering a polygon'''
+        (minlat, minlon, dlat, dlon) = mp_util.polygon_bounds(polygon)
+        t1 = self.mt.coord_to_tile(minlat+dlat, minlon, zoom)
+        t2 = self.mt.coord_to_tile(minlat, minlon+dlon, zoom)
+        ret = set()
+        for y in range(t1.y, t2.y+1):
+            for x in range(t1.x, t2.x+1):
+                if len(polygon) < 3:
+                    ret.add((x, y))
+                    continue
+                tile = TileInfo((x, y), zoom, self.mt.service)
+                corners = [tile.coord((ox, oy)) for (ox, oy) in [(0, 0), (TILES_WIDTH, 0), (0, TILES_HEIGHT),
+                                                               (TILES_WIDTH, TILES_HEIGHT),
+                                                               (TILES_WIDTH//2, TILES_HEIGHT//2)]]
+                if any([point_in_polygon(lat, lon, polygon) for (lat, lon) in corners]):
+                    ret.add((x, y))
+                    continue
+                # a small polygon may sit entirely inside one tile
+                (lat1, lon1) = corners[0]
+                (lat2, lon2) = corners[3]
+                for (lat, lon) in polygon:
+                    if lat2 <= lat <= lat1 and lon1 <= lon <= lon2:
+                        ret.add((x, y))
+                        break
+        return ret
+
+    def plan(self):
+        '''work out which tiles need downloading'''
+        self.tiles = []
+        self.total = 0
+        self.cached = 0
+        self.cached_bytes = 0
+        store = self.mt.store()
+        now = time.time()
+        for zoom in range(self.min_zoom, self.max_zoom+1):
+            xy = set()
+            for polygon in self.polygons:
+                xy.update(self.polygon_tiles(polygon, zoom))
+            for (x, y) in sorted(xy):
+                self.total += 1
+                st = store.stat(zoom, x, y)
+                if st is not None and st[1] + self.mt.refresh_age > now:
+                    self.cached += 1
+                    self.cached_bytes += st[0]
+                    continue
+                self.tiles.append(TileInfo((x, y), zoom, self.mt.service))
+
+    def estimate_bytes(self):
+        '''estimated download size, based on the tiles already cached'''
+        if self.cached > 0:
+            average = self.cached_bytes / float(self.cached)
+        else:
+            average = TILE_SIZE_ESTIMATE
+        return int(average * len(self.tiles))
+
+    def summary(self):
+        return "%u tiles zoom %u-%u, %u cached, %u to download (about %.1f MByte)" % (
+            self.total, self.min_zoom, self.max_zoom, self.cached, len(self.tiles),
+            self.estimate_bytes() / (1024.0*1024.0))
+
+    def start(self):
+        '''queue the missing tiles for download'''
+        self.started = True
+        with self.mt._download_lock:
+            self.mt._seed_pending.update([t.key() for t in self.tiles])
+        for tile in self.tiles:
+            self.mt.queue_download(tile)
+
+    def remaining(self):
+        '''number of seeded tiles still waiting for download'''
+        if not self.started:
+            return len(self.tiles)
+        return len(self.mt._seed_pending)
+
+    def progress(self):
+        if len(self.tiles) == 0:
+            return "seed complete"
+        done = len(self.tiles) - self.remaining()
+        return "seeded %u/%u tiles (%.1f%%)" % (done, len(self.tiles), 100.0 * done / len(self.tiles))
+
+    def stop(self):
+        '''cancel the seeded tiles which are not yet downloaded'''
+        keys = set([t.key() for t in self.tiles])
+        self.mt.cancel_downloads(keys)
+
+
+class TileLRU:
+    '''least recently used cache of decoded tiles, bounded in bytes
+
+    The shared loading/unavailable sentinel images don't count towards
+    the size.
+    '''
+    def __init__(self, max_bytes, sentinels=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.sentinel_ids = set([id(s) for s in (sentinels or [])])
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+
+    def _size(self, img):
+        if id(img) in self.sentinel_ids:
+            return 0
+        return img.nbytes
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, key):
+        '''return a cached tile, marking it as recently used, or None'''
+        with self.lock:
+            img = self.cache.get(key, None)
+            if img is not None:
+                self.cache.move_to_end(key)
+            return img
+
+    def _put(self, key, img):
+        '''add a tile, called with lock held'''
+        old = self.cache.pop(key, None)
+        if old is not None:
+            self.nbytes -= self._size(old)
+        self.cache[key] = img
+        self.nbytes += self._size(img)
+        while self.nbytes > self.max_bytes and len(self.cache) > 1:
+            (k, old) = self.cache.popitem(last=False)
+            self.nbytes -= self._size(old)
+
+    def put(self, key, img):
+        '''add a tile, evicting least recently used tiles as needed'''
+        with self.lock:
+            self._put(key, img)
+
+    def setdefault(self, key, img):
+        '''add a tile only if there is no entry for key'''
+        with self.lock:
+            if key not in self.cache:
+                self._put(key, img)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.nbytes = 0
+
+
 class MPTile:
     '''map tile object'''
     def __init__(self, cache_path=None, download=True, cache_size=500,
              service="MicrosoftSat", tile_delay=0.3, debug=False,
-             max_zoom=19, refresh_age=30*24*60*60):
+             max_zoom=19, refresh_age=30*24*60*60, tile_store='files',
+             cache_bytes=None, download_workers=4):
 
         if cache_path is None:
-            try:
-                cache_path = os.path.join(os.environ['HOME'], '.tilecache')
-            except Exception:
-                if 'LOCALAPPDATA' in os.environ:
-                    cache_path = os.path.join(os.environ['LOCALAPPDATA'], '.tilecache')
-                else:
-                    import tempfile
-                    cache_path = os.path.join(tempfile.gettempdir(), '.tilecache')
+            cache_path = default_cache_path()
 
         if not os.path.exists(cache_path):
             mp_util.mkdir_p(cache_path)
@@ -206,24 +622,55 @@ class MPTile:
 
         if service not in TILE_SERVICES:
             raise TileException('unknown tile service %s' % service)
-
-        # _download_pending is a dictionary of TileInfo objects
+        if tile_store not in TILE_STORES:
+            raise TileException('unknown tile store %s' % tile_store)
+        self.tile_store = tile_store
+        self._stores = {}
+
+        # _download_pending is a dictionary of TileInfo objects, with
+        # _download_heap holding (priority, seq, key) download order
+        self.download_workers = download_workers
+        self.http_timeout = 20
         self._download_pending = {}
-        self._download_thread = None
+        self._download_heap = []
+        self._download_seq = 0
+        self._downloading = set()
+        # keys of seeded tiles that have not finished downloading
+        self._seed_pending = set()
+        self._download_threads = 0
+        self._download_lock = threading.Lock()
+        self._host_next = {}
+        self._view_id = 0
+        self._view_center = None
+        self._in_view = False
+        # bumped whenever a download finishes, so users of area_to_image()
+        # know when a cached image is out of date
+        self.tile_version = 0
+        # the sentinel images are recognised by identity, never copy them
         self._loading = mp_icon('loading.jpg')
         self._unavailable = mp_icon('unavailable.jpg')
-        try:
-            self._tile_cache = collections.OrderedDict()
-        except AttributeError:
-            # OrderedDicts in python 2.6 come from the ordereddict module
-            # which is a 3rd party package, not in python2.6 distribution
-            import ordereddict
-            self._tile_cache = ordereddict.OrderedDict()
+        if cache_bytes is None:
+            cache_bytes = cache_size * TILES_WIDTH * TILES_HEIGHT * 3
+        self._tile_cache = TileLRU(cache_bytes, sentinels=[self._loading, self._unavailable])
 
     def set_service(self, service):
         '''set tile service'''
         self.service = service
 
+    def store(self, service=None):
+        '''return the tile store for a service, opening it if needed'''
+        if service is None:
+            service = self.service
+        # download workers open stores too
+        with self._download_lock:
+            if service not in self._stores:
+                self._stores[service] = open_tile_store(self.tile_store, self.cache_path, service)
+            return self._stores[service]
+
+    def is_sentinel(self, img):
+        '''true if img is the loading or unavailable placeholder'''
+        return img is self._loading or img is self._unavailable
+
     def get_service(self):
         '''get tile service'''
         return self.service
@@ -265,97 +712,218 @@ class MPTile:
         '''return number of tiles pending download'''
         return len(self._download_pending)
 
-    def downloader(self):
-        '''the download thread'''
-        while self.tiles_pending() > 0:
-            time.sleep(self.tile_delay)
-
-            keys = sorted(self._download_pending.keys())
+    def begin_view(self, lat, lon):
+        '''start a new view centred on lat/lon. Tiles requested for the
+        view are downloaded closest to the centre first'''
+        with self._download_lock:
+            self._view_id += 1
+            self._view_center = (lat, lon)
+            self._in_view = True
+
+    def end_view(self):
+        '''cancel pending downloads of tiles which were not requested for
+        the current view, as they have scrolled out of sight'''
+        with self._download_lock:
+            for key in list(self._download_pending.keys()):
+                tile = self._download_pending[key]
+                if tile.view is None or tile.view == self._view_id or key in self._downloading:
+                    continue
+                self._download_pending.pop(key)
+                if self.debug:
+                    print("Cancelled %s" % str(key))
+            self._in_view = False
+        self.start_download_thread()
 
-            # work out which one to download next, choosing by request_time
-            tile_info = self._download_pending[keys[0]]
+    def cancel_downloads(self, keys):
+        '''cancel pending downloads for a set of tile keys'''
+        with self._download_lock:
             for key in keys:
-                if self._download_pending[key].request_time > tile_info.request_time:
-                    tile_info = self._download_pending[key]
+                if key not in self._downloading:
+                    self._download_pending.pop(key, None)
+                    self._seed_pending.discard(key)
+
+    def download_priority(self, tile):
+        '''heap key for a tile; newest view first, then distance from the
+        view centre, then most recently requested'''
+        if tile.view is None or self._view_center is None:
+            return (0, 0, -tile.request_time)
+        (lat, lon) = self._view_center
+        return (-tile.view, tile.distance(lat, lon), -tile.request_time)
+
+    def queue_download(self, tile):
+        '''add a tile to the download queue, or update its priority'''
+        key = tile.key()
+        with self._download_lock:
+            pending = self._download_pending.get(key, None)
+            if pending is None:
+                pending = tile
+                pending.priority = None
+                self._download_pending[key] = pending
+            else:
+                pending.refresh_time()
+            view = self._view_id if self._view_center is not None else None
+            if pending.priority is not None and pending.view == view:
+                # already queued for this view
+                return
+            pending.view = view
+            pending.priority = self.download_priority(pending)
+            self._download_seq += 1
+            heapq.heappush(self._download_heap, (pending.priority, self._download_seq, key))
+            if len(self._download_heap) > 4 * len(self._download_pending) + 64:
+                # drop stale entries
+                self._download_heap = [h for h in self._download_heap
+                                       if h[2] in self._download_pending and
+                                       self._download_pending[h[2]].priority == h[0]]
+                heapq.heapify(self._download_heap)
+            if self._in_view:
+                # workers are started once the whole view is queued
+                return
+        self.start_download_thread()
 
-            url = tile_info.url(self.service)
-            path = self.tile_to_path(tile_info)
-            key = tile_info.key()
+    def next_download(self):
+        '''pop the highest priority tile from the queue, or None. Called
+        with the download lock held'''
+        while self._download_heap:
+            (priority, seq, key) = heapq.heappop(self._download_heap)
+            tile = self._download_pending.get(key, None)
+            if tile is None or tile.priority != priority or key in self._downloading:
+                # cancelled, requeued or already in progress
+                continue
+            self._downloading.add(key)
+            return tile
+        return None
 
+    def download_done(self, key, unavailable=False):
+        '''remove a tile from the queue once its download has finished'''
+        if unavailable:
+            self._tile_cache.setdefault(key, self._unavailable)
+        with self._download_lock:
+            self._download_pending.pop(key, None)
+            self._downloading.discard(key)
+            self._seed_pending.discard(key)
+            self.tile_version += 1
+
+    def host_wait(self, host):
+        '''reserve the next request slot for a host, waiting until it is
+        due. Requests to one host are at least tile_delay apart'''
+        with self._download_lock:
+            now = time.time()
+            t = max(now, self._host_next.get(host, 0))
+            self._host_next[host] = t + self.tile_delay
+        if t > now:
+            time.sleep(t - now)
+
+    def http_get(self, conns, url, headers, redirects=5):
+        '''fetch a URL, keeping one connection per host open in conns for
+        re-use. Returns (status, response, body)'''
+        u = url_parse(url)
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        ckey = (u.scheme, u.netloc)
+        for attempt in range(2):
+            conn = conns.get(ckey, None)
+            if conn is None:
+                if u.scheme == 'https':
+                    conn = http_client.HTTPSConnection(u.netloc, timeout=self.http_timeout)
+                else:
+                    conn = http_client.HTTPConnection(u.netloc, timeout=self.http_timeout)
+                conns[ckey] = conn
             try:
-                if self.debug:
-                    print("Downloading %s [%u left]" % (url, len(keys)))
-                req = url_request(url)
-                req.add_header('User-Agent', 'MAVProxy')
-
-                # try to re-use our cached data:
-                try:
-                    mtime = os.path.getmtime(path)
-                    req.add_header('If-Modified-Since', time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime)))
-                except Exception:
-                    pass
-
-                if url.find('google') != -1:
-                    req.add_header('Referer', 'https://maps.google.com/')
-                resp = url_open(req)
-                headers = resp.info()
-            except url_error as e:
-                try:
-                    if e.getcode() == 304:
-                        # cache hit; touch the file to reset its refresh time
-                        pathlib.Path(path).touch()
-                        self._download_pending.pop(key)
-                        continue
-                except Exception as ex:
-                    pass
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except (http_client.HTTPException, OSError):
+                # the server may have closed an idle connection
+                conn.close()
+                conns.pop(ckey, None)
+                if attempt == 1:
+                    raise
+        location = resp.getheader('location')
+        if resp.status in [301, 302, 303, 307, 308] and location and redirects > 0:
+            return self.http_get(conns, url_join(url, location), headers, redirects-1)
+        return (resp.status, resp, body)
+
+    def download_tile(self, tile_info, conns):
+        '''download one tile into the tile store'''
+        url = tile_info.url(self.service)
+        store = self.store()
+        (tx, ty) = tile_info.tile
+        key = tile_info.key()
+
+        headers = {'User-Agent': 'MAVProxy'}
+        # try to re-use our cached data:
+        mtime = store.mtime(tile_info.zoom, tx, ty)
+        if mtime is not None:
+            headers['If-Modified-Since'] = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime))
+        if url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
+
+        self.host_wait(url_parse(url).netloc)
+        try:
+            if self.debug:
+                print("Downloading %s [%u left]" % (url, self.tiles_pending()))
+            (status, resp, img) = self.http_get(conns, url, headers)
+        except (http_client.HTTPException, OSError) as e:
+            self.download_done(key, unavailable=True)
+            if self.debug:
+                print("Failed %s: %s" % (url, str(e)))
+            return
+        if status == 304:
+            # cache hit; touch the tile to reset its refresh time
+            store.touch(tile_info.zoom, tx, ty)
+            self.download_done(key)
+            return
+        if status != 200:
+            self.download_done(key, unavailable=True)
+            if self.debug:
+                print("Failed %s: HTTP %u" % (url, status))
+            return
+        content_type = resp.getheader('content-type')
+        if content_type is None or content_type.find('image') == -1:
+            self.download_done(key, unavailable=True)
+            if self.debug:
+                print("non-image response %s" % url)
+            return
 
-                #print('Error loading %s' % url)
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("Failed %s: %s" % (url, str(e)))
-                continue
-            if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("non-image response %s" % url)
-                continue
-            else:
-                img = resp.read()
+        # see if its a blank/unavailable tile
+        md5 = hashlib.md5(img).hexdigest()
+        if md5 in BLANK_TILES:
+            if self.debug:
+                print("blank tile %s" % url)
+            self.download_done(key, unavailable=True)
+            return
 
-            # see if its a blank/unavailable tile
-            md5 = hashlib.md5(img).hexdigest()
-            if md5 in BLANK_TILES:
-                if self.debug:
-                    print("blank tile %s" % url)
-                    if not key in self._tile_cache:
-                        self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                continue
+        store.put(tile_info.zoom, tx, ty, img)
+        self.download_done(key)
 
-            mp_util.mkdir_p(os.path.dirname(path))
-            h = open(path+'.tmp','wb')
-            h.write(img)
-            h.close()
+    def downloader(self):
+        '''a download worker thread, exits when the queue is empty'''
+        conns = {}
+        while True:
+            with self._download_lock:
+                tile_info = self.next_download()
+                if tile_info is None:
+                    self._download_threads -= 1
+                    break
             try:
-                os.unlink(path)
-            except Exception:
-                pass
-            os.rename(path+'.tmp', path)
-            self._download_pending.pop(key)
-        self._download_thread = None
+                self.download_tile(tile_info, conns)
+            except Exception as e:
+                self.download_done(tile_info.key(), unavailable=True)
+                print("Tile download failed: %s" % str(e))
+        for conn in conns.values():
+            conn.close()
 
     def start_download_thread(self):
-        '''start the downloader'''
-        if self._download_thread:
-            return
-        t = threading.Thread(target=self.downloader)
-        t.daemon = True
-        self._download_thread = t
-        t.start()
+        '''start download workers, up to download_workers of them'''
+        with self._download_lock:
+            while (self._download_threads < self.download_workers and
+                   self._download_threads < len(self._download_pending) - len(self._downloading)):
+                t = threading.Thread(target=self.downloader, name='tile_download')
+                t.daemon = True
+                self._download_threads += 1
+                t.start()
 
     def load_tile_lowres(self, tile):
         '''load a lower resolution tile from cache to fill in a
@@ -380,22 +948,17 @@ class MPTile:
 
             # see if its in the tile cache
             key = tile_info.key()
-            if key in self._tile_cache:
-                img = self._tile_cache[key]
-                if np.array_equal(img, np.array(self._unavailable)):
+            img = self._tile_cache.get(key)
+            if img is not None:
+                if self.is_sentinel(img):
                     continue
             else:
-                path = self.tile_to_path(tile_info)
-                if not os.path.exists(path):
-                    continue
-                img = cv2.imread(path)
+                (img, mtime) = self.read_tile(tile_info)
                 if img is None:
                     continue
                 #cv2.rectangle(img, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
                 # add it to the tile cache
-                self._tile_cache[key] = img
-                while len(self._tile_cache) > self.cache_size:
-                    self._tile_cache.popitem(0)
+                self._tile_cache.put(key, img)
 
             # copy out the quadrant we want
             availx = min(TILES_WIDTH - tile_info.offsetx, width2)
@@ -413,39 +976,41 @@ class MPTile:
             return scaled
         return None
 
+    def read_tile(self, tile):
+        '''read and decode a tile from the tile store, returning (img, mtime)
+        or (None, None) if it is not stored'''
+        (x, y) = tile.tile
+        r = self.store().get(tile.zoom, x, y)
+        if r is None:
+            return (None, None)
+        (data, mtime) = r
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return (None, None)
+        return (img, mtime)
+
     def load_tile(self, tile):
         '''load a tile from cache or tile server'''
 
         # see if its in the tile cache
         key = tile.key()
-        if key in self._tile_cache:
-            img = self._tile_cache[key]
-            if np.array_equal(img, self._unavailable):
+        img = self._tile_cache.get(key)
+        if img is not None:
+            if img is self._unavailable:
                 img = self.load_tile_lowres(tile)
                 if img is None:
                     img = self._unavailable
             return img
 
-
-        path = self.tile_to_path(tile)
-        if not os.path.exists(path):
-            ret = None
-        else:
-            ret = cv2.imread(path)
+        (ret, mtime) = self.read_tile(tile)
         if ret is not None:
             #cv2.rectangle(ret, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
             # if it is an old tile, then try to refresh
-            if os.path.getmtime(path) + self.refresh_age < time.time():
-                try:
-                        self._download_pending[key].refresh_time()
-                except Exception:
-                        self._download_pending[key] = tile
-                self.start_download_thread()
-                    
+            if mtime + self.refresh_age < time.time():
+                self.queue_download(tile)
+
             # add it to the tile cache
-            self._tile_cache[key] = ret
-            while len(self._tile_cache) > self.cache_size:
-                self._tile_cache.popitem(0)
+            self._tile_cache.put(key, ret)
             return ret
 
         if not self.download:
@@ -454,11 +1019,7 @@ class MPTile:
                 img = self._unavailable
             return img
 
-        try:
-            self._download_pending[key].refresh_time()
-        except Exception:
-            self._download_pending[key] = tile
-        self.start_download_thread()
+        self.queue_download(tile)
 
         img = self.load_tile_lowres(tile)
         if img is None:
@@ -594,10 +1155,11 @@ class MPTile:
 
         # order the display by distance from the middle, so the download happens
         # close to the middle of the image first
+        (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
         if ordered:
-            (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
             tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
+        self.begin_view(midlat, midlon)
         for t in tlist:
             scaled_tile = self.scaled_tile(t)
 
@@ -608,11 +1170,88 @@ class MPTile:
                 h = scaled_tile_roi.shape[0]
                 w = scaled_tile_roi.shape[1]
                 img[t.dsty:t.dsty+h, t.dstx:t.dstx+w] = scaled_tile_roi.copy()
+        self.end_view()
 
         # return as an RGB image
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         return img
 
+def stub_server_test(workers_list, count=200, latency=0.05):
+    '''test download throughput and ordering against a local HTTP stub
+    tile server with a fixed response latency'''
+    import shutil
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    tile_data = cv2.imencode('.png', np.zeros((TILES_HEIGHT, TILES_WIDTH, 3), np.uint8))[1].tobytes()
+    requests = []
+    clients = set()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(latency)
+            requests.append(self.path)
+            clients.add(self.client_address)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(tile_data)))
+            self.end_headers()
+            self.wfile.write(tile_data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    TILE_SERVICES['StubServer'] = 'http://127.0.0.1:%u/${ZOOM}/${X}/${Y}.png' % server.server_address[1]
+
+    for workers in workers_list:
+        cache_path = tempfile.mkdtemp()
+        mt = MPTile(cache_path=cache_path, service='StubServer', tile_delay=0, download_workers=workers)
+        del requests[:]
+        clients.clear()
+        t0 = time.time()
+        for i in range(count):
+            mt.load_tile(TileInfo((i % 64, i // 64), 12, 'StubServer'))
+        while mt.tiles_pending() > 0:
+            time.sleep(0.01)
+        dt = time.time() - t0
+        print("workers=%u %u tiles in %.2fs %.1f tiles/s, %u connections" % (
+            workers, len(requests), dt, len(requests)/dt, len(clients)))
+        shutil.rmtree(cache_path)
+
+    # ordering: a single worker should fetch the tiles closest to the
+    # view centre first, and drop tiles once the view moves away
+    cache_path = tempfile.mkdtemp()
+    mt = MPTile(cache_path=cache_path, service='StubServer', tile_delay=0, download_workers=1)
+    (lat, lon, ground_width) = (-35.362938, 149.165085, 20000)
+    del requests[:]
+    mt.area_to_image(lat, lon, 800, 600, ground_width)
+    (midlat, midlon) = mt.coord_from_area(400, 300, lat, lon, 800, ground_width)
+    queued = mt.tiles_pending()
+    time.sleep(latency * 3.5)
+    mt.area_to_image(lat+1, lon+1, 800, 600, ground_width)
+    while mt.tiles_pending() > 0:
+        time.sleep(0.01)
+    first_view = []
+    for path in requests:
+        (zoom, x, y) = [int(v) for v in path[1:-4].split('/')]
+        tile = TileInfo((x, y), zoom, 'StubServer')
+        if tile.distance(midlat, midlon) < ground_width:
+            first_view.append(tile.distance(midlat, midlon))
+    print("first view: %u tiles queued, %u fetched before moving, %u cancelled" % (
+        queued, len(first_view), queued - len(first_view)))
+    print("closest first: %s" % (first_view == sorted(first_view)))
+    shutil.rmtree(cache_path)
+    server.shutdown()
+
+
 def mp_icon(filename):
     '''load an icon from the data directory'''
     # we have to jump through a lot of hoops to get an OpenCV image
@@ -647,36 +1286,58 @@ if __name__ == "__main__":
     parser.add_option("--zoom", default=None, type='int', help="zoom level")
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
     parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
+    parser.add_option("--lat2", type='float', default=None, help="bounding box second corner latitude")
+    parser.add_option("--lon2", type='float', default=None, help="bounding box second corner longitude")
+    parser.add_option("--min-zoom", type='int', default=4, help="minimum tile zoom")
+    parser.add_option("--workers", type='int', default=4, help="number of download workers")
     parser.add_option("--boundary", default=None, help="region boundary")
+    parser.add_option("--kml", default=None, help="seed the polygons in a KML/KMZ file")
+    parser.add_option("--estimate", action='store_true', default=False, help="only estimate the tile count and size")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
+    parser.add_option("--tile-store", default='files', choices=TILE_STORES, help="tile store type")
+    parser.add_option("--stub-test", action='store_true', default=False,
+                      help="test downloads against a local stub tile server")
     (opts, args) = parser.parse_args()
 
-    lat = opts.lat
-    lon = opts.lon
-    ground_width = opts.width
+    if opts.stub_test:
+        stub_server_test([1, 4, 8])
+        sys.exit(0)
+
+    mt = MPTile(debug=opts.debug, service=opts.service,
+            tile_delay=opts.delay, max_zoom=opts.max_zoom,
+            tile_store=opts.tile_store, download_workers=opts.workers)
 
     if opts.boundary:
-        boundary = mp_util.polygon_load(opts.boundary)
-        bounds = mp_util.polygon_bounds(boundary)
-        lat = bounds[0]+bounds[2]
-        lon = bounds[1]
-        ground_width = max(mp_util.gps_distance(lat, lon, lat, mp_util.wrap_180(lon+bounds[3])),
-                           mp_util.gps_distance(lat, lon, lat-bounds[2], lon))
-        print(lat, lon, ground_width)
+        polygons = [mp_util.polygon_load(opts.boundary)]
+    elif opts.kml:
+        from MAVProxy.modules.lib import kmlread
+        kml = kmlread.KMLRead(opts.kml)
+        kml.parse()
+        polygons = []
+        for n in kml.placemark_nodes():
+            obj = kml.readObject(n)
+            if isinstance(obj, kmlread.Polygon):
+                polygons.append(obj.vertexes)
+            elif isinstance(obj, kmlread.Point):
+                polygons.append([obj.latlon])
+    elif opts.lat2 is not None and opts.lon2 is not None:
+        polygons = [[(opts.lat, opts.lon), (opts.lat2, opts.lon2)]]
+    else:
+        # a square of the given width with lat/lon at the top left
+        (lat2, lon2) = mp_util.gps_offset(opts.lat, opts.lon, opts.width, -opts.width)
+        polygons = [[(opts.lat, opts.lon), (lat2, lon2)]]
 
-    mt = MPTile(debug=opts.debug, service=opts.service,
-            tile_delay=opts.delay, max_zoom=opts.max_zoom)
-    if opts.zoom is None:
-        zooms = range(mt.min_zoom, mt.max_zoom+1)
+    if opts.zoom is not None:
+        (min_zoom, max_zoom) = (opts.zoom, opts.zoom)
     else:
-        zooms = [opts.zoom]
-    for zoom in zooms:
-        tlist = mt.area_to_tile_list(lat, lon, width=1024, height=1024,
-                         ground_width=ground_width, zoom=zoom)
-        print("zoom %u needs %u tiles" % (zoom, len(tlist)))
-        for tile in tlist:
-            mt.load_tile(tile)
-        while mt.tiles_pending() > 0:
-            time.sleep(2)
-            print("Waiting on %u tiles" % mt.tiles_pending())
+        (min_zoom, max_zoom) = (opts.min_zoom, mt.max_zoom)
+    seeder = TileSeeder(mt, polygons, min_zoom, max_zoom)
+    seeder.plan()
+    print(seeder.summary())
+    if opts.estimate:
+        sys.exit(0)
+    seeder.start()
+    while mt.tiles_pending() > 0:
+        time.sleep(2)
+        print(seeder.progress())
     print('Done')
@@ -75,6 +75,8 @@ def run_command(args, cwd=None, shell=False, timeout=None, env=None):
 
 
 class MiscModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['COMMAND_ACK'])
+
     def __init__(self, mpstate):
         super(MiscModule, self).__init__(mpstate, "misc", "misc commands", public=True)
         self.add_command('alt', self.cmd_alt, "show altitude information")
@@ -12,6 +12,8 @@ AP_FLAKE8_CLEAN
 
 
 class ModeModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['HIGH_LATENCY2'])
+
     def __init__(self, mpstate):
         super(ModeModule, self).__init__(mpstate, "mode", public=True)
         self.add_command('mode', self.cmd_mode, "mode change", [
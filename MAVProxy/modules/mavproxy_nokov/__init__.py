@@ -3,8 +3,7 @@ use nokov data to provide motion capture data
 it works with nokov software
 """
 
-import time
-
+from MAVProxy.modules.lib import mocap_bridge
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 #from MAVProxy.modules.mavproxy_nokov.nokov import nokovsdk
@@ -21,29 +20,26 @@ def py_data_func(pFrameOfMocapData, userdata):
     if pFrameOfMocapData == None:
         print("Not get the data frame.\n")
         return
+    # called in the SDK thread, poses are queued for the main loop to send
     frameData = pFrameOfMocapData.contents
     names_rigid = nokov_module.names_rigid
+    axis = nokov_module.nokov_settings.axis
+    bridge = nokov_module.bridge
     for i in range(frameData.nRigidBodies):
         if i >= len(names_rigid):
             break
         rigid = frameData.RigidBodies[i]
-        name = names_rigid[i]
-        if nokov_module.nokov_settings.tracker_name == name:
-            print('%f,%f,%f' % (rigid.x, rigid.y, rigid.z))
-            now = time.time()
-            time_us = int(now * 1.0e6)
-            x = rigid.x / 1000
-            y = rigid.y / 1000
-            z = rigid.z / 1000
-            qx = rigid.qx
-            qy = rigid.qy
-            qz = rigid.qz
-            qw = rigid.qw
-            if nokov_module.nokov_settings.axis == 'z':
-                nokov_module.master.mav.att_pos_mocap_send(time_us, (qw, qy, qx, -qz), y, x, -z)
-            elif nokov_module.nokov_settings.axis == 'y':
-                nokov_module.master.mav.att_pos_mocap_send(time_us, (qw, qx, qz, -qy), x, z, -y)
-            return
+        x = rigid.x / 1000
+        y = rigid.y / 1000
+        z = rigid.z / 1000
+        qx = rigid.qx
+        qy = rigid.qy
+        qz = rigid.qz
+        qw = rigid.qw
+        if axis == 'z':
+            bridge.push(names_rigid[i], (y, x, -z), (qw, qy, qx, -qz))
+        elif axis == 'y':
+            bridge.push(names_rigid[i], (x, z, -y), (qw, qx, qz, -qy))
 
 
 class NokovModule(mp_module.MPModule):
@@ -58,12 +54,20 @@ class NokovModule(mp_module.MPModule):
              ('axis', str, 'z'),
              ('tracker_name', str, None)]
         )
-        self.add_command('nokov', self.cmd_nokov, "nokov control", ['<start>', '<stop>', 'set (NOKOVSETTING)'])
+        # with nothing mapped, tracker_name is sent to the master link
+        self.bridge = mocap_bridge.MocapBridge(mpstate, "nokov", settings=self.nokov_settings, rate=100.0)
+        self.add_command('nokov', self.cmd_nokov, "nokov control",
+                         ['<start|stop|mappings|stats|reset>',
+                          'map BODY <sysid|links|rate>',
+                          'unmap BODY',
+                          'set (NOKOVSETTING)'])
+        self.add_completion_function('(NOKOVSETTING)', self.nokov_settings.completion)
 
     def cmd_stop(self):
         del self.client
         self.client = None
         self.names_rigid = []
+        self.bridge.stop()
 
     def cmd_start(self):
         if self.client != None:
@@ -73,6 +77,7 @@ class NokovModule(mp_module.MPModule):
         client = nokovsdk.PySDKClient()
         ver = client.PyNokovVersion()
         print('SeekerSDK ver. %d.%d.%d.%d' % (ver[0], ver[1], ver[2], ver[3]))
+        self.bridge.start()
         client.PySetDataCallback(py_data_func, None)
         ret = client.Initialize(bytes(self.nokov_settings.host, encoding="utf8"))
         if ret == 0:
@@ -102,7 +107,7 @@ class NokovModule(mp_module.MPModule):
 
     def usage(self):
         '''show help on command line options'''
-        return "Usage: nokov <start|stop|set>"
+        return "Usage: nokov <start|stop|set|map|unmap|mappings|stats|reset>"
 
     def cmd_nokov(self, args):
         '''control behaviour of the module'''
@@ -114,12 +119,18 @@ class NokovModule(mp_module.MPModule):
             self.cmd_stop()
         elif args[0] == "set":
             self.nokov_settings.command(args[1:])
+        elif args[0] in ["map", "unmap", "mappings", "stats", "reset"]:
+            self.bridge.command(args)
         else:
             print(self.usage())
 
     def idle_task(self):
         '''called rapidly by mavproxy'''
-        pass
+        if self.client is None:
+            return
+        if self.nokov_settings.tracker_name is not None:
+            self.bridge.set_default(self.nokov_settings.tracker_name)
+        self.bridge.service()
 
 
 def init(mpstate):
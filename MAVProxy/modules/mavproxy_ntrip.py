@@ -2,12 +2,12 @@
 send NTRIP data to flight controller
 """
 
-import random
 import time
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import ntrip
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import rtcm_inject
 
 
 class NtripModule(mp_module.MPModule):
@@ -28,6 +28,7 @@ class NtripModule(mp_module.MPModule):
                          ["<status>",
                           "<start>",
                           "<stop>",
+                          "<inject> <status|set|priority>",
                           "set (NTRIPSETTING)"])
         self.add_completion_function('(NTRIPSETTING)',
                                      self.ntrip_settings.completion)
@@ -43,6 +44,7 @@ class NtripModule(mp_module.MPModule):
         self.logfile = None
         self.id_counts = {}
         self.last_by_id = {}
+        self.injector = rtcm_inject.shared_injector(mpstate)
 
     def mavlink_packet(self, msg):
         '''handle an incoming mavlink packet'''
@@ -61,21 +63,28 @@ class NtripModule(mp_module.MPModule):
 
     def idle_task(self):
         '''called on idle'''
+        self.injector.service()
         if self.start_pending and self.ntrip is None and self.pos is not None:
             self.cmd_start()
         if self.ntrip is None:
             return
-        data = self.ntrip.read()
-        if data is None:
-            now = time.time()
-            if (self.last_pkt is not None and
-                now - self.last_pkt > 15 and
-                (self.last_restart is None or now - self.last_restart > 30)):
-                print("NTRIP restart")
-                self.ntrip = None
-                self.start_pending = True
-                self.last_restart = now
-            return
+        while self.ntrip is not None:
+            data = self.ntrip.read()
+            if data is None:
+                break
+            self.handle_rtcm(data)
+        now = time.time()
+        if (self.ntrip is not None and
+            self.last_pkt is not None and
+            now - self.last_pkt > 15 and
+            (self.last_restart is None or now - self.last_restart > 30)):
+            print("NTRIP restart")
+            self.ntrip = None
+            self.start_pending = True
+            self.last_restart = now
+
+    def handle_rtcm(self, data):
+        '''pass one RTCM3 packet from the caster to the injector'''
         if time.time() - self.ntrip.dt_last_gga_sent > 2:
             self.ntrip.setPosition(self.pos[0], self.pos[1])
             self.ntrip.send_gga()
@@ -86,49 +95,23 @@ class NtripModule(mp_module.MPModule):
             self.id_counts[rtcm_id] = 0
             self.last_by_id[rtcm_id] = data[:]
         self.id_counts[rtcm_id] += 1
+        now = time.time()
+        self.last_pkt = now
 
-        blen = len(data)
-        if blen > 4*180:
-            # can't send this with GPS_RTCM_DATA
+        links = 'all' if self.ntrip_settings.sendalllinks else None
+        if not self.injector.submit(data, source='ntrip', links=links,
+                                    repeat=self.ntrip_settings.sendmul,
+                                    frag_drop_pct=self.ntrip_settings.frag_drop_pct):
             return
-        total_len = blen
-        self.rate_total += blen * self.ntrip_settings.sendmul
-
-        if blen > 180:
-            flags = 1 # fragmented
-        else:
-            flags = 0
-        # add in the sequence number
-        flags |= (self.pkt_count & 0x1F) << 3
-
-        fragment = 0
-        while blen > 0:
-            send_data = bytearray(data[:180])
-            frag_len = len(send_data)
-            data = data[frag_len:]
-            if frag_len < 180:
-                send_data.extend(bytearray([0]*(180-frag_len)))
-            if self.ntrip_settings.sendalllinks:
-                links = self.mpstate.mav_master
-            else:
-                links = [self.master]
-            for link in links:
-                for d in range(self.ntrip_settings.sendmul):
-                    if random.random() * 100 < self.ntrip_settings.frag_drop_pct:
-                        continue
-                    link.mav.gps_rtcm_data_send(flags | (fragment<<1), frag_len, send_data)
-            fragment += 1
-            blen -= frag_len
+        self.rate_total += len(data) * self.ntrip_settings.sendmul
         self.pkt_count += 1
 
-        now = time.time()
         if now - self.last_rate > 1:
             dt = now - self.last_rate
             rate_now = self.rate_total / float(dt)
             self.rate = 0.9 * self.rate + 0.1 * rate_now
             self.last_rate = now
             self.rate_total = 0
-        self.last_pkt = now
 
     def cmd_ntrip(self, args):
         '''ntrip command handling'''
@@ -144,6 +127,8 @@ class NtripModule(mp_module.MPModule):
             self.ntrip_status()
         elif args[0] == "set":
             self.ntrip_settings.command(args[1:])
+        elif args[0] == "inject":
+            self.injector.command(args[1:])
 
     def ntrip_status(self):
         '''show ntrip status'''
@@ -159,6 +144,9 @@ class NtripModule(mp_module.MPModule):
             print(" %4u: %u (len %u)" % (id, self.id_counts[id], len(self.last_by_id[id])))
             frame_size += len(self.last_by_id[id])
         print("ntrip: %u packets, %.1f bytes/sec last %.1fs ago framesize %u" % (self.pkt_count, self.rate, now - self.last_pkt, frame_size))
+        print("injection:")
+        for line in self.injector.status_lines():
+            print(line)
 
     def cmd_start(self):
         '''start ntrip link'''
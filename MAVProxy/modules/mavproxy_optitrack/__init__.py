@@ -2,11 +2,11 @@
 # it works with optitrack motion capture cameras and optitrack motive tracker software (https://optitrack.com/software/motive/)
 # yuan-chu tai
 
-import time
 from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mocap_bridge
 from MAVProxy.modules.mavproxy_optitrack import NatNetClient
 
 class optitrack(mp_module.MPModule):
@@ -21,31 +21,36 @@ class optitrack(mp_module.MPModule):
             ('print_lv', int, 0),
             ('multicast', bool, True)]
         )
-        self.add_command('optitrack', self.cmd_optitrack, "optitrack control", ['<start>', '<stop>', 'set (OPTITRACKSETTING)'])
+        # bodies without a mapping go nowhere, unless nothing is mapped in
+        # which case obj_id is sent to the master link every msg_intvl_ms
+        self.bridge = mocap_bridge.MocapBridge(mpstate, "optitrack", settings=self.optitrack_settings)
+        self.add_command('optitrack', self.cmd_optitrack, "optitrack control",
+                         ['<start|stop|mappings|stats|reset>',
+                          'map BODY <sysid|links|rate>',
+                          'unmap BODY',
+                          'set (OPTITRACKSETTING)'])
+        self.add_completion_function('(OPTITRACKSETTING)', self.optitrack_settings.completion)
         self.streaming_client = NatNetClient.NatNetClient()
         # Configure the streaming client to call our rigid body handler on the emulator to send data out.
         self.streaming_client.rigid_body_listener = self.receive_rigid_body_frame
-        self.last_msg_time = 0
         self.started = False
 
     # This is a callback function that gets connected to the NatNet client. It is called once per rigid body per frame
+    # in the NatNet thread, so it only queues the pose for the main loop
     def receive_rigid_body_frame(self, new_id, position, rotation):
-        if (new_id == self.optitrack_settings.obj_id):
-            now = time.time()
-            if (now - self.last_msg_time) > (self.optitrack_settings.msg_intvl_ms * 0.001):
-                time_us = int(now * 1.0e6)
-                self.master.mav.att_pos_mocap_send(time_us, (rotation[3], rotation[0], rotation[2], -rotation[1]), position[0], position[2], -position[1])
-                self.last_msg_time = now
+        self.bridge.push(new_id, (position[0], position[2], -position[1]),
+                         (rotation[3], rotation[0], rotation[2], -rotation[1]))
 
     def usage(self):
         '''show help on command line options'''
-        return "Usage: optitrack <start|stop|set>"
+        return "Usage: optitrack <start|stop|set|map|unmap|mappings|stats|reset>"
 
     def cmd_start(self):
         self.streaming_client.set_client_address(self.optitrack_settings.client)
         self.streaming_client.set_server_address(self.optitrack_settings.server)
         self.streaming_client.set_print_level(self.optitrack_settings.print_lv)
         self.streaming_client.set_use_multicast(self.optitrack_settings.multicast)
+        self.bridge.start()
         self.streaming_client.run()
         self.started = True
 
@@ -59,11 +64,28 @@ class optitrack(mp_module.MPModule):
             if self.started:
                 self.started = False
                 self.streaming_client.shutdown()
+                self.bridge.stop()
         elif args[0] == "set":
             self.optitrack_settings.command(args[1:])
+        elif args[0] in ["map", "unmap", "mappings", "stats", "reset"]:
+            self.bridge.command(args)
         else:
             print(self.usage())
 
+    def idle_task(self):
+        '''send queued poses that are due'''
+        if not self.started:
+            return
+        self.bridge.set_default(self.optitrack_settings.obj_id,
+                                rate=1000.0 / max(self.optitrack_settings.msg_intvl_ms, 1))
+        self.bridge.service()
+
+    def unload(self):
+        if self.started:
+            self.started = False
+            self.streaming_client.shutdown()
+        self.bridge.stop()
+
 def init(mpstate):
     '''initialise module'''
     return optitrack(mpstate)
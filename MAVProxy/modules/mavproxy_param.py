@@ -13,6 +13,7 @@ import struct
 from pymavlink import mavutil, mavparm
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import param_cache
 from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.lib import param_ftp
 
@@ -36,13 +37,64 @@ except ImportError:
     from Queue import Empty
 
 
+class ParamIndexSet(object):
+    '''received parameter indexes, held as a bitmap'''
+    def __init__(self, count=0):
+        self.bits = bytearray(b'\xff' * (count // 8))
+        self.count = len(self.bits) * 8
+        self.low = self.count
+        for idx in range(self.count, count):
+            self.add(idx)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, idx):
+        if idx < 0 or idx // 8 >= len(self.bits):
+            return False
+        return (self.bits[idx // 8] >> (idx % 8)) & 1 == 1
+
+    def add(self, idx):
+        if idx < 0 or idx in self:
+            return
+        n = idx // 8 + 1
+        if n > len(self.bits):
+            self.bits.extend(bytearray(n - len(self.bits)))
+        self.bits[idx // 8] |= 1 << (idx % 8)
+        self.count += 1
+        while self.low in self:
+            self.low += 1
+
+    def missing(self, limit, max_count):
+        '''up to max_count missing indexes below limit, lowest first'''
+        ret = []
+        idx = self.low
+        while idx < limit and len(ret) < max_count:
+            if idx % 8 == 0 and idx // 8 < len(self.bits) and self.bits[idx // 8] == 0xFF:
+                idx += 8
+                continue
+            if idx not in self:
+                ret.append(idx)
+            idx += 1
+        return ret
+
+
 class ParamState:
     '''this class is separated to make it possible to use the parameter
        functions on a secondary connection'''
     def __init__(self, mav_param, logdir, vehicle_name, parm_file, mpstate, sysid):
-        self.mav_param_set = set()
+        self.mav_param_set = ParamIndexSet()
         self.mav_param_count = 0
         self.param_period = mavutil.periodic_event(1)
+        # parameter names by index, for the cache
+        self.index_names = {}
+        # firmware identity from AUTOPILOT_VERSION and _HASH_CHECK value
+        self.identity = None
+        self.param_hash = None
+        # None until the cache has been checked, then 'probe' and 'done'
+        self.cache_state = None
+        self.cache_probe_start = 0
+        self.cache_dirty = False
         self.fetch_one = dict()
         self.mav_param = mav_param
         self.logdir = logdir
@@ -245,14 +297,22 @@ class ParamState:
     def handle_mavlink_packet(self, master, m):
         '''handle an incoming mavlink packet'''
         if m.get_type() == 'PARAM_VALUE':
+            param_id = "%.16s" % m.param_id
+            if param_id == '_HASH_CHECK':
+                # the hash is sent as the bits of the float value
+                self.param_hash, = struct.unpack('<I', struct.pack('<f', m.param_value))
+                if self.cache_state == 'probe':
+                    self.cache_probe_check(master)
+                return
             self.handle_mavlink_watch_param_value(master, m)
             value = self.handle_px4_param_value(m)
-            param_id = "%.16s" % m.param_id
             # Note: the xml specifies param_index is a uint16, so -1 in that field will show as 65535
             # We accept both -1 and 65535 as 'unknown index' to future proof us against someday having that
             # xml fixed.
             if self.fetch_set is not None:
                 self.fetch_set.discard(m.param_index)
+            if m.param_index != -1 and m.param_index != 65535:
+                self.index_names[m.param_index] = str(param_id)
             if m.param_index != -1 and m.param_index != 65535 and m.param_index not in self.mav_param_set:
                 added_new_parameter = True
                 self.mav_param_set.add(m.param_index)
@@ -260,6 +320,8 @@ class ParamState:
                 added_new_parameter = False
             if m.param_count != -1:
                 self.mav_param_count = m.param_count
+            if self.cache_state == 'done' and self.mav_param.get(str(param_id), None) != value:
+                self.cache_dirty = True
             self.mav_param[str(param_id)] = value
             if param_id in self.fetch_one and self.fetch_one[param_id] > 0:
                 self.fetch_one[param_id] -= 1
@@ -272,6 +334,9 @@ class ParamState:
                 if self.logdir is not None:
                     self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
                 self.fetch_set = None
+                self.cache_dirty = True
+            if self.cache_state == 'probe':
+                self.cache_probe_check(master)
             if self.fetch_set is not None and len(self.fetch_set) == 0:
                 self.fetch_check(master, force=True)
 
@@ -289,27 +354,116 @@ class ParamState:
                 # remember autopilot types so we can handle PX4 parameters
                 self.autopilot_type_by_sysid[m.get_srcSystem()] = m.autopilot
 
+        elif m.get_type() == 'AUTOPILOT_VERSION':
+            self.identity = param_cache.identity_from_version(m)
+            if self.cache_state == 'probe':
+                self.cache_probe_check(master)
+
     def fetch_check(self, master, force=False):
         '''check for missing parameters periodically'''
         if self.param_period.trigger() or force:
             if master is None:
                 return
+            if self.cache_state == 'probe':
+                self.cache_probe_check(master)
+                return
+            if (self.cache_dirty and self.identity is not None and self.mav_param_count != 0 and
+                    len(self.mav_param_set) == self.mav_param_count):
+                self.cache_dirty = False
+                self.save_cache()
             if len(self.mav_param_set) == 0 and not self.ftp_started:
-                if not self.use_ftp():
+                if self.cache_state is None and self.mpstate.settings.param_cache:
+                    self.cache_probe(master)
+                elif not self.use_ftp():
                     master.param_fetch_all()
                 else:
                     self.ftp_start()
             elif not self.ftp_started and self.mav_param_count != 0 and len(self.mav_param_set) != self.mav_param_count:
                 if master.time_since('PARAM_VALUE') >= 1 or force:
-                    diff = set(range(self.mav_param_count)).difference(self.mav_param_set)
-                    count = 0
-                    while len(diff) > 0 and count < 10:
-                        idx = diff.pop()
+                    for idx in self.mav_param_set.missing(self.mav_param_count, 10):
                         master.param_fetch_one(idx)
                         if self.fetch_set is None:
                             self.fetch_set = set()
                         self.fetch_set.add(idx)
-                        count += 1
+
+    def cache_probe(self, master):
+        '''ask for what is needed to check the parameter cache: the
+        firmware identity, the parameter count and, where supported, the
+        parameter hash'''
+        self.cache_state = 'probe'
+        self.cache_probe_start = time.time()
+        if self.identity is None:
+            master.mav.command_long_send(
+                self.sysid[0], self.sysid[1],
+                mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE, 0,
+                mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION, 0, 0, 0, 0, 0, 0)
+        master.mav.param_request_read_send(self.sysid[0], self.sysid[1], b'_HASH_CHECK', -1)
+        master.mav.param_request_read_send(self.sysid[0], self.sysid[1], b'', 0)
+
+    def cache_probe_check(self, master):
+        '''use the cache if it matches the vehicle, otherwise fall back to
+        fetching the parameters'''
+        elapsed = time.time() - self.cache_probe_start
+        have_count = self.mav_param_count != 0
+        if elapsed < 3 and not (have_count and self.identity is not None and
+                                (self.param_hash is not None or elapsed > 1.5)):
+            return
+        self.cache_state = 'done'
+        if self.cache_matches():
+            return
+        # start again with a full fetch
+        self.mav_param_set = ParamIndexSet()
+        self.fetch_set = None
+        self.fetch_check(master, force=True)
+
+    def cache_matches(self):
+        '''load the cached parameters if they match the vehicle. The
+        fetch is only skipped when the vehicle gives a parameter hash;
+        without one the cached values are only a provisional fill until
+        the full fetch confirms them'''
+        if self.identity is None or self.mav_param_count == 0:
+            return False
+        cached = param_cache.load(self.sysid, self.identity)
+        if cached is None:
+            return False
+        (count, cached_hash, params) = cached
+        if count != self.mav_param_count:
+            print("Parameter cache count %u does not match %u" % (count, self.mav_param_count))
+            return False
+        if self.param_hash is not None and cached_hash != self.param_hash:
+            print("Parameter cache hash 0x%08x does not match 0x%08x" % (cached_hash or 0, self.param_hash))
+            return False
+        self.mav_param.clear()
+        self.index_names = {}
+        self.param_types = {}
+        for (idx, (name, value, ptype)) in enumerate(params):
+            self.mav_param[str(name)] = value
+            self.index_names[idx] = str(name)
+            if ptype is not None:
+                self.param_types[str(name).upper()] = ptype
+        if self.param_hash is None:
+            # nothing to prove the values are current, fetch them all
+            print("Loaded %u cached parameters, fetching to confirm" % count)
+            return False
+        self.mav_param_set = ParamIndexSet(count)
+        self.fetch_set = None
+        print("Loaded %u parameters from cache (matched hash 0x%08x)" % (count, self.param_hash))
+        self.mpstate.console.set_status('Params', 'Param %u/%u' % (count, count))
+        if self.logdir is not None:
+            self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
+        return True
+
+    def save_cache(self):
+        '''save the parameters for a fast start next time'''
+        if self.identity is None or not self.mpstate.settings.param_cache:
+            return
+        params = []
+        for idx in range(self.mav_param_count):
+            name = self.index_names.get(idx, None)
+            if name is None or name not in self.mav_param:
+                return
+            params.append((name, self.mav_param[name], self.param_types.get(name.upper(), None)))
+        param_cache.save(self.sysid, self.identity, self.mav_param_count, self.param_hash, params)
 
     def param_use_xml_filepath(self, filepath):
         self.param_help.xml_filepath = filepath
@@ -358,7 +512,7 @@ class ParamState:
             mav.srcComponent = mavutil.mavlink.MAV_COMP_ID_MISSIONPLANNER
             try:
                 buf = p.pack(mav)
-                self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + buf))
+                self.mpstate.logqueue.write_packet(usec, buf)
                 # also give to param editor so it can update for changes
                 if editor:
                     editor.mavlink_packet(p)
@@ -400,10 +554,10 @@ class ParamState:
         with_defaults = pdata.defaults is not None
 
         self.param_types = {}
-        self.mav_param_set = set()
         self.fetch_one = dict()
         self.fetch_set = None
         self.mav_param.clear()
+        self.index_names = {}
         total_params = len(pdata.params)
         self.mav_param_count = total_params
 
@@ -412,9 +566,11 @@ class ParamState:
             # we need to set it to REAL32 to ensure we use write value for param_set
             name = str(name.decode('utf-8'))
             self.param_types[name] = mavutil.mavlink.MAV_PARAM_TYPE_REAL32
-            self.mav_param_set.add(idx)
             self.mav_param[name] = v
+            self.index_names[idx] = name
             idx += 1
+        self.mav_param_set = ParamIndexSet(total_params)
+        self.cache_dirty = True
 
         self.ftp_failed = False
         self.mpstate.console.set_status('Params', 'Param %u/%u' % (total_params, total_params))
@@ -437,7 +593,7 @@ class ParamState:
         '''force refetch of parameters'''
         if not self.use_ftp():
             master.param_fetch_all()
-            self.mav_param_set = set()
+            self.mav_param_set = ParamIndexSet()
         else:
             self.ftp_start()
 
@@ -930,6 +1086,8 @@ class ParamState:
 
 
 class ParamModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['PARAM_VALUE', 'HEARTBEAT', 'AUTOPILOT_VERSION'])
+
     def __init__(self, mpstate, **kwargs):
         super(ParamModule, self).__init__(mpstate, "param", "parameter handling", public=True, multi_vehicle=True)
         self.xml_filepath = kwargs.get("xml-filepath", None)
@@ -998,7 +1156,7 @@ class ParamModule(mp_module.MPModule):
             parmfile = os.path.join(self.logdir, fname)
             if os.path.exists(parmfile):
                 self.mpstate.mav_param.load(parmfile)
-                self.pstate[sysid].mav_param_set = set(self.mav_param.keys())
+                self.pstate[sysid].mav_param_set = ParamIndexSet(len(self.mav_param.keys()))
         self.pstate[sysid].param_help.xml_filepath = self.xml_filepath
 
     def get_sysid(self):
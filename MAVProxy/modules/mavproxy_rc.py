@@ -19,6 +19,8 @@ if mp_util.has_wxpython:
 
 
 class RCModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['RC_CHANNELS', 'SERVO_OUTPUT_RAW'])
+
     def __init__(self, mpstate):
         super(RCModule, self).__init__(mpstate, "rc", "rc command handling", public=True)
         self.count = 18
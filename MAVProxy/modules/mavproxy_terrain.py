@@ -1,15 +1,80 @@
 """
   MAVProxy terrain handling module
+
+  Each TERRAIN_REQUEST covers a grid of 8x7 blocks of 4x4 points. Whole
+  grids are computed in one vectorised pass and cached, and grids along
+  the loaded mission and ahead of the vehicle are computed before the
+  autopilot asks for them.
 """
 
+import collections
+import math
 import time
 
+import numpy
+
 from MAVProxy.modules.lib import mp_elevation
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 
+# ArduPilot stores terrain in grid blocks aligned to whole degrees, each
+# 28 points north by 32 east and overlapping its neighbours
+GRID_BLOCK_SPACING_X = 24
+GRID_BLOCK_SPACING_Y = 28
+LOCATION_SCALING_FACTOR = 0.011131884502145034
+
+# cached grids match requests within this many 1e-7 degrees
+GRID_MATCH_TOLERANCE = 100
+
+# offsets in grid spacings of the 56 blocks and their 16 points, in
+# TERRAIN_DATA order
+_bits = numpy.arange(56)
+BLOCK_EAST = numpy.repeat(4 * (_bits % 8), 16).reshape(56, 16)
+BLOCK_NORTH = numpy.repeat(4 * (_bits // 8), 16).reshape(56, 16)
+_points = numpy.arange(16)
+POINT_EAST = numpy.tile(_points % 4, (56, 1))
+POINT_NORTH = numpy.tile(_points // 4, (56, 1))
+
+
+def grid_origin(lat, lon, spacing):
+    '''the SW corner in 1e-7 degrees of the autopilot's grid block holding
+    lat/lon in degrees, following AP_Terrain::calculate_grid_info'''
+    lat_deg = int(math.floor(lat))
+    lon_deg = int(math.floor(lon))
+    ref_lat = lat_deg * 10000000
+    ref_lng = lon_deg * 10000000
+    lat_e7 = int(lat * 1.0e7)
+    lon_e7 = int(lon * 1.0e7)
+    scale = max(math.cos(math.radians((ref_lat + lat_e7) * 0.5e-7)), 0.01)
+    north = (lat_e7 - ref_lat) * LOCATION_SCALING_FACTOR
+    east = (lon_e7 - ref_lng) * LOCATION_SCALING_FACTOR * scale
+    grid_x = int(north / spacing) // GRID_BLOCK_SPACING_X
+    grid_y = int(east / spacing) // GRID_BLOCK_SPACING_Y
+    dlat = int(grid_x * GRID_BLOCK_SPACING_X * spacing / LOCATION_SCALING_FACTOR)
+    scale = max(math.cos(math.radians((ref_lat + dlat * 0.5) * 1.0e-7)), 0.01)
+    dlng = int(grid_y * GRID_BLOCK_SPACING_Y * spacing / LOCATION_SCALING_FACTOR / scale)
+    return (ref_lat + dlat, ref_lng + dlng)
+
+
+class TerrainGrid(object):
+    '''terrain heights for the 56 blocks of one TERRAIN_REQUEST'''
+    def __init__(self, lat, lon, spacing, data, complete):
+        self.lat = lat
+        self.lon = lon
+        self.spacing = spacing
+        self.data = data
+        self.complete = complete
+        self.created = time.time()
+
+    def all_complete(self):
+        return bool(self.complete.all())
+
+
 class TerrainModule(mp_module.MPModule):
+    mavlink_packet_types = frozenset(['TERRAIN_REQUEST', 'TERRAIN_REPORT', 'GLOBAL_POSITION_INT',
+                                      'RADIO', 'RADIO_STATUS'])
+
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=True)
 
@@ -20,12 +85,29 @@ class TerrainModule(mp_module.MPModule):
         self.blocks_sent = 0
         self.check_lat = 0
         self.check_lon = 0
+        self.grids = collections.OrderedDict()
+        self.grids_computed = 0
+        self.cache_hits = 0
+        self.send_credit = 0.0
+        self.last_credit = time.time()
+        self.txbuf = None
+        self.last_radio = 0
+        self.spacing = None
+        self.position = None
+        self.prefetch = collections.deque()
+        self.prefetch_keys = set()
+        self.mission_change = None
+        self.last_velocity_prefetch = 0
         self.add_command('terrain', self.cmd_terrain, "terrain control",
                          ["<status|check>",
                           'set (TERRAINSETTING)'])
         self.terrain_settings = mp_settings.MPSettings([('debug', int, 0),
                                                         ('enable', int, 1),
                                                         ('offline', int, 0),
+                                                        ('rate', float, 20.0),
+                                                        ('cache_size', int, 500),
+                                                        ('prefetch', int, 1),
+                                                        ('lookahead', float, 60.0),
                                                         mp_settings.MPSetting('source', str, "SRTM3", choice=mp_elevation.TERRAIN_SERVICES.keys())])
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
 
@@ -41,10 +123,14 @@ class TerrainModule(mp_module.MPModule):
             print("blocks_sent: %u requests_received: %u" % (
                 self.blocks_sent,
                 self.requests_received))
+            print("grids cached: %u computed: %u cache hits: %u prefetch pending: %u rate: %.1f" % (
+                len(self.grids), self.grids_computed, self.cache_hits,
+                len(self.prefetch), self.send_rate()))
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
             # Re-init terrain model
             self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source, offline=self.terrain_settings.offline)
+            self.grids.clear()
         elif args[0] == "check":
             self.cmd_terrain_check(args[1:])
         else:
@@ -72,6 +158,14 @@ class TerrainModule(mp_module.MPModule):
             self.current_request = msg
             self.sent_mask = 0
             self.requests_received += 1
+            if self.spacing != msg.grid_spacing:
+                self.spacing = msg.grid_spacing
+                self.mission_change = None
+        elif mtype in ['RADIO', 'RADIO_STATUS']:
+            self.txbuf = msg.txbuf
+            self.last_radio = time.time()
+        elif mtype == 'GLOBAL_POSITION_INT':
+            self.position = msg
         elif mtype == 'TERRAIN_REPORT':
             if (msg.lat == self.check_lat and
                 msg.lon == self.check_lon and
@@ -80,65 +174,176 @@ class TerrainModule(mp_module.MPModule):
                 self.check_lat = 0
                 self.check_lon = 0
 
+    def compute_grid(self, lat, lon, spacing):
+        '''compute all 56 blocks of the grid with SW corner lat/lon in 1e-7 degrees'''
+        (blat, blon) = mp_util.gps_offset_array(lat * 1.0e-7, lon * 1.0e-7,
+                                                BLOCK_EAST * spacing, BLOCK_NORTH * spacing)
+        (plat, plon) = mp_util.gps_offset_array(blat, blon,
+                                                POINT_EAST * spacing, POINT_NORTH * spacing)
+        alt = self.ElevationModel.GetElevationArray(plat, plon)
+        complete = ~numpy.isnan(alt).any(axis=1)
+        data = numpy.zeros(alt.shape, dtype=int)
+        data[complete] = numpy.trunc(alt[complete]).astype(int)
+        self.grids_computed += 1
+        return TerrainGrid(lat, lon, spacing, data, complete)
+
+    def grid_key(self, lat, lon, spacing):
+        return (spacing, lat // 1000, lon // 1000)
+
+    def find_grid(self, lat, lon, spacing):
+        '''find a cached grid within GRID_MATCH_TOLERANCE of lat/lon'''
+        (spacing, klat, klon) = self.grid_key(lat, lon, spacing)
+        for dlat in (-1, 0, 1):
+            for dlon in (-1, 0, 1):
+                for grid in self.grids.get((spacing, klat+dlat, klon+dlon), []):
+                    if abs(grid.lat - lat) <= GRID_MATCH_TOLERANCE and abs(grid.lon - lon) <= GRID_MATCH_TOLERANCE:
+                        return grid
+        return None
+
+    def get_grid(self, lat, lon, spacing):
+        '''return the cached grid for lat/lon, computing it if needed.
+        Incomplete grids are recomputed once a second while tiles load'''
+        grid = self.find_grid(lat, lon, spacing)
+        if grid is not None:
+            if grid.all_complete() or time.time() - grid.created < 1:
+                self.cache_hits += 1
+                return grid
+            self.remove_grid(grid)
+        grid = self.compute_grid(lat, lon, spacing)
+        key = self.grid_key(lat, lon, spacing)
+        if key not in self.grids:
+            self.grids[key] = []
+        self.grids[key].append(grid)
+        self.grids.move_to_end(key)
+        while len(self.grids) > max(1, self.terrain_settings.cache_size):
+            self.grids.popitem(last=False)
+        return grid
+
+    def remove_grid(self, grid):
+        key = self.grid_key(grid.lat, grid.lon, grid.spacing)
+        if key in self.grids and grid in self.grids[key]:
+            self.grids[key].remove(grid)
+            if len(self.grids[key]) == 0:
+                self.grids.pop(key)
+
     def send_terrain_data_bit(self, bit):
         '''send some terrain data'''
-        lat = self.current_request.lat * 1.0e-7
-        lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
-                if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
-        self.master.mav.terrain_data_send(self.current_request.lat,
-                                          self.current_request.lon,
-                                          self.current_request.grid_spacing,
+        req = self.current_request
+        grid = self.get_grid(req.lat, req.lon, req.grid_spacing)
+        if not grid.complete[bit]:
+            if self.terrain_settings.debug:
+                print("no alt for block %u" % bit)
+            return False
+        self.master.mav.terrain_data_send(req.lat,
+                                          req.lon,
+                                          req.grid_spacing,
                                           bit,
-                                          data)
+                                          grid.data[bit].tolist())
         self.blocks_sent += 1
         self.last_send_time = time.time()
         self.sent_mask |= 1<<bit
         if self.terrain_settings.debug and bit == 55:
-            lat = self.current_request.lat * 1.0e-7
-            lon = self.current_request.lon * 1.0e-7
+            lat = req.lat * 1.0e-7
+            lon = req.lon * 1.0e-7
             print("--lat=%f --lon=%f %.1f" % (
                 lat, lon, self.ElevationModel.GetElevation(lat, lon)))
             (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=32*self.current_request.grid_spacing,
-                                             north=28*self.current_request.grid_spacing)
+                                             east=32*req.grid_spacing,
+                                             north=28*req.grid_spacing)
             print("--lat=%f --lon=%f %.1f" % (
                 lat2, lon2, self.ElevationModel.GetElevation(lat2, lon2)))
-
+        return True
 
     def send_terrain_data(self):
-        '''send some terrain data'''
+        '''send the next wanted block, returning False if there is nothing to send now'''
         for bit in range(56):
             if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
-                self.send_terrain_data_bit(bit)
-                return
+                return self.send_terrain_data_bit(bit)
         # no bits to send
         self.current_request = None
         self.sent_mask = 0
+        return False
+
+    def send_rate(self):
+        '''blocks per second, backing off when the radio reports a filling buffer'''
+        rate = self.terrain_settings.rate
+        if self.txbuf is not None and time.time() - self.last_radio < 5 and self.txbuf < 50:
+            rate *= max(self.txbuf, 2) / 50.0
+        return max(rate, 1.0)
+
+    def queue_prefetch(self, lat, lon):
+        '''queue the grid holding lat/lon in degrees'''
+        (glat, glon) = grid_origin(lat, lon, self.spacing)
+        key = (glat, glon, self.spacing)
+        if key in self.prefetch_keys or self.find_grid(glat, glon, self.spacing) is not None:
+            return
+        self.prefetch_keys.add(key)
+        self.prefetch.append(key)
+
+    def queue_path(self, points):
+        '''queue grids along a path of (lat, lon) points'''
+        step = GRID_BLOCK_SPACING_X * self.spacing * 0.5
+        for i in range(len(points)):
+            (lat, lon) = points[i][:2]
+            self.queue_prefetch(lat, lon)
+            if i == 0:
+                continue
+            (lat0, lon0) = points[i-1][:2]
+            dist = mp_util.gps_distance(lat0, lon0, lat, lon)
+            if dist > 100000:
+                # not a path the vehicle will fly
+                continue
+            bearing = mp_util.gps_bearing(lat0, lon0, lat, lon)
+            d = step
+            while d < dist:
+                (lat2, lon2) = mp_util.gps_newpos(lat0, lon0, bearing, d)
+                self.queue_prefetch(lat2, lon2)
+                d += step
+
+    def check_prefetch(self):
+        '''queue grids along the mission and ahead of the vehicle'''
+        if self.spacing is None:
+            self.spacing = self.get_mav_param('TERRAIN_SPACING', None)
+            if self.spacing is None:
+                return
+            self.spacing = int(self.spacing)
+        wp = self.module('wp')
+        if wp is not None and wp.wploader.last_change != self.mission_change:
+            self.mission_change = wp.wploader.last_change
+            points = [p for p in wp.wploader.polygon() if p[0] != 0 or p[1] != 0]
+            self.queue_path(points)
+        now = time.time()
+        pos = self.position
+        if pos is not None and now - self.last_velocity_prefetch > 2 and (pos.lat != 0 or pos.lon != 0):
+            self.last_velocity_prefetch = now
+            lat = pos.lat * 1.0e-7
+            lon = pos.lon * 1.0e-7
+            # vx is north and vy east, in cm/s
+            t = self.terrain_settings.lookahead
+            (lat2, lon2) = mp_util.gps_offset(lat, lon, pos.vy * 0.01 * t, pos.vx * 0.01 * t)
+            self.queue_path([(lat, lon), (lat2, lon2)])
 
     def idle_task(self):
         '''called when idle'''
-        if self.current_request is None:
+        now = time.time()
+        if self.current_request is not None:
+            rate = self.send_rate()
+            self.send_credit = min(self.send_credit + (now - self.last_credit) * rate, max(rate * 0.5, 1))
+            self.last_credit = now
+            while self.current_request is not None and self.send_credit >= 1:
+                if not self.send_terrain_data():
+                    break
+                self.send_credit -= 1
             return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
+        self.send_credit = 0
+        self.last_credit = now
+        if not self.terrain_settings.enable or not self.terrain_settings.prefetch:
             return
-        self.send_terrain_data()
+        self.check_prefetch()
+        if self.prefetch:
+            (lat, lon, spacing) = self.prefetch.popleft()
+            self.prefetch_keys.discard((lat, lon, spacing))
+            self.get_grid(lat, lon, spacing)
 
 def init(mpstate):
     '''initialise module'''
@@ -6,6 +6,7 @@ import math
 import threading
 import time
 
+from MAVProxy.modules.lib import mocap_bridge
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import LowPassFilter2p
@@ -35,23 +36,28 @@ class ViconModule(mp_module.MPModule):
              ('gps_nsats', float, 16),
              ('object_name', str, None)
              ])
+        # subjects are sent from the main loop by the bridge. With nothing
+        # mapped object_name, or the first subject, goes to the master link
+        self.bridge = mocap_bridge.MocapBridge(mpstate, "vicon", settings=self.vicon_settings,
+                                               sender=self.send_pose)
         self.add_command('vicon', self.cmd_vicon, 'VICON control',
-                         ["<start>",
-                          "<stop>",
+                         ["<start|stop|mappings|stats|reset>",
+                          "map SUBJECT <sysid|links|rate>",
+                          "unmap SUBJECT",
                           "set (VICONSETTING)"])
         self.add_completion_function('(VICONSETTING)',
                                      self.vicon_settings.completion)
         self.vicon = None
-        self.thread = threading.Thread(target=self.thread_loop)
-        self.thread.start()
+        self.default_subject = None
         self.pos = None
         self.att = None
         self.frame_count = 0
         self.gps_count = 0
         self.vision_count = 0
         self.last_frame_count = 0
-        self.vel_filter = LowPassFilter2p.LowPassFilter2p(200.0, 30.0)
         self.actual_frame_rate = 0.0
+        self.thread = threading.Thread(target=self.thread_loop)
+        self.thread.start()
 
     def detect_vicon_object(self):
         self.vicon.get_frame()
@@ -88,42 +94,35 @@ class ViconModule(mp_module.MPModule):
         return pos_ned, roll, pitch, yaw
 
     def thread_loop(self):
-        """background processing"""
-        object_name = None
-        segment_name = None
-        last_pos = None
+        """background processing, poses are queued for the main loop"""
+        subjects = {}
+        frame_dt = None
         last_frame_num = None
+        last_rate = time.time()
         frame_count = 0
 
         while True:
             if self.vicon is None:
                 time.sleep(0.1)
-                object_name = None
+                subjects = {}
+                frame_dt = None
+                self.default_subject = None
                 continue
 
-            if not object_name:
-                object_name, segment_name = self.detect_vicon_object()
-                if object_name is None:
-                    continue
-                last_msg_time = time.time()
-                now = time.time()
-                last_origin_send = now
-                now_ms = int(now * 1000)
-                last_gps_send_ms = now_ms
+            # get_frame() waits for the next frame
+            self.vicon.get_frame()
+            now = time.time()
+            if frame_dt is None:
                 frame_rate = self.vicon.get_frame_rate()
+                if not frame_rate:
+                    continue
                 frame_dt = 1.0/frame_rate
-                last_rate = time.time()
-                frame_count = 0
                 print("Vicon frame rate %.1f" % frame_rate)
-
-            if self.vicon_settings.gps_rate > 0:
-                gps_period_ms = 1000 // self.vicon_settings.gps_rate
-            time.sleep(0.01)
-            self.vicon.get_frame()
-            mav = self.master
-            now = time.time()
-            now_ms = int(now * 1000)
             frame_num = self.vicon.get_frame_number()
+            if frame_num == last_frame_num:
+                time.sleep(0.001)
+                continue
+            last_frame_num = frame_num
 
             frame_count += 1
             if now - last_rate > 0.1:
@@ -131,68 +130,96 @@ class ViconModule(mp_module.MPModule):
                 self.actual_frame_rate = 0.9 * self.actual_frame_rate + 0.1 * rate
                 last_rate = now
                 frame_count = 0
-                self.vel_filter.set_cutoff_frequency(self.actual_frame_rate, self.vicon_settings.vel_filter_hz)
-
-            pos_ned, roll, pitch, yaw = self.get_vicon_pose(object_name, segment_name)
-            if pos_ned is None:
-                continue
-            
-            # print(f"XYZ: {pos_ned.x}, {pos_ned.y}, {pos_ned.z}, ")
-
-            if last_frame_num is None or frame_num - last_frame_num > 100 or frame_num <= last_frame_num:
-                last_frame_num = frame_num
-                last_pos = pos_ned
-                continue
-
-            dt = (frame_num - last_frame_num) * frame_dt
-            vel = (pos_ned - last_pos) * (1.0/dt)
-            last_pos = pos_ned
-            last_frame_num = frame_num
-
-            filtered_vel = self.vel_filter.apply(vel)
-
-            if self.vicon_settings.vision_rate > 0:
-                dt = now - last_msg_time
-                if dt < 1.0 / self.vicon_settings.vision_rate:
+                for sub in subjects.values():
+                    if sub is not None:
+                        sub['vel_filter'].set_cutoff_frequency(self.actual_frame_rate, self.vicon_settings.vel_filter_hz)
+
+            names = self.bridge.bodies
+            if len(names) == 0:
+                if self.default_subject is None:
+                    self.default_subject, segment_name = self.detect_vicon_object()
+                    if self.default_subject is None:
+                        continue
+                names = [self.default_subject]
+
+            for object_name in names:
+                if object_name not in subjects:
+                    segment_name = self.vicon.get_subject_root_segment_name(object_name)
+                    if segment_name is None:
+                        continue
+                    subjects[object_name] = {'segment': segment_name,
+                                             'last_pos': None,
+                                             'last_frame_num': None,
+                                             'vel_filter': LowPassFilter2p.LowPassFilter2p(200.0, 30.0)}
+                sub = subjects[object_name]
+
+                pos_ned, roll, pitch, yaw = self.get_vicon_pose(object_name, sub['segment'])
+                if pos_ned is None:
                     continue
 
-            last_msg_time = now
-
-            self.pos = pos_ned
-            self.att = [math.degrees(roll), math.degrees(pitch), math.degrees(yaw)]
-            self.frame_count += 1
-
-            time_us = int(now * 1.0e6)
-
-            if now - last_origin_send > 1 and self.vicon_settings.vision_rate > 0:
-                # send a heartbeat msg
-                mav.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GCS, mavutil.mavlink.MAV_AUTOPILOT_GENERIC, 0, 0, 0)
-
-                # send origin at 1Hz
-                mav.mav.set_gps_global_origin_send(self.target_system,
-                                                   int(self.vicon_settings.origin_lat*1.0e7),
-                                                   int(self.vicon_settings.origin_lon*1.0e7),
-                                                   int(self.vicon_settings.origin_alt*1.0e3),
-                                                   time_us)
-                last_origin_send = now
+                sub_last = sub['last_frame_num']
+                if sub_last is None or frame_num - sub_last > 100 or frame_num <= sub_last:
+                    sub['last_frame_num'] = frame_num
+                    sub['last_pos'] = pos_ned
+                    continue
 
-            if self.vicon_settings.gps_rate > 0 and now_ms - last_gps_send_ms > gps_period_ms:
+                dt = (frame_num - sub_last) * frame_dt
+                vel = (pos_ned - sub['last_pos']) * (1.0/dt)
+                sub['last_pos'] = pos_ned
+                sub['last_frame_num'] = frame_num
+
+                filtered_vel = sub['vel_filter'].apply(vel)
+                self.bridge.push(object_name, pos_ned, None, capture_time=now,
+                                 extra=(roll, pitch, yaw, filtered_vel))
+
+    def send_pose(self, mav, mapping, sample, time_us):
+        """send one subject to one link, called from the main loop by the bridge"""
+        now = time.time()
+        now_ms = int(now * 1000)
+        pos_ned = sample.pos
+        (roll, pitch, yaw, filtered_vel) = sample.extra
+        state = mapping.state
+        target_system = mapping.sysid if mapping.sysid is not None else self.target_system
+        vision_rate = self.vicon_settings.vision_rate
+
+        self.pos = pos_ned
+        self.att = [math.degrees(roll), math.degrees(pitch), math.degrees(yaw)]
+        self.frame_count += 1
+
+        if now - state.get('last_origin_send', 0) > 1 and vision_rate > 0:
+            # send a heartbeat msg
+            mav.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GCS, mavutil.mavlink.MAV_AUTOPILOT_GENERIC, 0, 0, 0)
+
+            # send origin at 1Hz
+            mav.mav.set_gps_global_origin_send(target_system,
+                                               int(self.vicon_settings.origin_lat*1.0e7),
+                                               int(self.vicon_settings.origin_lon*1.0e7),
+                                               int(self.vicon_settings.origin_alt*1.0e3),
+                                               time_us)
+            state['last_origin_send'] = now
+
+        if self.vicon_settings.gps_rate > 0:
+            gps_period_ms = 1000 // self.vicon_settings.gps_rate
+            if now_ms - state.get('last_gps_send_ms', 0) > gps_period_ms:
                 '''send GPS data at the specified rate, trying to align on the given period'''
-                self.gps_input_send(now, pos_ned, yaw, filtered_vel)
-                last_gps_send_ms = (now_ms//gps_period_ms) * gps_period_ms
+                self.gps_input_send(now, pos_ned, yaw, filtered_vel, mav=mav)
+                state['last_gps_send_ms'] = (now_ms//gps_period_ms) * gps_period_ms
                 self.gps_count += 1
 
-            if self.vicon_settings.vision_rate > 0:
-                # send VISION_POSITION_ESTIMATE
-                # we force mavlink1 to avoid the covariances which seem to make the packets too large
-                # for the mavesp8266 wifi bridge
-                mav.mav.global_vision_position_estimate_send(time_us,
-                                                             pos_ned.x, pos_ned.y, pos_ned.z,
-                                                             roll, pitch, yaw, force_mavlink1=True)
-                self.vision_count += 1
-
-    def gps_input_send(self, time, pos_ned, yaw, gps_vel):
+        if vision_rate > 0 and now - state.get('last_vision_send', 0) >= 0.95 / vision_rate:
+            # send VISION_POSITION_ESTIMATE
+            # we force mavlink1 to avoid the covariances which seem to make the packets too large
+            # for the mavesp8266 wifi bridge
+            mav.mav.global_vision_position_estimate_send(time_us,
+                                                         pos_ned.x, pos_ned.y, pos_ned.z,
+                                                         roll, pitch, yaw, force_mavlink1=True)
+            state['last_vision_send'] = now
+            self.vision_count += 1
+
+    def gps_input_send(self, time, pos_ned, yaw, gps_vel, mav=None):
         time_us = int(time * 1.0e6)
+        if mav is None:
+            mav = self.master
 
         gps_lat, gps_lon = mavextra.gps_offset(self.vicon_settings.origin_lat,
                                                self.vicon_settings.origin_lon,
@@ -207,7 +234,7 @@ class ViconModule(mp_module.MPModule):
         if yaw_cd == 0:
             # the yaw extension to GPS_INPUT uses 0 as no yaw support
             yaw_cd = 36000
-        self.master.mav.gps_input_send(time_us, 0, 0, gps_week_ms, gps_week, fix_type,
+        mav.mav.gps_input_send(time_us, 0, 0, gps_week_ms, gps_week, fix_type,
                                int(gps_lat * 1.0e7), int(gps_lon * 1.0e7), gps_alt,
                                1.0, 1.0,
                                gps_vel.x, gps_vel.y, gps_vel.z,
@@ -231,6 +258,7 @@ class ViconModule(mp_module.MPModule):
         vicon.set_axis_mapping(pyvicon.Direction.Forward, pyvicon.Direction.Right, pyvicon.Direction.Down)
         print(vicon.get_axis_mapping())
         print("vicon ready")
+        self.bridge.start()
         self.vicon = vicon
 
     def cmd_vicon(self, args):
@@ -242,11 +270,19 @@ class ViconModule(mp_module.MPModule):
             self.cmd_start()
         if args[0] == "stop":
             self.vicon = None
+            self.bridge.stop()
         elif args[0] == "set":
             self.vicon_settings.command(args[1:])
+        elif args[0] in ["map", "unmap", "mappings", "stats", "reset"]:
+            self.bridge.command(args)
 
     def idle_task(self):
         """run on idle"""
+        if self.default_subject is not None:
+            # the vision and GPS rates are limited again when sending
+            self.bridge.set_default(self.default_subject,
+                                    rate=max(self.vicon_settings.vision_rate, self.vicon_settings.gps_rate, 1))
+        self.bridge.service()
         if not self.pos or not self.att or self.frame_count == self.last_frame_count:
             return
         self.last_frame_count = self.frame_count
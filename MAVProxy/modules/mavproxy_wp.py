@@ -18,6 +18,12 @@ if mp_util.has_wxpython:
 
 
 class WPModule(mission_item_protocol.MissionItemProtocolModule):
+    mavlink_packet_types = mission_item_protocol.MissionItemProtocolModule.mavlink_packet_types | frozenset([
+        'COMMAND_ACK',
+        'MISSION_CURRENT',
+        'MISSION_ITEM_REACHED',
+    ])
+
     def __init__(self, mpstate):
         super(WPModule, self).__init__(mpstate, "wp", "waypoint handling", public=True)
         # support for setting mission waypoint via command
@@ -151,11 +157,7 @@ class WPModule(mission_item_protocol.MissionItemProtocolModule):
         wp.target_component = self.target_component
         self.wploader.set(wp, idx)
 
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(self.target_system,
-                                                        self.target_component,
-                                                        idx, idx+1)
+        self.send_changes(hint=(idx, idx))
         print("Moved WP %u %.1fm bearing %.1f from home" % (idx, dist, bearing))
 
     def commands(self):
@@ -497,13 +499,7 @@ class WPModule(mission_item_protocol.MissionItemProtocolModule):
         w.x = lat
         w.y = lon
         self.wploader.set(w, 0)
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(
-            self.target_system,
-            self.target_component,
-            0, 0
-        )
+        self.send_changes(hint=(0, 0))
 
     def fix_jumps(self, idx, delta):
         '''fix up jumps when we add/remove rows'''
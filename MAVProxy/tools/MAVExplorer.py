@@ -24,6 +24,7 @@ from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.lib import param_ftp
+from MAVProxy.modules.lib import log_cache
 from MAVProxy.modules.lib.graph_ui import Graph_UI
 from pymavlink.mavextra import *
 from MAVProxy.modules.lib.mp_menu import *
@@ -40,6 +41,7 @@ from builtins import input
 import datetime
 import matplotlib
 import struct
+import numpy
 
 grui = []
 flightmodes = None
@@ -64,8 +66,12 @@ def xml_escape(e):
 
 def timestring(msg):
     '''return string for msg timestamp'''
-    ts_ms = int(msg._timestamp * 1000.0) % 1000
-    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(msg._timestamp)) + ".%.03u" % ts_ms
+    return timestamp_string(msg._timestamp)
+
+def timestamp_string(timestamp):
+    '''return string for a log timestamp'''
+    ts_ms = int(timestamp * 1000.0) % 1000
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) + ".%.03u" % ts_ms
 
 class MEStatus(object):
     '''status object to conform with mavproxy structure for modules'''
@@ -116,10 +122,14 @@ class MEState(object):
               MPSetting('paramdocs', bool, True, 'show param docs'),
               MPSetting('max_rate', float, 0, 'maximum display rate of graphs in Hz'),
               MPSetting('vehicle_type', str, 'Auto', 'force vehicle type for mode handling'),
+              MPSetting('logcache', bool, True, 'build and use a columnar cache next to the log'),
+              MPSetting('columnar', bool, True, 'evaluate graphs on whole columns where possible'),
+              MPSetting('graph_workers', int, 4, 'worker processes extracting graph data, 0 to disable'),
               ]
             )
 
         self.mlog = None
+        self.log_cache = None
         self.mav_param = None
         self.filename = None
         self.command_map = command_map
@@ -1189,6 +1199,32 @@ def cmd_param(args):
                     s += " # %s" % info
             print(s)
 
+def param_changes(types):
+    '''yield (timestamp, name, value) for each parameter message in the log'''
+    cache = mestate.log_cache
+    if cache is not None and cache.ready() and mestate.settings.condition is None:
+        columns = []
+        for (mtype, name, value) in [('PARM', 'Name', 'Value'), ('PARAM_VALUE', 'param_id', 'param_value')]:
+            if cache.has(mtype, name) and cache.has(mtype, value):
+                c = cache.columns(mtype, [name, value])
+                columns.append((c['_timestamp'], c[name], c[value]))
+        if len(columns) > 0:
+            t = numpy.concatenate([c[0] for c in columns])
+            names = numpy.concatenate([c[1] for c in columns])
+            values = numpy.concatenate([c[2] for c in columns])
+            for i in numpy.argsort(t, kind='stable'):
+                yield (t[i], str(names[i]), float(values[i]))
+        return
+    while True:
+        m = mestate.mlog.recv_match(type=types, condition=mestate.settings.condition)
+        if m is None:
+            break
+        if m.get_type() == 'PARM':
+            yield (m._timestamp, m.Name, m.Value)
+        elif m.get_type() == 'PARAM_VALUE':
+            yield (m._timestamp, m.param_id, m.param_value)
+    mestate.mlog.rewind()
+
 def cmd_paramchange(args):
     '''show param changes'''
     if len(args) > 0:
@@ -1199,18 +1235,7 @@ def cmd_paramchange(args):
         wildcard = '*'
     types = set(['PARM','PARAM_VALUE'])
     vmap = {}
-    while True:
-        m = mestate.mlog.recv_match(type=types, condition=mestate.settings.condition)
-        if m is None:
-            break
-        if m.get_type() == 'PARM':
-            pname = m.Name
-            pvalue = m.Value
-        elif m.get_type() == 'PARAM_VALUE':
-            pname = m.param_id
-            pvalue = m.param_value
-        else:
-            continue
+    for (timestamp, pname, pvalue) in param_changes(types):
         if pname.startswith('STAT_'):
             # STAT_* changes are not interesting
             continue
@@ -1220,9 +1245,8 @@ def cmd_paramchange(args):
             vmap[pname] = pvalue
             continue
 
-        print("%s %s %.6f -> %.6f" % (timestring(m), pname, vmap[pname], pvalue))
+        print("%s %s %.6f -> %.6f" % (timestamp_string(timestamp), pname, vmap[pname], pvalue))
         vmap[pname] = pvalue
-    mestate.mlog.rewind()
 
 
 def cmd_logmessage(args):
@@ -1364,6 +1388,7 @@ def loadfile(args):
                                       progress_callback=progress_bar)
     mestate.filename = args
     mestate.mlog = mlog
+    mestate.log_cache = None
     # note that this is a shallow copy of the messages.
     # Instance-number-containing messages in mestate.status.msgs may
     # reference messages in their parent DFReader object which no
@@ -1389,6 +1414,28 @@ def loadfile(args):
 
     setup_menus()
 
+    if mestate.settings.logcache:
+        t = threading.Thread(target=load_log_cache, args=(args,), name='log_cache')
+        t.daemon = True
+        t.start()
+
+def load_log_cache(filename):
+    '''open or build the columnar cache for a log in the background'''
+    cache = log_cache.LogCache(filename)
+    if not cache.valid():
+        t0 = time.time()
+        try:
+            # use our own connection so the loaded log isn't disturbed
+            mlog = mavutil.mavlink_connection(filename, notimestamps=False,
+                                              zero_time_base=False)
+            count = cache.build(mlog)
+        except Exception as ex:
+            mestate.console.writeln("Failed to build log cache: %s" % ex)
+            return
+        mestate.console.writeln("Built log cache of %u messages in %.1fs" % (count, time.time()-t0))
+    if mestate.filename == filename:
+        mestate.log_cache = cache
+
 def print_caught_exception(e):
     if sys.version_info[0] >= 3:
         ret = "%s\n" % e
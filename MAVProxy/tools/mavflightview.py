@@ -21,6 +21,7 @@ from MAVProxy.modules.mavproxy_map import mp_slipmap, mp_tile
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.lib import grapher
+from MAVProxy.modules.lib import mp_expression
 from MAVProxy.modules.lib import kmlread
 
 
@@ -220,8 +221,8 @@ def colour_for_point(mlog, point, instance, options):
     # evaluate source as an expression which should return a
     # number in the range 0..255
     try:
-        v = eval(source, globals(), mlog.messages)
-    except Exception as e:
+        v = mp_expression.compile_expression(source, namespace=globals()).evaluate(mlog.messages)
+    except mp_expression.ExpressionError as e:
         str_e = str(e)
         try:
             count = colour_expression_exceptions[str_e]
@@ -234,9 +235,6 @@ def colour_for_point(mlog, point, instance, options):
         colour_expression_exceptions[str_e] += 1
         v = 0
 
-    # we don't use evaluate_expression as we want the exceptions...
-#    v = mavutil.evaluate_expression(source, mlog.messages)
-
     if v is None:
         return v
     if isinstance(v, str):